@@ -1,15 +1,23 @@
+import hashlib
+import io
 import json
 import numpy as np
 import pandas as pd
 import streamlit as st
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
-from svgpathtools import parse_path
-from kafka_utilities import kafka_producer
+from kafka_utilities import kafka_producer, spool_stats
+from event_collector import RerunEventCollector
+from canvas_diff import CanvasDiffer, fingerprint
+from arc_length import ArcLengthCache
+from image_cache import ImageCache
+from metrics import export_from_env
 import datetime
 
 
 def main():
+    # METRICS_PORT / METRICS_FILE, started once per process
+    export_from_env()
     if "button_id" not in st.session_state:
         st.session_state["button_id"] = ""
     if "color_to_label" not in st.session_state:
@@ -22,6 +30,19 @@ def main():
     }
     page = st.sidebar.selectbox("Page:", options=list(PAGES.keys()))
     PAGES[page]()
+    st.sidebar.metric("Image cache hit rate", f"{get_image_cache().hit_rate:.0%}")
+    for stats in spool_stats().values():
+        st.sidebar.metric(
+            "Spooled events",
+            stats["lag"],
+            help=f"{stats['bytes'] / 2**20:.0f} MiB spooled, "
+            f"oldest waiting {stats['lag_seconds']:.0f}s",
+        )
+
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache()
 
 
 def full_app():
@@ -35,66 +56,40 @@ def full_app():
         """
     )
 
-    # Specify canvas parameters in application
-    drawing_mode = st.sidebar.selectbox(
-        "Drawing tool:",
-        ("freedraw", "line", "rect", "circle", "transform", "polygon", "point"),
-    )
-    kafka_producer(
-        request_dict={
-            "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "basic-example",
-            "drawing_mode": drawing_mode,
-        }
+    # Specify canvas parameters in application, the widget values of a
+    # rerun are sent as one record holding only the changed fields
+    events = RerunEventCollector("basic-example")
+    drawing_mode = events.add(
+        "drawing_mode",
+        st.sidebar.selectbox(
+            "Drawing tool:",
+            ("freedraw", "line", "rect", "circle", "transform", "polygon", "point"),
+        ),
     )
-    stroke_width = st.sidebar.slider("Stroke width: ", 1, 25, 3)
-    kafka_producer(
-        request_dict={
-            "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "basic-example",
-            "stroke_width": stroke_width,
-        }
+    stroke_width = events.add(
+        "stroke_width", st.sidebar.slider("Stroke width: ", 1, 25, 3)
     )
     if drawing_mode == "point":
-        point_display_radius = st.sidebar.slider("Point display radius: ", 1, 25, 3)
-        kafka_producer(
-            request_dict={
-                "timestamp": datetime.datetime.now().isoformat(),
-                "message_type": "basic-example",
-                "point_display_radius": point_display_radius,
-            }
+        point_display_radius = events.add(
+            "point_display_radius",
+            st.sidebar.slider("Point display radius: ", 1, 25, 3),
         )
-    stroke_color = st.sidebar.color_picker("Stroke color hex: ")
-    kafka_producer(
-        request_dict={
-            "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "basic-example",
-            "stroke_color": stroke_color,
-        }
+    stroke_color = events.add(
+        "stroke_color", st.sidebar.color_picker("Stroke color hex: ")
     )
-    bg_color = st.sidebar.color_picker("Background color hex: ", "#eee")
-    kafka_producer(
-        request_dict={
-            "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "basic-example",
-            "bg_color": bg_color,
-        }
+    bg_color = events.add(
+        "bg_color", st.sidebar.color_picker("Background color hex: ", "#eee")
     )
-    bg_image = st.sidebar.file_uploader("Background image:", type=["png", "jpg"])
-    kafka_producer(
-        request_dict={
-            "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "basic-example",
-            "bg_image": bg_image,
-        }
+    bg_image = events.add(
+        "bg_image", st.sidebar.file_uploader("Background image:", type=["png", "jpg"])
     )
-    realtime_update = st.sidebar.checkbox("Update in realtime", True)
-    kafka_producer(
-        request_dict={
-            "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "basic-example",
-            "realtime_update": realtime_update,
-        }
+    realtime_update = events.add(
+        "realtime_update", st.sidebar.checkbox("Update in realtime", True)
+    )
+    thumbnail_width = (
+        st.sidebar.slider("Thumbnail width: ", 100, 600, 300, step=50)
+        if st.sidebar.checkbox("Show the canvas image as a thumbnail", False)
+        else None
     )
 
     # Create a canvas component
@@ -103,38 +98,99 @@ def full_app():
         stroke_width=stroke_width,
         stroke_color=stroke_color,
         background_color=bg_color,
-        background_image=Image.open(bg_image) if bg_image else None,
+        background_image=(
+            get_image_cache().get(bg_image, (600, 500)) if bg_image else None
+        ),
         update_streamlit=realtime_update,
         height=500,
+        width=600,
         drawing_mode=drawing_mode,
         point_display_radius=point_display_radius if drawing_mode == "point" else 0,
         display_toolbar=st.sidebar.checkbox("Display toolbar", True),
         key="full_app",
     )
 
-    # Do something interesting with the image data and paths
+    # Do something interesting with the image data and paths, an unchanged
+    # canvas reuses the frames and images rendered on a previous rerun
     if canvas_result.image_data is not None:
-        st.image(canvas_result.image_data)
+        st.image(canvas_image_png(canvas_result.image_data, thumbnail_width))
     if canvas_result.json_data is not None:
-        if canvas_result.json_data.get("objects"):
+        json_hash = fingerprint(canvas_result.json_data)
+        changed = st.session_state.get("full_app_json_hash") != json_hash
+        st.session_state["full_app_json_hash"] = json_hash
+        if changed and canvas_result.json_data.get("objects"):
             # for each key in the json_data, we can get the value
-            # and produce a message to the kafka topic
+            # and add it to this rerun's record
             for key in canvas_result.json_data["objects"][0].keys():
                 if key == "path":
                     new_message = "new path drawn"
                 else:
                     new_message = canvas_result.json_data["objects"][0].get(key)
-                kafka_producer(
-                    request_dict={
-                        "timestamp": datetime.datetime.now().isoformat(),
-                        "message_type": "basic-example",
-                        key: new_message,
-                    }
-                )
-        objects = pd.json_normalize(canvas_result.json_data["objects"])
-        for col in objects.select_dtypes(include=["object"]).columns:
-            objects[col] = objects[col].astype("str")
-        st.dataframe(objects)
+                events.add(key, new_message)
+        st.dataframe(objects_frame(json_hash, canvas_result.json_data["objects"]))
+    events.flush()
+
+
+@st.cache_data(max_entries=32)
+def objects_frame(json_hash: str, _objects: list) -> pd.DataFrame:
+    """Return the canvas objects as a string cast DataFrame, cached per canvas hash."""
+    objects = pd.json_normalize(_objects)
+    for col in objects.select_dtypes(include=["object"]).columns:
+        objects[col] = objects[col].astype("str")
+    return objects
+
+
+def canvas_image_png(image_data: np.ndarray, thumbnail_width: int = None) -> bytes:
+    """Encode the canvas image as PNG, downsampled to ``thumbnail_width`` if given.
+
+    Cached per image content, so an unchanged canvas is not encoded again.
+    """
+    image_hash = hashlib.blake2b(image_data.tobytes(), digest_size=16).hexdigest()
+    return _encode_png(image_hash, image_data, thumbnail_width)
+
+
+@st.cache_data(max_entries=32)
+def _encode_png(
+    image_hash: str, _image_data: np.ndarray, thumbnail_width: int
+) -> bytes:
+    image = Image.fromarray(_image_data)
+    if thumbnail_width is not None and image.width > thumbnail_width:
+        image.thumbnail((thumbnail_width, image.height), Image.Resampling.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def circle_centers(objects: list) -> pd.DataFrame:
+    """Compute the center coordinates of the circle objects in one NumPy pass.
+
+    Parameters
+    ----------
+    objects : list
+        The Fabric.js objects of the canvas.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns ``center_x``, ``center_y`` and ``radius``, one row per circle.
+    """
+    geometry = np.array(
+        [
+            (obj["left"], obj["top"], obj["radius"], obj["angle"])
+            for obj in objects
+            if obj.get("type") == "circle"
+        ],
+        dtype=float,
+    ).reshape(-1, 4)
+    left, top, radius, angle = geometry.T
+    theta = np.deg2rad(angle)
+    return pd.DataFrame(
+        {
+            "center_x": left + radius * np.cos(theta),
+            "center_y": top + radius * np.sin(theta),
+            "radius": radius,
+        }
+    )
 
 
 def center_circle_app():
@@ -151,7 +207,7 @@ def center_circle_app():
     ```
     """
     )
-    bg_image = Image.open("img/dnd.jpeg")
+    bg_image = get_image_cache().get("img/dnd.jpeg", (600, 400))
 
     with open("saved_state.json", "r") as f:
         saved_state = json.load(f)
@@ -173,33 +229,24 @@ def center_circle_app():
     )
 
     if canvas_result.json_data is not None:
-        kafka_producer(
-            request_dict={
-                "timestamp": datetime.datetime.now().isoformat(),
-                "message_type": "center-circle",
-                "body": canvas_result.json_data["objects"],
-            }
+        # only the objects added, modified or deleted since the last rerun
+        delta = CanvasDiffer("center_circle_app").emit(
+            canvas_result.json_data["objects"], "center-circle"
         )
-        df = pd.json_normalize(canvas_result.json_data["objects"])
-        if len(df) == 0:
+        centers = circle_centers(canvas_result.json_data["objects"])
+        if len(centers) == 0:
             return
-        df["center_x"] = df["left"] + df["radius"] * np.cos(df["angle"] * np.pi / 180)
-        df["center_y"] = df["top"] + df["radius"] * np.sin(df["angle"] * np.pi / 180)
 
         st.subheader("List of circle drawings")
-        for _, row in df.iterrows():
-            st.markdown(
-                f'Center coords: ({row["center_x"]:.2f}, {row["center_y"]:.2f}). Radius: {row["radius"]:.2f}'
-            )
+        st.dataframe(centers.round(2), use_container_width=True)
+        if delta is not None:
+            # all circles in one event, only when the canvas changed, under
+            # a message_type of their own, center-circle only holds deltas
             kafka_producer(
                 request_dict={
                     "timestamp": datetime.datetime.now().isoformat(),
-                    "message_type": "center-circle",
-                    "body": {
-                        "center_x": row["center_x"],
-                        "center_y": row["center_y"],
-                        "radius": row["radius"],
-                    },
+                    "message_type": "center-circle-centers",
+                    "body": centers.to_dict("records"),
                 }
             )
 
@@ -217,14 +264,14 @@ def color_annotation_app():
     """
     )
 
-    bg_image = Image.open("img/annotation.jpeg")
+    bg_image = get_image_cache().get("img/annotation.jpeg", (512, 320))
     label_color = (
         st.sidebar.color_picker("Annotation color: ", "#EA1010") + "77"
     )  # for alpha from 00 to FF
     kafka_producer(
         request_dict={
             "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "color-annotation",
+            "message_type": "color-annotation-settings",
             "body": label_color,
         }
     )
@@ -232,7 +279,7 @@ def color_annotation_app():
     kafka_producer(
         request_dict={
             "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "color-annotation",
+            "message_type": "color-annotation-settings",
             "body": label,
         }
     )
@@ -240,7 +287,7 @@ def color_annotation_app():
     kafka_producer(
         request_dict={
             "timestamp": datetime.datetime.now().isoformat(),
-            "message_type": "color-annotation",
+            "message_type": "color-annotation-settings",
             "body": mode,
         }
     )
@@ -255,12 +302,9 @@ def color_annotation_app():
         key="color_annotation_app",
     )
     if canvas_result.json_data is not None:
-        kafka_producer(
-            request_dict={
-                "timestamp": datetime.datetime.now().isoformat(),
-                "message_type": "color-annotation",
-                "body": canvas_result.json_data["objects"],
-            }
+        # only the objects added, modified or deleted since the last rerun
+        CanvasDiffer("color_annotation_app").emit(
+            canvas_result.json_data["objects"], "color-annotation"
         )
         df = pd.json_normalize(canvas_result.json_data["objects"])
         if len(df) == 0:
@@ -273,6 +317,11 @@ def color_annotation_app():
         st.json(st.session_state["color_to_label"])
 
 
+@st.cache_resource
+def get_arc_length_cache():
+    return ArcLengthCache()
+
+
 def compute_arc_length():
     st.markdown(
         """
@@ -282,7 +331,7 @@ def compute_arc_length():
     """
     )
 
-    bg_image = Image.open("img/annotation.jpeg")
+    bg_image = get_image_cache().get("img/annotation.jpeg", (512, 320))
 
     canvas_result = st_canvas(
         stroke_color="yellow",
@@ -297,23 +346,29 @@ def compute_arc_length():
         canvas_result.json_data is not None
         and len(canvas_result.json_data["objects"]) != 0
     ):
-        kafka_producer(
-            request_dict={
-                "timestamp": datetime.datetime.now().isoformat(),
-                "message_type": "compute-arc-length",
-                "body": canvas_result.json_data["objects"],
-            }
+        # only the objects added, modified or deleted since the last rerun
+        delta = CanvasDiffer("compute_arc_length").emit(
+            canvas_result.json_data["objects"], "compute-arc-length"
         )
-        df = pd.json_normalize(canvas_result.json_data["objects"])
-        paths = df["path"].tolist()
-        for ind, path in enumerate(paths):
-            path = parse_path(" ".join([str(e) for line in path for e in line]))
-            st.write(f"Path {ind} has length {path.length():.3f} pixels")
+        cache = get_arc_length_cache()
+        lengths = []
+        for ind, obj in enumerate(canvas_result.json_data["objects"]):
+            # unchanged paths are looked up, not measured again
+            lengths.append(cache.length(obj["path"]))
+            st.write(f"Path {ind} has length {lengths[ind]:.3f} pixels")
+        if delta is not None and (delta["added"] or delta["modified"]):
+            # the lengths of the changed paths only, keyed by the object id
+            # the deltas carry the path under
+            length_of = dict(zip(delta["order"], lengths))
+            body = [
+                {"id": change["id"], "length": f"{length_of[change['id']]:.3f} pixels"}
+                for change in delta["added"] + delta["modified"]
+            ]
             kafka_producer(
                 request_dict={
                     "timestamp": datetime.datetime.now().isoformat(),
-                    "message_type": "compute-arc-length",
-                    "body": {"path": path, "length": f"{path.length():.3f} pixels"},
+                    "message_type": "compute-arc-length-lengths",
+                    "body": body,
                 }
             )
 
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from svgpathtools import parse_path
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Gauss-Legendre nodes and weights mapped onto t in [0, 1]
+_LOW_NODES, _LOW_WEIGHTS = np.polynomial.legendre.leggauss(4)
+_HIGH_NODES, _HIGH_WEIGHTS = np.polynomial.legendre.leggauss(8)
+_REFINED_NODES, _REFINED_WEIGHTS = np.polynomial.legendre.leggauss(32)
+
+
+def path_fingerprint(path: list) -> str:
+    """Return a hash identifying a Fabric.js path command list."""
+    if orjson is not None:
+        encoded = orjson.dumps(path)
+    else:
+        encoded = json.dumps(path, separators=(",", ":")).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def path_to_svg(path: list) -> str:
+    """Turn a Fabric.js path command list into an svg path string."""
+    return " ".join([str(e) for line in path for e in line])
+
+
+def exact_length(path: list) -> float:
+    """Return the path length computed by svgpathtools."""
+    return parse_path(path_to_svg(path)).length()
+
+
+def _quadratic_segments(path: list):
+    """Return the control points of the path as quadratic segments.
+
+    Lines are quadratics with their control point half way. Raises
+    ValueError for any other command, the caller falls back to svgpathtools.
+    """
+    starts, controls, ends = [], [], []
+    current = start = None
+    for command in path:
+        op, args = command[0], command[1:]
+        if op == "M":
+            current = start = (args[0], args[1])
+            continue
+        if current is None:
+            raise ValueError(f"Path does not start with a move: {command}")
+        if op == "Q":
+            control, end = (args[0], args[1]), (args[2], args[3])
+        elif op == "L":
+            end = (args[0], args[1])
+            control = ((current[0] + end[0]) / 2, (current[1] + end[1]) / 2)
+        elif op in ("Z", "z"):
+            end = start
+            control = ((current[0] + end[0]) / 2, (current[1] + end[1]) / 2)
+        else:
+            raise ValueError(f"Unsupported path command {op}")
+        starts.append(current)
+        controls.append(control)
+        ends.append(end)
+        current = end
+    return (
+        np.array(starts, dtype=float).reshape(-1, 2),
+        np.array(controls, dtype=float).reshape(-1, 2),
+        np.array(ends, dtype=float).reshape(-1, 2),
+    )
+
+
+def _gauss_lengths(d0: np.ndarray, d1: np.ndarray, nodes, weights) -> np.ndarray:
+    """Return the length of every quadratic segment."""
+    t = (nodes + 1) / 2
+    # B'(t) = 2 (1 - t) (P1 - P0) + 2 t (P2 - P1), shape (segments, nodes, 2)
+    derivative = 2 * (
+        (1 - t)[None, :, None] * d0[:, None, :] + t[None, :, None] * d1[:, None, :]
+    )
+    speed = np.sqrt((derivative**2).sum(axis=2))
+    return speed @ weights / 2
+
+
+def estimate_length(path: list, tolerance: float = 1e-4) -> float:
+    """Estimate the length of a Fabric.js path with vectorized quadrature.
+
+    Every quadratic segment is integrated at once with 4 and 8 point
+    Gauss-Legendre quadrature. Segments where the two disagree by more than
+    ``tolerance`` (relative) are integrated again with 32 points, and if
+    that still disagrees, or the path holds commands other than M/L/Q/Z,
+    the exact svgpathtools length is returned instead.
+
+    Parameters
+    ----------
+    path : list
+        The Fabric.js path commands, e.g. ``[["M", 0, 0], ["Q", 1, 1, 2, 0]]``.
+    tolerance : float
+        The accepted relative error per segment.
+
+    Returns
+    -------
+    float
+        The path length in pixels.
+    """
+    try:
+        starts, controls, ends = _quadratic_segments(path)
+    except (ValueError, IndexError):
+        return exact_length(path)
+    d0, d1 = controls - starts, ends - controls
+    low = _gauss_lengths(d0, d1, _LOW_NODES, _LOW_WEIGHTS)
+    lengths = _gauss_lengths(d0, d1, _HIGH_NODES, _HIGH_WEIGHTS)
+    rough = np.abs(lengths - low) > tolerance * np.maximum(lengths, 1e-12)
+    if rough.any():
+        refined = _gauss_lengths(d0[rough], d1[rough], _REFINED_NODES, _REFINED_WEIGHTS)
+        error = np.abs(refined - lengths[rough])
+        if (error > tolerance * refined + 1e-9).any():
+            return exact_length(path)
+        lengths[rough] = refined
+    return float(lengths.sum())
+
+
+class ArcLengthCache:
+    """A bounded LRU cache of path lengths keyed by path fingerprint.
+
+    Parameters
+    ----------
+    max_entries : int
+        The number of lengths kept, the least recently used are evicted.
+    tolerance : float
+        Passed on to ``estimate_length``, None always uses svgpathtools.
+    """
+
+    def __init__(self, max_entries: int = 10000, tolerance: float = 1e-4):
+        self.max_entries = max_entries
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        self._lengths = OrderedDict()
+        self._lock = threading.Lock()
+
+    def length(self, path: list) -> float:
+        """Return the length of a path, computing it only on a cache miss."""
+        key = path_fingerprint(path)
+        with self._lock:
+            if key in self._lengths:
+                self._lengths.move_to_end(key)
+                self.hits += 1
+                return self._lengths[key]
+            self.misses += 1
+        if self.tolerance is None:
+            length = exact_length(path)
+        else:
+            length = estimate_length(path, self.tolerance)
+        with self._lock:
+            self._lengths[key] = length
+            if len(self._lengths) > self.max_entries:
+                self._lengths.popitem(last=False)
+        return length
@@ -0,0 +1,183 @@
+import argparse
+import time
+
+from confluent_kafka import Consumer
+
+from event_archive import FORMATS, load_state, save_state, write_documents
+from opensearch_client import get_client
+from opensearch_index import INDEX_ALIAS
+from opensearch_loader import iter_hit_pages
+from opensearch_sink import kafka_doc_id, stamp_consumed
+from serializers import decode_message
+
+kafka_brokers = "localhost:29092"
+kafka_topic = "canvas"
+
+
+def export_opensearch(
+    path: str,
+    file_format: str,
+    include_body: bool,
+    settle: float,
+    page_size: int,
+) -> int:
+    """Append the documents indexed since the previous export to the archive.
+
+    Documents are read in ``indexed_at`` order and the position of the last
+    archived one is saved after every page, so an interrupted export resumes
+    where it stopped. Documents indexed in the last ``settle`` seconds are
+    left for the next export, they may not be searchable yet. Documents from
+    before ``indexed_at`` existed are exported once, on the first run.
+    """
+    state = load_state(path)
+    exported = 0
+    phases = [
+        (
+            "legacy",
+            {"bool": {"must_not": {"exists": {"field": "indexed_at"}}}},
+            [{"timestamp": {"order": "asc"}}],
+        ),
+        (
+            "indexed",
+            {"range": {"indexed_at": {"lt": f"now-{int(settle)}s"}}},
+            [{"indexed_at": {"order": "asc"}}],
+        ),
+    ]
+    for phase, query, sort in phases:
+        if state.get("phase", "legacy") != phase:
+            continue
+        pages = iter_hit_pages(
+            get_client(),
+            INDEX_ALIAS,
+            float("inf"),
+            query=query,
+            sort=sort,
+            source_excludes=None if include_body else ["body"],
+            page_size=page_size,
+            search_after=state.get("search_after"),
+        )
+        for hits, total in pages:
+            exported += write_documents(
+                path,
+                [(hit["_id"], hit["_source"]) for hit in hits],
+                file_format=file_format,
+                include_body=include_body,
+            )
+            state.update(search_after=hits[-1]["sort"])
+            save_state(path, state)
+            print(f"{phase}: archived {exported:,} of {total:,}")
+        if phase == "legacy":
+            state = {"format": file_format, "phase": "indexed"}
+            save_state(path, state)
+    return exported
+
+
+def export_kafka(
+    path: str,
+    file_format: str,
+    include_body: bool,
+    batch_size: int,
+    idle_timeout: float,
+) -> int:
+    """Append the canvas topic to the archive, as its own consumer group.
+
+    Offsets are committed once a batch is written, so a crash re-archives
+    at most one batch. Stops after ``idle_timeout`` seconds without messages.
+    """
+    consumer = Consumer(
+        {
+            "bootstrap.servers": kafka_brokers,
+            "group.id": "canvas_archiver",
+            "auto.offset.reset": "earliest",
+            "enable.auto.commit": False,
+        }
+    )
+    consumer.subscribe([kafka_topic])
+    exported = 0
+    documents = []
+    last_message = time.monotonic()
+    try:
+        while time.monotonic() - last_message < idle_timeout:
+            messages = consumer.consume(batch_size - len(documents), timeout=1.0)
+            for message in messages:
+                if message.error():
+                    print(f"Consumer error: {message.error()}")
+                    continue
+                last_message = time.monotonic()
+                try:
+                    document = decode_message(message)
+                except Exception as e:
+                    print(f"Skipping undecodable message: {e}")
+                    continue
+                stamp_consumed(message, document)
+                documents.append((kafka_doc_id(message), document))
+            if documents and (len(documents) >= batch_size or not messages):
+                exported += write_documents(
+                    path, documents, file_format=file_format, include_body=include_body
+                )
+                consumer.commit(asynchronous=False)
+                documents = []
+                print(f"archived {exported:,}")
+    finally:
+        consumer.close()
+    return exported
+
+
+def main() -> None:
+    """
+    append the logged canvas events to a columnar archive partitioned by
+    date and message_type, for offline analytics in the dashboard
+    """
+    parser = argparse.ArgumentParser(description="Archive logged canvas events")
+    parser.add_argument(
+        "--source", choices=["opensearch", "kafka"], default="opensearch"
+    )
+    parser.add_argument("--path", default="archive", help="the archive directory")
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="arrow",
+        help="arrow files are memory-mapped when read, parquet files are smaller",
+    )
+    parser.add_argument(
+        "--include-body",
+        action="store_true",
+        help="also archive the canvas objects (body field) as JSON",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=60,
+        help="opensearch: skip documents indexed in the last this many seconds",
+    )
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=10,
+        help="kafka: stop after this many seconds without messages",
+    )
+    args = parser.parse_args()
+
+    state = load_state(args.path)
+    if state.setdefault("format", args.format) != args.format:
+        parser.error(f"the archive at {args.path} is in {state['format']} format")
+    save_state(args.path, state)
+
+    if args.source == "opensearch":
+        exported = export_opensearch(
+            args.path, args.format, args.include_body, args.settle, args.batch_size
+        )
+    else:
+        exported = export_kafka(
+            args.path,
+            args.format,
+            args.include_body,
+            args.batch_size,
+            args.idle_timeout,
+        )
+    print(f"archived {exported:,} events to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
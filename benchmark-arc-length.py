@@ -0,0 +1,47 @@
+import argparse
+import random
+import time
+
+from arc_length import ArcLengthCache, estimate_length, exact_length
+from synthetic_events import fabric_path
+
+
+def timed(function, paths: list):
+    start = time.perf_counter()
+    lengths = [function(path) for path in paths]
+    return lengths, (time.perf_counter() - start) / len(paths) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare arc length computations over synthetic strokes"
+    )
+    parser.add_argument("--strokes", type=int, default=20)
+    parser.add_argument("--points", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for points in args.points:
+        rng = random.Random(args.seed)
+        paths = [fabric_path(points, rng) for _ in range(args.strokes)]
+        exact, exact_ms = timed(exact_length, paths)
+        estimated, estimate_ms = timed(
+            lambda path: estimate_length(path, args.tolerance), paths
+        )
+        cache = ArcLengthCache(tolerance=args.tolerance)
+        timed(cache.length, paths)
+        # a rerun with an unchanged canvas only hits the cache
+        _, cached_ms = timed(cache.length, paths)
+        max_error = max(abs(e - x) / x for e, x in zip(estimated, exact))
+        print(f"{points} segment strokes")
+        print(f"  svgpathtools: {exact_ms:,.3f} ms/path")
+        print(
+            f"     estimate: {estimate_ms:,.3f} ms/path, "
+            f"max relative error {max_error:.2e}"
+        )
+        print(f"       cached: {cached_ms:,.3f} ms/path")
+
+
+if __name__ == "__main__":
+    main()
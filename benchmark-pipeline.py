@@ -0,0 +1,349 @@
+import argparse
+import datetime
+import logging
+import multiprocessing
+import random
+import re
+import resource
+import threading
+import time
+
+import numpy as np
+from confluent_kafka import Consumer, Producer
+
+from kafka_utilities import EventEmitter
+from opensearch_sink import BulkSink, kafka_doc_id
+from serializers import decode_message, get_serializer
+from synthetic_events import MESSAGE_TYPES, SyntheticSession
+
+TOPIC = "canvas-benchmark"
+
+
+class MockClusterAddress(logging.Handler):
+    """Catch the address librdkafka gives its mock cluster."""
+
+    address = None
+
+    def emit(self, record):
+        match = re.search(r"replaced with (\S+)", record.getMessage())
+        if match:
+            MockClusterAddress.address = match.group(1)
+
+
+def start_mock_cluster() -> tuple:
+    """Start librdkafka's mock cluster, it lives as long as the returned producer.
+
+    The benchmark topic is auto-created by a metadata request, the mock
+    cluster gives it 4 partitions.
+
+    Returns
+    -------
+    tuple
+        ``(producer, bootstrap_servers)``, other clients reach the cluster
+        through the bootstrap servers.
+    """
+    mock_logger = logging.getLogger("mock-cluster")
+    mock_logger.addHandler(MockClusterAddress())
+    mock_logger.setLevel(logging.INFO)
+    mock_logger.propagate = False
+    producer = Producer(
+        {
+            "test.mock.num.brokers": 1,
+            "bootstrap.servers": "mock",
+            "logger": mock_logger,
+        }
+    )
+    while MockClusterAddress.address is None:
+        producer.poll(0.1)
+    producer.list_topics(TOPIC, timeout=10)
+    return producer, MockClusterAddress.address
+
+
+class FakeOpenSearch:
+    """An in-process stand-in for the OpenSearch ``bulk`` API.
+
+    Every indexed document's end to end latency, from its ``timestamp`` to
+    the bulk request, is recorded.
+
+    Parameters
+    ----------
+    latency : float
+        Seconds every bulk request takes, on top of the work done here.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.indexed = 0
+        self.end_to_end = []
+
+    def bulk(self, body: list) -> dict:
+        now = datetime.datetime.now()
+        documents = body[1::2]
+        for document in documents:
+            self.end_to_end.append(
+                (
+                    now - datetime.datetime.fromisoformat(document["timestamp"])
+                ).total_seconds()
+            )
+        if self.latency:
+            time.sleep(self.latency)
+        self.indexed += len(documents)
+        return {
+            "errors": False,
+            "items": [{"index": {"status": 201}} for _ in documents],
+        }
+
+
+def percentiles(values: list, scale: float = 1000) -> dict:
+    """Return p50/p95/p99 of ``values``, multiplied by ``scale``."""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    values = np.array(values) * scale
+    return {f"p{q}": float(np.percentile(values, q)) for q in (50, 95, 99)}
+
+
+def usage(before: resource.struct_rusage) -> dict:
+    """Return the CPU seconds since ``before`` and the peak RSS of this process."""
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        "cpu_s": after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime,
+        "max_rss_mb": after.ru_maxrss / 1024,
+    }
+
+
+def run_sessions(
+    bootstrap: str,
+    sessions: int,
+    rate: float,
+    duration: float,
+    mix: dict,
+    serializer: str,
+    seed: int,
+    results,
+) -> None:
+    """The producer stage: simulated user sessions emitting through an EventEmitter.
+
+    Each session reruns the apps sending the message types in ``mix``
+    ``rate`` times per second, 0 as fast as it can, for ``duration`` seconds
+    and emits the events of each rerun, canvas deltas included.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    ack_latencies = []
+
+    def on_delivery(err, msg):
+        if err is None:
+            ack_latencies.append(msg.latency())
+
+    emitter = EventEmitter(
+        kafka_topic=TOPIC,
+        kafka_brokers=bootstrap,
+        backpressure="block",
+        on_delivery=on_delivery,
+        serializer=get_serializer(serializer),
+    )
+    message_types, weights = zip(*mix.items())
+    emit_latencies = [[] for _ in range(sessions)]
+
+    def session(index: int) -> None:
+        rng = random.Random(seed + index)
+        user = SyntheticSession(rng)
+        deadline = time.monotonic() + duration
+        next_event = time.monotonic()
+        while time.monotonic() < deadline:
+            message_type = rng.choices(message_types, weights)[0]
+            for event in user.rerun(message_type):
+                start = time.perf_counter()
+                emitter.emit(event)
+                emit_latencies[index].append(time.perf_counter() - start)
+            if rate:
+                next_event += rng.expovariate(rate)
+                time.sleep(max(next_event - time.monotonic(), 0))
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    emitted = time.perf_counter() - start
+    emitter.close(timeout=60)
+    stats = emitter.stats()
+    results.put(
+        (
+            "producer",
+            {
+                "events": stats["emitted"],
+                "events_per_sec": stats["emitted"] / emitted,
+                "delivered": stats["delivered"],
+                "failed": stats["failed"],
+                "emit_ms": percentiles(sum(emit_latencies, [])),
+                "produce_to_ack_ms": percentiles(ack_latencies),
+                **usage(before),
+            },
+        )
+    )
+
+
+def run_sink(
+    bootstrap: str,
+    bulk_latency: float,
+    max_batch_docs: int,
+    ready,
+    expected,
+    results,
+) -> None:
+    """The consumer stage: a BulkSink from the mock cluster into FakeOpenSearch.
+
+    Stops once ``expected`` documents are indexed, or 30 seconds after the
+    last one when fewer arrive.
+    """
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    client = FakeOpenSearch(bulk_latency)
+    consumer = Consumer(
+        {
+            "bootstrap.servers": bootstrap,
+            "group.id": "canvas-benchmark",
+            "auto.offset.reset": "earliest",
+            "enable.auto.commit": False,
+        }
+    )
+    sink = BulkSink(
+        client=client,
+        consumer=consumer,
+        index_name="canvas-benchmark",
+        decode=decode_message,
+        doc_id=kafka_doc_id,
+        max_batch_docs=max_batch_docs,
+        report_interval=float("inf"),
+    )
+
+    def on_assign(consumer, partitions):
+        sink.on_assign(consumer, partitions)
+        ready.set()
+
+    consumer.subscribe([TOPIC], on_assign=on_assign, on_revoke=sink.on_revoke)
+    thread = threading.Thread(target=sink.run)
+    thread.start()
+    first_indexed = last_indexed = None
+    last_count = 0
+    while expected.value < 0 or client.indexed < expected.value:
+        time.sleep(0.05)
+        if client.indexed != last_count:
+            last_count = client.indexed
+            last_indexed = time.perf_counter()
+            first_indexed = first_indexed or last_indexed
+        elif last_indexed and time.perf_counter() - last_indexed > 30:
+            break
+    last_indexed = time.perf_counter()
+    sink.stop()
+    thread.join()
+    consumer.close()
+    summary = sink.metrics.summary()
+    elapsed = last_indexed - (first_indexed or last_indexed)
+    results.put(
+        (
+            "sink",
+            {
+                "docs": client.indexed,
+                "docs_per_sec": client.indexed / elapsed if elapsed else None,
+                "bulk_requests": summary["bulk_requests"],
+                "bulk_ms": percentiles(list(sink.metrics.bulk_latencies)),
+                "end_to_end_ms": percentiles(client.end_to_end),
+                **usage(before),
+            },
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Replay synthetic app sessions through the producer, "
+        "a mock Kafka cluster, the bulk sink and a fake OpenSearch"
+    )
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=20,
+        help="app reruns per second per session, 0 for as fast as possible",
+    )
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument(
+        "--mix",
+        nargs="+",
+        default=[f"{message_type}=1" for message_type in MESSAGE_TYPES],
+        help="message_type=weight pairs",
+    )
+    parser.add_argument("--serializer", default="json")
+    parser.add_argument("--max-batch-docs", type=int, default=500)
+    parser.add_argument(
+        "--bulk-latency-ms",
+        type=float,
+        default=5,
+        help="simulated OpenSearch time per bulk request",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    mix = {
+        message_type: float(weight)
+        for message_type, weight in (pair.split("=") for pair in args.mix)
+    }
+
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    mock_producer, bootstrap = start_mock_cluster()
+    # every stage has its own process, so its CPU and memory are its own,
+    # spawned as librdkafka clients don't survive a fork
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    ready = context.Event()
+    expected = context.Value("q", -1)
+    sink = context.Process(
+        target=run_sink,
+        args=(
+            bootstrap,
+            args.bulk_latency_ms / 1000,
+            args.max_batch_docs,
+            ready,
+            expected,
+            results,
+        ),
+    )
+    sink.start()
+    ready.wait()
+    producer = context.Process(
+        target=run_sessions,
+        args=(
+            bootstrap,
+            args.sessions,
+            args.rate,
+            args.duration,
+            mix,
+            args.serializer,
+            args.seed,
+            results,
+        ),
+    )
+    producer.start()
+    stages = dict([results.get()])
+    expected.value = stages["producer"]["delivered"]
+    stages.update([results.get()])
+    producer.join()
+    sink.join()
+    stages["kafka (mock cluster)"] = usage(before)
+    del mock_producer
+
+    for stage, stats in stages.items():
+        print(stage)
+        for name, value in stats.items():
+            if isinstance(value, dict):
+                value = ", ".join(
+                    f"{key} {number:,.2f}" if number is not None else f"{key} -"
+                    for key, number in value.items()
+                )
+            elif isinstance(value, float):
+                value = f"{value:,.2f}"
+            print(f"  {name}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import datetime
+import logging
+import time
+
+import numpy as np
+from confluent_kafka import Producer
+
+import kafka_utilities
+from kafka_utilities import kafka_producer
+
+# librdkafka's built-in mock cluster stands in for the broker, the
+# bootstrap.servers setting is ignored when it is enabled
+MOCK_CONFIG = {"test.mock.num.brokers": 1}
+
+# the sidebar widgets full_app reports on every rerun
+SIDEBAR_FIELDS = {
+    "drawing_mode": "freedraw",
+    "stroke_width": 3,
+    "stroke_color": "#000000",
+    "bg_color": "#eee",
+    "bg_image": None,
+    "realtime_update": True,
+}
+
+
+def legacy_kafka_producer(
+    kafka_topic: str = "canvas",
+    kafka_brokers: str = "localhost:29092",
+    request_dict: dict = None,
+):
+    """The pre-registry producer: one Producer, poll and flush per message."""
+    p = Producer(
+        {
+            **MOCK_CONFIG,
+            "bootstrap.servers": kafka_brokers,
+            "socket.keepalive.enable": True,
+        }
+    )
+    p.produce(kafka_topic, str(request_dict))
+    p.poll(1)
+    p.flush()
+    return request_dict
+
+
+def pooled_kafka_producer(
+    kafka_topic: str = "canvas",
+    kafka_brokers: str = "localhost:29092",
+    request_dict: dict = None,
+):
+    return kafka_producer(
+        kafka_topic=kafka_topic,
+        kafka_brokers=kafka_brokers,
+        request_dict=request_dict,
+        producer_config=MOCK_CONFIG,
+        # time the producer alone, the policy would drop most reruns
+        apply_policy=False,
+    )
+
+
+def run(produce, reruns: int, drain=None) -> dict:
+    """Simulate ``reruns`` full_app reruns and time each of them.
+
+    Parameters
+    ----------
+    produce : callable
+        A function with the ``kafka_producer`` call signature.
+    reruns : int
+        The number of reruns to simulate.
+    drain : callable
+        Called before the clock stops, to wait for queued deliveries.
+
+    Returns
+    -------
+    dict
+        Messages per second and rerun latency percentiles in milliseconds.
+    """
+    latencies = []
+    messages = 0
+    start = time.perf_counter()
+    for _ in range(reruns):
+        rerun_start = time.perf_counter()
+        for key, value in SIDEBAR_FIELDS.items():
+            produce(
+                request_dict={
+                    "timestamp": datetime.datetime.now().isoformat(),
+                    "message_type": "basic-example",
+                    key: value,
+                }
+            )
+            messages += 1
+        latencies.append(time.perf_counter() - rerun_start)
+    if drain is not None:
+        drain()
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "messages/sec": messages / elapsed,
+        "p50 rerun ms": np.percentile(latencies_ms, 50),
+        "p99 rerun ms": np.percentile(latencies_ms, 99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the per-call and the pooled kafka producer"
+    )
+    parser.add_argument("--reruns", type=int, default=50)
+    args = parser.parse_args()
+
+    logging.getLogger("kafka_utilities").setLevel(logging.WARNING)
+
+    results = {
+        "before (producer per call)": run(legacy_kafka_producer, args.reruns),
+        "after (pooled producer)": run(
+            pooled_kafka_producer, args.reruns, drain=kafka_utilities.close_emitters
+        ),
+    }
+    kafka_utilities.close_producers()
+
+    for name, stats in results.items():
+        print(name)
+        for stat, value in stats.items():
+            print(f"  {stat:>14}: {value:,.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import random
+import time
+import zlib
+
+from serializers import SERIALIZERS, get_serializer
+from synthetic_events import MESSAGE_TYPES, session_events
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def compressors() -> dict:
+    """Return the batch compressors that are installed."""
+    available = {"zlib": zlib.compress}
+    if lz4 is not None:
+        available["lz4"] = lz4.frame.compress
+    if zstandard is not None:
+        available["zstd"] = zstandard.ZstdCompressor().compress
+    return available
+
+
+def measure(serializer, events: list) -> dict:
+    """Time encoding and decoding ``events`` and measure their size.
+
+    Returns
+    -------
+    dict
+        Mean encode and decode cost in microseconds, mean bytes per event and
+        bytes per event once the whole batch is compressed.
+    """
+    start = time.perf_counter()
+    encoded = [serializer.dumps(event) for event in events]
+    encode_us = (time.perf_counter() - start) / len(events) * 1e6
+    start = time.perf_counter()
+    for value in encoded:
+        serializer.loads(value)
+    decode_us = (time.perf_counter() - start) / len(events) * 1e6
+    # librdkafka compresses a message set as a whole, approximate it by
+    # compressing the concatenated batch
+    batch = b"".join(encoded)
+    result = {
+        "encode us": encode_us,
+        "decode us": decode_us,
+        "bytes": len(batch) / len(events),
+    }
+    for name, compress in compressors().items():
+        result[f"{name} bytes"] = len(compress(batch)) / len(events)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare encode/decode cost and bytes on wire per event type"
+    )
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for message_type in MESSAGE_TYPES:
+        events = session_events(message_type, args.events, random.Random(args.seed))
+        print(message_type)
+        for name in SERIALIZERS:
+            try:
+                serializer = get_serializer(name)
+            except ImportError as e:
+                print(f"  {name:>8}: skipped, {e}")
+                continue
+            stats = measure(serializer, events)
+            print(
+                f"  {name:>8}: "
+                + ", ".join(f"{stat} {value:,.1f}" for stat, value in stats.items())
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import datetime
+import hashlib
+import json
+import uuid
+
+import streamlit as st
+
+from kafka_utilities import kafka_producer
+
+
+def fingerprint(obj: dict) -> str:
+    """Return a short hash identifying the content of a Fabric.js object."""
+    encoded = json.dumps(obj, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(encoded.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class CanvasDiffer:
+    """Turn the canvas object list of each rerun into add/modify/delete deltas.
+
+    Objects get an id the first time they are seen and keep it while they
+    stay on the canvas. Unchanged objects are matched by fingerprint, the
+    remaining ones by their order on the canvas, which is how a moved or
+    resized object shows up. The state lives in ``st.session_state``.
+
+    Parameters
+    ----------
+    canvas_key : str
+        The key of the ``st_canvas`` component.
+    state : MutableMapping
+        Where the state is kept, defaults to ``st.session_state``.
+    """
+
+    def __init__(self, canvas_key: str, state=None):
+        self.state_key = f"canvas_diff_{canvas_key}"
+        self.state = st.session_state if state is None else state
+        if self.state_key not in self.state:
+            self.state[self.state_key] = {
+                "canvas_session": uuid.uuid4().hex,
+                "revision": 0,
+                "next_id": 0,
+                # (object id, fingerprint) in canvas order
+                "objects": [],
+            }
+
+    def diff(self, objects: list) -> dict:
+        """Return the delta since the previous call, or None when nothing changed.
+
+        Returns
+        -------
+        dict
+            ``canvas_session``, ``revision``, ``added`` and ``modified`` (lists
+            of ``{"id", "object"}``), ``deleted`` (a list of ids) and
+            ``order`` (the ids of every object in canvas order).
+        """
+        state = self.state[self.state_key]
+        previous_ids = [object_id for object_id, _ in state["objects"]]
+        fingerprints = [fingerprint(obj) for obj in objects]
+
+        unmatched_old = {}
+        for object_id, old_fingerprint in state["objects"]:
+            unmatched_old.setdefault(old_fingerprint, []).append(object_id)
+        ids = [None] * len(objects)
+        for index, new_fingerprint in enumerate(fingerprints):
+            if unmatched_old.get(new_fingerprint):
+                ids[index] = unmatched_old[new_fingerprint].pop(0)
+        remaining = {object_id for ids_ in unmatched_old.values() for object_id in ids_}
+        leftover = [
+            object_id for object_id, _ in state["objects"] if object_id in remaining
+        ]
+
+        added, modified = [], []
+        for index, obj in enumerate(objects):
+            if ids[index] is not None:
+                continue
+            if leftover:
+                ids[index] = leftover.pop(0)
+                modified.append({"id": ids[index], "object": obj})
+            else:
+                ids[index] = state["next_id"]
+                state["next_id"] += 1
+                added.append({"id": ids[index], "object": obj})
+
+        state["objects"] = list(zip(ids, fingerprints))
+        if not (added or modified or leftover) and ids == previous_ids:
+            return None
+        state["revision"] += 1
+        return {
+            "canvas_session": state["canvas_session"],
+            "revision": state["revision"],
+            "added": added,
+            "modified": modified,
+            "deleted": leftover,
+            "order": ids,
+        }
+
+    def emit(self, objects: list, message_type: str, **producer_kwargs) -> dict:
+        """Send the delta of ``objects`` as the body of one event, if any.
+
+        Deltas bypass the event policy, a sampled out delta would break
+        every later reconstruction of the canvas.
+        """
+        delta = self.diff(objects)
+        if delta is None:
+            return None
+        return kafka_producer(
+            request_dict={
+                "timestamp": datetime.datetime.now().isoformat(),
+                "message_type": message_type,
+                "body": delta,
+            },
+            apply_policy=False,
+            **producer_kwargs,
+        )
+
+
+def apply_delta(canvas: dict, delta: dict) -> dict:
+    """Apply a delta to ``{"objects": {id: object}, "order": [ids]}`` and return it."""
+    for object_id in delta["deleted"]:
+        canvas["objects"].pop(object_id, None)
+    for change in delta["added"] + delta["modified"]:
+        canvas["objects"][change["id"]] = change["object"]
+    canvas["order"] = delta["order"]
+    return canvas
+
+
+def compact(deltas: list) -> list:
+    """Rebuild the full canvas object list from the deltas of one canvas session.
+
+    Parameters
+    ----------
+    deltas : list
+        The delta bodies of a single ``canvas_session``, in any order. The
+        events of a canvas' message_type only ever hold deltas, what the apps
+        derive from a canvas is sent under a message_type of its own.
+
+    Returns
+    -------
+    list
+        The Fabric.js objects on the canvas after the last delta.
+    """
+    canvas = {"objects": {}, "order": []}
+    for delta in sorted(deltas, key=lambda delta: delta["revision"]):
+        apply_delta(canvas, delta)
+    return [canvas["objects"][object_id] for object_id in canvas["order"]]
@@ -0,0 +1,93 @@
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubChatHandler(BaseHTTPRequestHandler):
+    """Answer ``/v1/chat/completions`` like an OpenAI compatible server.
+
+    The answer repeats the last message word by word, streamed as
+    server-sent events when the request asks for ``stream``.
+    """
+
+    # keep-alive and chunked responses, as real servers do
+    protocol_version = "HTTP/1.1"
+    token_delay = 0.05
+    first_token_delay = 0.5
+    max_tokens = 200
+
+    def do_POST(self):
+        if self.path != "/v1/chat/completions":
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        words = request["messages"][-1]["content"].split()[: self.max_tokens]
+        tokens = ["You asked:"] + [f" {word}" for word in words]
+        time.sleep(self.first_token_delay)
+        if not request.get("stream"):
+            body = json.dumps(
+                {
+                    "choices": [
+                        {"message": {"role": "assistant", "content": "".join(tokens)}}
+                    ]
+                },
+                ensure_ascii=False,
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for token in tokens:
+                event = {"choices": [{"delta": {"content": token}}]}
+                self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+                time.sleep(self.token_delay)
+            self._write_chunk("data: [DONE]\n\n")
+            self._write_chunk("")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client cancelled
+            self.close_connection = True
+
+    def _write_chunk(self, text: str) -> None:
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main() -> None:
+    """
+    serve a stand-in for the local model, to try the dashboard's chat
+    without one or to test the chat client
+    """
+    parser = argparse.ArgumentParser(
+        description="A stub OpenAI compatible chat completions server"
+    )
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1234)
+    parser.add_argument(
+        "--token-delay", type=float, default=0.05, help="seconds between tokens"
+    )
+    parser.add_argument(
+        "--first-token-delay",
+        type=float,
+        default=0.5,
+        help="seconds before the first token",
+    )
+    args = parser.parse_args()
+
+    StubChatHandler.token_delay = args.token_delay
+    StubChatHandler.first_token_delay = args.first_token_delay
+    server = ThreadingHTTPServer((args.host, args.port), StubChatHandler)
+    print(f"Serving http://{args.host}:{args.port}/v1/chat/completions")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""A streaming client for OpenAI compatible chat completion servers.
+
+The dashboard asks a local model (LM Studio by default) about the data. The
+answer is streamed as server-sent events and rendered token by token.
+Requests reuse pooled keep-alive connections, can be cancelled, and are
+limited in number per process, so a crowd of users cannot pile requests onto
+a model that answers one at a time.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+
+class ChatError(Exception):
+    """The chat server could not be reached or answered with an error."""
+
+
+class ChatBusyError(ChatError):
+    """Every request slot stayed taken for the whole queue timeout."""
+
+
+def chat_config_from_env() -> dict:
+    """Read the chat server settings from the environment."""
+    return {
+        "url": os.getenv("CHAT_URL", "http://localhost:1234/v1/chat/completions"),
+        "model": os.getenv("CHAT_MODEL", ""),
+        "connect_timeout": float(os.getenv("CHAT_CONNECT_TIMEOUT", "5")),
+        "read_timeout": float(os.getenv("CHAT_READ_TIMEOUT", "60")),
+        "total_timeout": float(os.getenv("CHAT_TOTAL_TIMEOUT", "600")),
+        "max_concurrency": int(os.getenv("CHAT_MAX_CONCURRENCY", "2")),
+        "queue_timeout": float(os.getenv("CHAT_QUEUE_TIMEOUT", "30")),
+    }
+
+
+def parse_event_lines(lines):
+    """Yield the decoded ``data`` payloads of server-sent event lines.
+
+    Stops at the ``[DONE]`` sentinel. Comments, other fields and keep-alive
+    blank lines are skipped.
+    """
+    for line in lines:
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:") :].strip()
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+
+
+class ChatStream:
+    """One streamed chat completion, iterate it for the text as it arrives.
+
+    Parameters
+    ----------
+    response : requests.Response
+        The open streaming response.
+    release : callable
+        Called once when the stream ends, however it ends.
+    total_timeout : float
+        Seconds the whole completion may take.
+    on_complete : callable
+        Called with the full text once the server finished the completion,
+        not when it was cancelled or failed.
+    """
+
+    def __init__(
+        self,
+        response: requests.Response,
+        release,
+        total_timeout: float = None,
+        on_complete=None,
+    ):
+        self.response = response
+        self.text = ""
+        self.completed = False
+        self.cancelled = False
+        self._release = release
+        self._released = False
+        self._lock = threading.Lock()
+        self._deadline = (
+            time.monotonic() + total_timeout if total_timeout is not None else None
+        )
+        self._on_complete = on_complete
+
+    def __iter__(self):
+        try:
+            if "text/event-stream" not in self.response.headers.get("Content-Type", ""):
+                # the server ignored "stream", the whole answer comes at once
+                yield self._append(self._content(self.response.json(), "message"))
+            else:
+                # server-sent events are always UTF-8, whatever the headers say
+                self.response.encoding = "utf-8"
+                lines = self.response.iter_lines(chunk_size=None, decode_unicode=True)
+                for event in parse_event_lines(lines):
+                    if self.cancelled:
+                        return
+                    if self._deadline is not None and time.monotonic() > (
+                        self._deadline
+                    ):
+                        raise ChatError("The model took too long to answer")
+                    delta = self._content(event, "delta")
+                    if delta:
+                        yield self._append(delta)
+            if not self.cancelled:
+                self.completed = True
+                if self._on_complete is not None:
+                    self._on_complete(self.text)
+        except ChatError:
+            raise
+        except Exception as e:
+            # reading from a cancelled, closed connection fails in all sorts of ways
+            if self.cancelled:
+                return
+            if isinstance(e, requests.RequestException):
+                raise ChatError(f"The chat request failed: {e}") from e
+            if isinstance(e, ValueError):
+                raise ChatError(f"Unable to parse the chat response: {e}") from e
+            raise
+        finally:
+            self.close()
+
+    @staticmethod
+    def _content(payload: dict, field: str) -> str:
+        choices = payload.get("choices") or [{}]
+        return (choices[0].get(field) or {}).get("content") or ""
+
+    def _append(self, text: str) -> str:
+        self.text += text
+        return text
+
+    def cancel(self) -> None:
+        """Stop the stream, the connection is closed and the slot freed."""
+        self.cancelled = True
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self.response.close()
+        self._release()
+
+
+class ChatClient:
+    """A pooled, concurrency limited client for a chat completions endpoint.
+
+    Parameters
+    ----------
+    url : str
+        The ``/v1/chat/completions`` endpoint.
+    model : str
+        The model to ask, empty for the server's loaded model.
+    connect_timeout : float
+        Seconds to wait for a connection.
+    read_timeout : float
+        Seconds to wait for the first and every following token.
+    total_timeout : float
+        Seconds a whole completion may take.
+    max_concurrency : int
+        Requests in flight at once, further ones wait for a free slot. It
+        is also the size of the connection pool.
+    queue_timeout : float
+        Seconds to wait for a free slot before ``ChatBusyError``.
+    """
+
+    def __init__(
+        self,
+        url: str = "http://localhost:1234/v1/chat/completions",
+        model: str = "",
+        connect_timeout: float = 5.0,
+        read_timeout: float = 60.0,
+        total_timeout: float = 600.0,
+        max_concurrency: int = 2,
+        queue_timeout: float = 30.0,
+    ):
+        self.url = url
+        self.model = model
+        self.timeout = (connect_timeout, read_timeout)
+        self.total_timeout = total_timeout
+        self.queue_timeout = queue_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    @classmethod
+    def from_env(cls, **overrides) -> "ChatClient":
+        """Create a client configured by ``chat_config_from_env``."""
+        return cls(**{**chat_config_from_env(), **overrides})
+
+    def stream(self, messages: list, on_complete=None, **params) -> ChatStream:
+        """Start a streamed completion of ``messages``.
+
+        Parameters
+        ----------
+        messages : list
+            The chat messages, ``{"role": ..., "content": ...}`` dicts.
+        on_complete : callable
+            Called with the full text once the completion finished.
+        **params
+            Further request fields, e.g. ``temperature``.
+
+        Returns
+        -------
+        ChatStream
+            Iterate it for the text as it arrives.
+
+        Raises
+        ------
+        ChatBusyError
+            When no slot frees up within the queue timeout.
+        ChatError
+            When the server cannot be reached or answers with an error.
+        """
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise ChatBusyError(
+                "The model is busy answering other questions, try again later"
+            )
+        try:
+            response = self.session.post(
+                self.url,
+                json={
+                    "messages": messages,
+                    "model": self.model,
+                    "stream": True,
+                    **params,
+                },
+                stream=True,
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            self._slots.release()
+            raise ChatError(f"The chat request failed: {e}") from e
+        if response.status_code != 200:
+            self._slots.release()
+            text = response.text
+            response.close()
+            raise ChatError(f"The chat server answered {response.status_code}: {text}")
+        return ChatStream(
+            response, self._slots.release, self.total_timeout, on_complete
+        )
+
+    def complete(self, messages: list, **params) -> str:
+        """Return the whole completion of ``messages``, see ``stream``."""
+        stream = self.stream(messages, **params)
+        for _ in stream:
+            pass
+        return stream.text
+
+    def close(self) -> None:
+        self.session.close()
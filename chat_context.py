@@ -0,0 +1,230 @@
+"""Compact, token-budgeted summaries of the dashboard data for LLM prompts.
+
+Instead of every row, the model gets the frame's shape, counts per
+``message_type`` and ``variable``, an event histogram, the top values per
+variable and a sample stratified by variable, in that order of priority,
+until the token budget is spent.
+"""
+
+import hashlib
+import json
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# rough, model independent: English text and CSV average ~4 characters a token
+CHARS_PER_TOKEN = 4
+# candidate histogram intervals, the first giving at most HISTOGRAM_BUCKETS wins
+HISTOGRAM_INTERVALS = ("1min", "5min", "15min", "1h", "6h", "1D", "7D", "30D")
+HISTOGRAM_BUCKETS = 24
+
+
+def estimate_tokens(text: str) -> int:
+    """Return an estimate of the number of tokens ``text`` takes."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _shorten(value, max_chars: int = 40) -> str:
+    text = str(value)
+    return text if len(text) <= max_chars else text[: max_chars - 3] + "..."
+
+
+def _table(frame: pd.DataFrame) -> list:
+    """Render a small frame as CSV lines, header first."""
+    return frame.to_csv(index=False).strip().splitlines()
+
+
+def overview_section(frame: pd.DataFrame) -> list:
+    lines = [f"rows: {len(frame):,}"]
+    if "doc_id" in frame:
+        lines.append(f"events: {frame['doc_id'].nunique():,}")
+    if "timestamp" in frame and len(frame):
+        timestamps = pd.to_datetime(frame["timestamp"], errors="coerce")
+        lines.append(f"from: {timestamps.min()}")
+        lines.append(f"to: {timestamps.max()}")
+    lines.append(
+        "columns: "
+        + ", ".join(f"{column} ({dtype})" for column, dtype in frame.dtypes.items())
+    )
+    return lines
+
+
+def message_type_section(frame: pd.DataFrame) -> list:
+    events = frame.drop_duplicates("doc_id") if "doc_id" in frame else frame
+    counts = events["message_type"].value_counts().rename_axis("message_type")
+    return _table(counts.reset_index(name="events"))
+
+
+def variable_section(frame: pd.DataFrame) -> list:
+    counts = frame.dropna(subset=["value"])["variable"].value_counts()
+    return _table(counts.rename_axis("variable").reset_index(name="count"))
+
+
+def histogram_section(frame: pd.DataFrame) -> list:
+    events = frame.drop_duplicates("doc_id") if "doc_id" in frame else frame
+    timestamps = pd.to_datetime(events["timestamp"], errors="coerce").dropna()
+    if timestamps.empty:
+        return []
+    span = timestamps.max() - timestamps.min()
+    for interval in HISTOGRAM_INTERVALS:
+        if span / pd.Timedelta(interval) < HISTOGRAM_BUCKETS:
+            break
+    counts = timestamps.dt.floor(interval).value_counts().sort_index()
+    return [f"interval: {interval}"] + _table(
+        counts.rename_axis("bucket").reset_index(name="events")
+    )
+
+
+def top_values_section(frame: pd.DataFrame, size: int = 5) -> list:
+    lines = []
+    values = frame.dropna(subset=["value"])
+    for variable, group in values.groupby("variable", sort=True):
+        counts = group["value"].astype(str).value_counts().head(size)
+        lines.append(
+            f"{variable}: "
+            + ", ".join(
+                f"{_shorten(value)} ({count})" for value, count in counts.items()
+            )
+        )
+    return lines
+
+
+def sample_section(frame: pd.DataFrame, seed: int = 0, per_variable: int = 100) -> list:
+    """Return sample rows, round robin over the variables, so rare ones show up."""
+    if frame.empty:
+        return []
+    rows = frame.dropna(subset=["value"]) if "value" in frame else frame
+    if "variable" in rows:
+        # at most per_variable rows of every variable, interleaved so the
+        # n-th row of every variable comes before the n+1-th of any
+        order = np.random.default_rng(seed).permutation(len(rows))
+        shuffled = rows.iloc[order].groupby("variable").head(per_variable)
+        rank = shuffled.groupby("variable").cumcount()
+        rows = shuffled.iloc[rank.argsort(kind="stable")]
+    else:
+        rows = rows.sample(min(len(rows), per_variable), random_state=seed)
+    rows = rows.apply(lambda column: column.map(_shorten))
+    return _table(rows)
+
+
+def build_context(frame: pd.DataFrame, token_budget: int = 3000, seed: int = 0) -> str:
+    """Summarize a (melted) dashboard frame within a token budget.
+
+    Sections are added in order of priority and line by line, the last one
+    that does not fit is cut off and the rest are left out. Sections whose
+    columns the frame lacks are skipped.
+
+    Parameters
+    ----------
+    frame : pd.DataFrame
+        The frame ``get_data`` returns, with ``doc_id``, ``timestamp``,
+        ``message_type``, ``variable`` and ``value`` columns.
+    token_budget : int
+        The most tokens the summary may take, see ``estimate_tokens``.
+    seed : int
+        Seeds the sample, the same frame always gives the same summary.
+
+    Returns
+    -------
+    str
+        The summary, sections separated by blank lines.
+    """
+    sections = [
+        ("Overview", overview_section, ()),
+        ("Events per message_type", message_type_section, ("message_type",)),
+        ("Values per variable", variable_section, ("variable", "value")),
+        ("Events over time", histogram_section, ("timestamp",)),
+        (
+            "Most frequent values per variable",
+            top_values_section,
+            ("variable", "value"),
+        ),
+        ("Sample rows", lambda f: sample_section(f, seed), ()),
+    ]
+    lines = []
+    used = 0
+    for title, section, required in sections:
+        if any(column not in frame for column in required):
+            continue
+        section_lines = section(frame)
+        if not section_lines:
+            continue
+        header = f"## {title}"
+        # a section starts with its header and first line or not at all
+        if used + estimate_tokens(header) + estimate_tokens(section_lines[0]) + 3 > (
+            token_budget
+        ):
+            break
+        if lines:
+            lines.append("")
+        lines.append(header)
+        used += estimate_tokens(header) + 2
+        for line in section_lines:
+            cost = estimate_tokens(line) + 1
+            if used + cost > token_budget:
+                lines.append("...")
+                return "\n".join(lines)
+            lines.append(line)
+            used += cost
+    return "\n".join(lines)
+
+
+def prompt_key(messages: list, model: str = "") -> str:
+    """Return a key identifying a chat request.
+
+    The messages hold the data summary and the question, so the key changes
+    with both, while a reloaded or otherwise identical frame maps onto the
+    same key.
+    """
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+class ResponseCache:
+    """Chat responses on disk, one JSON file per request key.
+
+    Shared by every session and process on the host and kept across
+    restarts.
+
+    Parameters
+    ----------
+    directory : str
+        Where the responses are stored.
+    ttl : float
+        Seconds a response stays valid, ``None`` for ever.
+    """
+
+    def __init__(self, directory: str = ".chat_cache", ttl: float = None):
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str):
+        """Return the cached response, ``None`` when missing or expired."""
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if self.ttl is not None and time.time() - entry["created_at"] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["response"]
+
+    def put(self, key: str, response: str) -> None:
+        path = self._path(key)
+        # written under a temporary name, concurrent readers never see half a file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump({"created_at": time.time(), "response": response}, f)
+        os.replace(temporary, path)
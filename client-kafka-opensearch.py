@@ -1,9 +1,17 @@
-import os
 from opensearchpy import OpenSearch
+import argparse
 import json
 from confluent_kafka import Consumer
 import logging
 import datetime
+import multiprocessing
+import signal
+import time
+from opensearch_sink import BulkSink, kafka_doc_id
+from serializers import decode_message
+from opensearch_client import get_client
+from opensearch_index import INDEX_ALIAS, ensure_index
+from metrics import export_from_env
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -13,63 +21,28 @@ logger.addHandler(handler)
 
 kafka_brokers = "localhost:29092"
 kafka_topic = "canvas"
-kafka_consumer = Consumer(
-    {
-        # For more info on these settings, see:
-        # https://kafka.apache.org/documentation/#consumerconfigs
-        # use a comma seperated str to add multiple brokers
-        "bootstrap.servers": kafka_brokers,
-        "group.id": "canvas_consumer",
-        "auto.offset.reset": "latest",
-        "socket.keepalive.enable": True,
-    }
-)
-kafka_consumer.subscribe([kafka_topic])
-
-
-def main() -> None:
-    """
-    an example showing how to create an synchronous connection to
-    OpenSearch, create an index, index a document and search to
-    return the document
-    """
-    host = "localhost"
-    port = 9200
-    auth = (
-        "admin",
-        os.getenv("OPENSEARCH_PASSWORD", "admin"),
-    )  # For testing only. Don't store credentials in code.
-
-    client = OpenSearch(
-        hosts=[{"host": host, "port": port}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_show_warn=False,
+index_name = INDEX_ALIAS
+
+
+def create_consumer() -> Consumer:
+    return Consumer(
+        {
+            # For more info on these settings, see:
+            # https://kafka.apache.org/documentation/#consumerconfigs
+            # use a comma seperated str to add multiple brokers
+            "bootstrap.servers": kafka_brokers,
+            "group.id": "canvas_consumer",
+            "auto.offset.reset": "latest",
+            "socket.keepalive.enable": True,
+            # offsets are committed by the sink once a bulk request succeeded
+            "enable.auto.commit": False,
+        }
     )
 
-    info = client.info()
-    print(
-        f"Welcome to {info['version']['distribution']} {info['version']['number']}!"
-    )
 
-    # create an index
-    index_name = "canvas-index"
-    index_body = {
-        "settings": {"index": {"number_of_shards": 4}},
-        "mappings": {
-            "properties": {
-                "timestamp": {"type": "date"},
-                "message_type": {"type": "keyword"},
-                "drawing_mode": {"type": "keyword"},
-            }
-        },
-    }
-    try:
-        response = client.indices.create(index_name, body=index_body)
-        print(response)
-    except Exception as e:
-        print(e)
+def create_index(client: OpenSearch) -> None:
+    # create the index template, rollover policy and write alias
+    ensure_index(client)
 
     # add a document to the index
     document = {
@@ -80,63 +53,136 @@ def main() -> None:
 
     doc_id = "1"
 
-    response = client.index(
-        index=index_name, body=document, id=doc_id, refresh=True
-    )
+    response = client.index(index=index_name, body=document, id=doc_id)
 
     print(response)
 
-    # get latest document id
-    # query = {
-    #     "size": 1,
-    #     "query": {
-    #         "match_all": {},
-    #     },
-    #     "sort": [{"_id": {"order": "desc"}}],
-    # }
-    query = {
-        "size": 1,
-        "query": {
-            "match_all": {},
-        },
-        "sort": [{"timestamp": {"order": "desc"}}],
-    }
-    while True:
-        try:
-            # get latest document id
-            response = client.search(body=query, index=index_name)
-            if len(response["hits"]["hits"]) > 0:
-                doc_id = str(int(response["hits"]["hits"][0]["_id"]) + 1)
-                print(doc_id)
-            else:
-                doc_id = "1"
-        except Exception as e:
-            print(e)
-            doc_id = "1"
-
-        message = kafka_consumer.poll(1.0)
-        print(message)
-        if message is None:
-            continue
-        if message.error():
-            logger.error(f"Consumer error: {message.error()}")
-        logger.info(f"Received message: {message.value().decode('utf-8')}")
-
-        document = eval(message.value().decode("utf-8"))
-        # print(document)
-
-        try:
-            # index document
-            response = client.index(
-                index=index_name, body=document, id=doc_id, refresh=True
-            )
-            print(f"Indexed document: {response}")
-        except Exception as e:
-            print(f"Unable to index document due to error: {e}")
-    # document = {'timestamp': '2024-10-13T14:02:11.666913', 'message_type': 'basic-example', 'body': 'freedraw'}
-    # doc_id = "3"
-    # response = client.index(index=index_name, body=document, id=doc_id, refresh=True)
-    # print(response)
+
+def run_worker(worker_id: int = 0) -> None:
+    """Consume the canvas topic into OpenSearch until SIGTERM or SIGINT.
+
+    On shutdown the buffered documents are flushed and their offsets
+    committed before the consumer leaves the group.
+    """
+    # each worker serves its metrics on METRICS_PORT + worker_id
+    export_from_env(offset=worker_id)
+    client = get_client()
+    kafka_consumer = create_consumer()
+    sink = BulkSink(
+        client=client,
+        consumer=kafka_consumer,
+        index_name=index_name,
+        decode=decode_message,
+        # ids come from topic/partition/offset, so replays are idempotent
+        # and any number of consumers can share the canvas_consumer group
+        doc_id=kafka_doc_id,
+    )
+    kafka_consumer.subscribe(
+        [kafka_topic], on_assign=sink.on_assign, on_revoke=sink.on_revoke
+    )
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: sink.stop())
+    logger.info(f"Worker {worker_id} started")
+    try:
+        sink.run()
+    finally:
+        kafka_consumer.close()
+        logger.info(f"Worker {worker_id} stopped")
+
+
+def supervise(
+    num_workers: int,
+    restart_backoff: float = 1.0,
+    shutdown_timeout: float = 30.0,
+) -> None:
+    """Run ``num_workers`` worker processes in the canvas_consumer group.
+
+    Workers that exit unexpectedly are restarted, waiting longer after every
+    consecutive crash. SIGTERM or SIGINT is forwarded to the workers, which
+    flush and commit before exiting.
+
+    Parameters
+    ----------
+    num_workers : int
+        The number of worker processes, more workers than the topic has
+        partitions leaves the extra ones idle.
+    restart_backoff : float
+        Seconds to wait before restarting a crashed worker, doubled on each
+        consecutive crash of the same worker up to a minute.
+    shutdown_timeout : float
+        Seconds to wait for workers to exit before killing them.
+    """
+    shutting_down = []
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: shutting_down.append(True))
+
+    def start(worker_id: int) -> multiprocessing.Process:
+        process = multiprocessing.Process(
+            target=run_worker, args=(worker_id,), name=f"canvas-worker-{worker_id}"
+        )
+        process.start()
+        return process
+
+    workers = {worker_id: start(worker_id) for worker_id in range(num_workers)}
+    started_at = dict.fromkeys(workers, time.monotonic())
+    crashes = dict.fromkeys(workers, 0)
+    restart_at = {}
+    while not shutting_down:
+        time.sleep(0.5)
+        now = time.monotonic()
+        for worker_id, process in workers.items():
+            if process.is_alive():
+                # a worker that stayed up for a minute is healthy again
+                if now - started_at[worker_id] > 60.0:
+                    crashes[worker_id] = 0
+                continue
+            if shutting_down:
+                break
+            if worker_id not in restart_at:
+                crashes[worker_id] += 1
+                delay = min(restart_backoff * 2 ** (crashes[worker_id] - 1), 60.0)
+                logger.error(
+                    f"Worker {worker_id} exited with code {process.exitcode}, "
+                    f"restarting in {delay:.1f}s"
+                )
+                restart_at[worker_id] = now + delay
+            elif now >= restart_at[worker_id]:
+                del restart_at[worker_id]
+                workers[worker_id] = start(worker_id)
+                started_at[worker_id] = now
+
+    logger.info("Shutting down workers")
+    for process in workers.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + shutdown_timeout
+    for process in workers.values():
+        process.join(max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            logger.error(f"{process.name} did not stop in time, killing it")
+            process.kill()
+            process.join()
+
+
+def main() -> None:
+    """
+    an example showing how to create an synchronous connection to
+    OpenSearch, create an index and index the messages of the canvas topic
+    """
+    parser = argparse.ArgumentParser(description="Index the canvas topic")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of consumer processes, up to the number of partitions",
+    )
+    args = parser.parse_args()
+
+    create_index(get_client())
+
+    # a single worker is supervised too, it exits when OpenSearch keeps
+    # rejecting a batch and is restarted to consume the batch again
+    supervise(args.workers)
 
 
 if __name__ == "__main__":
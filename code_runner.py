@@ -0,0 +1,449 @@
+"""Run the dashboard's user code snippets in a pool of limited worker processes.
+
+Each snippet runs in a worker process with a CPU time and memory limit and a
+wall clock timeout, so a runaway snippet only takes down its worker and
+concurrent users don't wait on each other. The data is written once into
+shared memory, as Arrow IPC where possible, and every worker decodes it once
+per version instead of receiving a pickled copy with every snippet. Results
+are cached by snippet and data fingerprint.
+
+The workers isolate resources, not privileges: a snippet can still do
+whatever the dashboard's user may do, e.g. read files.
+"""
+
+import atexit
+import gc
+import hashlib
+import io
+import logging
+import math
+import multiprocessing
+import os
+import pickle
+import resource
+import signal
+import threading
+import traceback
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+
+class SnippetError(Exception):
+    """The snippet failed, ran out of time or memory, or killed its worker."""
+
+
+class SnippetBusyError(SnippetError):
+    """Every worker stayed busy for the whole queue timeout."""
+
+
+class CPUTimeExceeded(Exception):
+    pass
+
+
+def runner_config_from_env() -> dict:
+    """Read the snippet runner settings from the environment."""
+    return {
+        "max_workers": int(os.getenv("CODE_RUNNER_WORKERS", "2")),
+        "cpu_seconds": float(os.getenv("CODE_RUNNER_CPU_SECONDS", "10")),
+        "memory_mb": int(os.getenv("CODE_RUNNER_MEMORY_MB", "1024")),
+        "timeout": float(os.getenv("CODE_RUNNER_TIMEOUT", "30")),
+        "queue_timeout": float(os.getenv("CODE_RUNNER_QUEUE_TIMEOUT", "30")),
+    }
+
+
+def serialize_frame(frame) -> tuple:
+    """Return ``(format, data)``, the frame as Arrow IPC or, failing that, a pickle.
+
+    Columns Arrow cannot type, such as the melted ``value`` column mixing
+    numbers, strings and objects, fall back to pickle for the whole frame.
+    """
+    if pa is not None:
+        try:
+            table = pa.Table.from_pandas(frame)
+        except (pa.ArrowException, TypeError, ValueError):
+            pass
+        else:
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+            return "arrow", sink.getvalue()
+    return "pickle", pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_frame(shared: dict) -> tuple:
+    """Return ``(segment, frame)``, the frame may use the segment's memory.
+
+    Arrow columns become zero-copy, read-only views of the shared memory,
+    so the segment stays attached as long as the frame is used.
+    """
+    segment = shared_memory.SharedMemory(name=shared["name"])
+    data = segment.buf[: shared["size"]]
+    if shared["format"] == "arrow":
+        frame = pa.ipc.open_stream(pa.py_buffer(data)).read_all().to_pandas()
+    else:
+        frame = pickle.loads(data)
+    return segment, frame
+
+
+# segments a snippet kept a view of, they can't be closed
+_pinned_segments = []
+
+
+def _detach(segment) -> None:
+    # frames hold reference cycles, collect them to release their views
+    gc.collect()
+    try:
+        segment.close()
+    except BufferError:
+        _pinned_segments.append(segment)
+
+
+def _result_of(namespace: dict) -> dict:
+    """Turn what the snippet assigned to ``fig`` or ``output`` into a result."""
+    fig = namespace.get("fig")
+    if fig is not None and hasattr(fig, "to_plotly_json"):
+        return {"kind": "plotly", "value": fig.to_json()}
+    if fig is not None and hasattr(fig, "savefig"):
+        image = io.BytesIO()
+        fig.savefig(image, format="png")
+        return {"kind": "image", "value": image.getvalue()}
+    if "output" in namespace:
+        return {"kind": "value", "value": namespace["output"]}
+    raise SnippetError('Assign the result to "fig" (a plot) or "output"')
+
+
+def _on_cpu_limit(signum, frame):
+    raise CPUTimeExceeded()
+
+
+def _worker_main(connection, cpu_seconds: float, memory_bytes: int) -> None:
+    """Serve snippets sent through ``connection`` until it closes."""
+    try:
+        import matplotlib
+
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        plt = None
+    import numpy as np
+    import pandas as pd
+    import plotly.express as px
+    import plotly.graph_objects as go
+
+    if memory_bytes:
+        # on top of what the worker and its imports already take
+        with open("/proc/self/statm") as f:
+            used = int(f.read().split()[0]) * resource.getpagesize()
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        resource.setrlimit(resource.RLIMIT_AS, (used + memory_bytes, hard))
+    cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    signal.signal(signal.SIGXCPU, _on_cpu_limit)
+    connection.send("ready")
+    frame_key, frame, segment = None, None, None
+    while True:
+        try:
+            code, shared = connection.recv()
+        except EOFError:
+            return
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        # CPU time adds up over the worker's life, the limit moves with it
+        used = math.ceil(usage.ru_utime + usage.ru_stime)
+        resource.setrlimit(
+            resource.RLIMIT_CPU, (used + math.ceil(cpu_seconds), cpu_hard)
+        )
+        try:
+            if shared["key"] != frame_key:
+                frame_key, frame = None, None
+                if segment is not None:
+                    _detach(segment)
+                segment, frame = _load_frame(shared)
+                frame_key = shared["key"]
+            namespace = {
+                # a copy, a snippet modifying df must not affect the next one
+                "df": frame.copy(),
+                "pd": pd,
+                "np": np,
+                "px": px,
+                "go": go,
+                "plt": plt,
+            }
+            exec(code, namespace)
+            result = _result_of(namespace)
+            pickle.dumps(result)
+        except CPUTimeExceeded:
+            result = {"error": f"The code used more than {cpu_seconds:g}s of CPU time"}
+        except MemoryError:
+            result = {"error": "The code ran out of memory"}
+        except SnippetError as e:
+            result = {"error": str(e)}
+        except Exception as e:
+            # from the snippet's frame on, the worker's own is of no interest
+            result = {
+                "error": "".join(
+                    traceback.format_exception(type(e), e, e.__traceback__.tb_next)
+                )
+            }
+        finally:
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_hard, cpu_hard))
+            if plt is not None:
+                plt.close("all")
+        connection.send(result)
+        # Arrow backed columns of the copy still point into the shared memory
+        namespace = result = None
+
+
+class _Worker:
+    startup_timeout = 60.0
+
+    def __init__(self, context, cpu_seconds: float, memory_bytes: int):
+        self.ready = False
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_connection, cpu_seconds, memory_bytes),
+            name="snippet-worker",
+            daemon=True,
+        )
+        self.process.start()
+        child_connection.close()
+
+    def run(self, code: str, shared: dict, timeout: float) -> dict:
+        try:
+            if not self.ready:
+                # the imports of a new worker don't count against the snippet
+                if not self.connection.poll(self.startup_timeout):
+                    self.kill()
+                    raise SnippetError("The worker process did not start")
+                self.connection.recv()
+                self.ready = True
+            self.connection.send((code, shared))
+            if not self.connection.poll(timeout):
+                self.kill()
+                raise SnippetError(f"The code did not finish within {timeout:g}s")
+            return self.connection.recv()
+        except (EOFError, OSError):
+            self.kill()
+            raise SnippetError(
+                "The code crashed its worker process, "
+                f"exit code {self.process.exitcode}"
+            )
+
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class SnippetRunner:
+    """A pool of worker processes running code snippets against a DataFrame.
+
+    Parameters
+    ----------
+    max_workers : int
+        Snippets run at once, further ones wait for a free worker.
+    cpu_seconds : float
+        CPU time a snippet may use.
+    memory_mb : int
+        Memory a worker may allocate beyond its own, including the data.
+    timeout : float
+        Wall clock seconds a snippet may take, the worker is killed and
+        replaced after.
+    queue_timeout : float
+        Seconds to wait for a free worker before ``SnippetBusyError``.
+    cache_entries : int
+        The number of results kept.
+    """
+
+    # shared frames kept, the previous one may still be read by a worker
+    max_frames = 2
+
+    def __init__(
+        self,
+        max_workers: int = 2,
+        cpu_seconds: float = 10.0,
+        memory_mb: int = 1024,
+        timeout: float = 30.0,
+        queue_timeout: float = 30.0,
+        cache_entries: int = 128,
+    ):
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_mb * 1024 * 1024
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.cache_entries = cache_entries
+        self.hits = 0
+        self.misses = 0
+        # spawned, a fork of a threaded server process could deadlock
+        self._context = multiprocessing.get_context("spawn")
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._idle = []
+        self._frames = OrderedDict()
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def share_frame(self, frame, data_key=None) -> dict:
+        """Put ``frame`` into shared memory, once per version of the data.
+
+        Parameters
+        ----------
+        frame : pd.DataFrame
+            The data.
+        data_key : hashable
+            Identifies this version of the data, e.g. its source and refresh
+            count. Without one, the frame is serialized and hashed.
+
+        Returns
+        -------
+        dict
+            What a worker needs to find the frame, its ``key`` is the data
+            fingerprint.
+        """
+        serialized = None
+        if data_key is None:
+            serialized = serialize_frame(frame)
+            key = hashlib.blake2b(serialized[1], digest_size=16).hexdigest()
+        else:
+            key = hashlib.blake2b(repr(data_key).encode(), digest_size=16).hexdigest()
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return self._frames[key][1]
+        file_format, data = serialized or serialize_frame(frame)
+        segment = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        segment.buf[: len(data)] = memoryview(data).cast("B")
+        shared = {
+            "key": key,
+            "name": segment.name,
+            "size": len(data),
+            "format": file_format,
+        }
+        with self._lock:
+            self._frames[key] = (segment, shared)
+            while len(self._frames) > self.max_frames:
+                old_segment, _ = self._frames.popitem(last=False)[1]
+                old_segment.close()
+                old_segment.unlink()
+        return shared
+
+    def _acquire(self) -> _Worker:
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise SnippetBusyError("All workers are busy, try again later")
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive():
+                    return worker
+        try:
+            return _Worker(self._context, self.cpu_seconds, self.memory_bytes)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, worker: _Worker) -> None:
+        if worker.alive():
+            with self._lock:
+                self._idle.append(worker)
+        self._slots.release()
+
+    def run(self, code: str, frame, data_key=None) -> dict:
+        """Run ``code`` with the frame as ``df`` and return what it assigned.
+
+        Parameters
+        ----------
+        code : str
+            The snippet, it assigns its result to ``fig`` or ``output``.
+        frame : pd.DataFrame
+            The data, see ``share_frame``.
+        data_key : hashable
+            Identifies this version of the data, see ``share_frame``.
+
+        Returns
+        -------
+        dict
+            ``kind`` is "plotly" with the figure's JSON as ``value``,
+            "image" with PNG bytes or "value" with the ``output``.
+
+        Raises
+        ------
+        SnippetError
+            When the code fails or exceeds its limits.
+        SnippetBusyError
+            When no worker frees up within the queue timeout.
+        """
+        shared = self.share_frame(frame, data_key)
+        cache_key = (code, shared["key"])
+        with self._lock:
+            if cache_key in self._results:
+                self._results.move_to_end(cache_key)
+                self.hits += 1
+                return self._results[cache_key]
+            self.misses += 1
+        worker = self._acquire()
+        try:
+            result = worker.run(code, shared, self.timeout)
+        finally:
+            self._release(worker)
+        if "error" in result:
+            raise SnippetError(result["error"])
+        with self._lock:
+            self._results[cache_key] = result
+            while len(self._results) > self.cache_entries:
+                self._results.popitem(last=False)
+        return result
+
+    def close(self) -> None:
+        """Stop the idle workers and free the shared frames."""
+        with self._lock:
+            workers, self._idle = self._idle, []
+            frames, self._frames = list(self._frames.values()), OrderedDict()
+        for worker in workers:
+            worker.kill()
+        for segment, _ in frames:
+            segment.close()
+            segment.unlink()
+
+
+_runners = {}
+_runners_lock = threading.Lock()
+
+
+def get_runner(**overrides) -> SnippetRunner:
+    """Return the process-wide runner for this configuration.
+
+    Parameters
+    ----------
+    **overrides
+        Settings that replace the ones from ``runner_config_from_env``.
+    """
+    config = {**runner_config_from_env(), **overrides}
+    key = (os.getpid(), repr(sorted(config.items())))
+    with _runners_lock:
+        runner = _runners.get(key)
+        if runner is None:
+            runner = SnippetRunner(**config)
+            _runners[key] = runner
+    return runner
+
+
+@atexit.register
+def close_runners() -> None:
+    """Stop every runner's workers and free its shared memory."""
+    with _runners_lock:
+        runners = list(_runners.values())
+        _runners.clear()
+    for runner in runners:
+        runner.close()
@@ -1,21 +1,63 @@
+import datetime
+import os
+
 import pandas as pd
 import streamlit as st
-import requests
 import plotly.express as px
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
-import os
-from opensearchpy import OpenSearch
+import plotly.io as pio
+from opensearch_client import get_client
+from opensearch_loader import IncrementalFrame
+import opensearch_aggregations
+from opensearch_index import INDEX_ALIAS
+from event_archive import archive_partitions, load_state, pa, read_archive
+from chat_context import ResponseCache, build_context, prompt_key
+from chat_client import ChatClient, ChatError
+from code_runner import SnippetError, get_runner
+
+ARCHIVE_PATH = os.environ.get("EVENT_ARCHIVE_DIR", "archive")
+CHAT_CACHE_DIR = os.environ.get("CHAT_CACHE_DIR", ".chat_cache")
+
+
+@st.cache_resource
+def get_opensearch_client():
+    """Share one pooled OpenSearch client across reruns and sessions."""
+    return get_client()
+
+
+@st.cache_resource
+def get_incremental_frame(limit: int, include_body: bool) -> IncrementalFrame:
+    """Share one incrementally refreshed frame per limit across sessions."""
+    return IncrementalFrame(
+        get_opensearch_client(),
+        INDEX_ALIAS,
+        max_rows=limit,
+        source_excludes=None if include_body else ["body"],
+    )
+
 
+@st.cache_data(max_entries=4)
+def melt_frame(limit: int, include_body: bool, version: int, _frame: pd.DataFrame):
+    """Melt a frame once per refresh, ``version`` keys the cache."""
+    return _frame.melt(id_vars=["doc_id", "timestamp", "message_type"])
 
-@st.cache_data(show_spinner="Getting Data", ttl=3600)
-def get_data(limit: int = 10):
+
+def get_data(limit: int = 10, include_body: bool = False, max_age: float = None):
     """Get data from OpenSearch and return it as a melted DataFrame.
 
+    The last frame is kept and refreshed by fetching only the documents
+    indexed since, see ``IncrementalFrame``. Documents are streamed page by
+    page from a point in time, so limits beyond the index's max result
+    window work too.
+
     Parameters
     ----------
     limit : int
-        The number of documents to retrieve from OpenSearch.
+        The number of newest documents to keep.
+    include_body : bool
+        Also fetch the ``body`` field, which holds whole canvas object lists.
+    max_age : float
+        Refresh when the frame is older than this many seconds, ``None``
+        only loads it once and 0 always refreshes.
 
     Returns
     -------
@@ -23,98 +65,166 @@ def get_data(limit: int = 10):
         A DataFrame containing the data retrieved from Open
 
     """
-    host = "localhost"
-    port = 9200
-    auth = (
-        "admin",
-        os.getenv("OPENSEARCH_PASSWORD", "admin"),
-    )  # For testing only. Don't store credentials in code.
-
-    client = OpenSearch(
-        hosts=[{"host": host, "port": port}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
+    frame = get_incremental_frame(limit, include_body)
+    if frame.frame is None or (max_age is not None and frame.age() >= max_age):
+        progress_bar = st.progress(0.0, text="Loading documents")
+
+        def progress(loaded: int, total: int) -> None:
+            progress_bar.progress(
+                min(loaded / max(total, 1), 1.0),
+                text=f"Loaded {loaded:,} of {total:,}",
+            )
+
+        frame.refresh(progress=progress)
+        progress_bar.empty()
+    return melt_frame(limit, include_body, frame.version, frame.frame)
+
 
-    info = client.info()
-    print(
-        f"Welcome to {info['version']['distribution']} {info['version']['number']}!"
+@st.cache_data(show_spinner="Reading the archive", ttl=60)
+def get_archive_data(
+    start: datetime.date,
+    end: datetime.date,
+    message_types: tuple,
+    include_body: bool = False,
+):
+    """Read a date range of the local event archive as a melted DataFrame.
+
+    Only the partitions of the chosen dates and message types are opened,
+    see ``event_archive.read_archive``. The frame has the same shape as the
+    one ``get_data`` returns.
+    """
+    table = read_archive(
+        ARCHIVE_PATH,
+        start,
+        end,
+        list(message_types),
+        file_format=load_state(ARCHIVE_PATH).get("format", "arrow"),
+        include_body=include_body,
     )
+    # fields no archived event has would only add empty rows
+    frame = table.to_pandas().drop(columns="date").dropna(axis=1, how="all")
+    return frame.melt(id_vars=["doc_id", "timestamp", "message_type"])
 
-    index_name = "canvas-index"
 
-    # get all documents
-    query = {
-        "size": limit,
-        "query": {
-            "match_all": {},
-        },
-        "sort": [{"timestamp": {"order": "desc"}}],
-    }
+@st.cache_data(show_spinner="Aggregating", ttl=60)
+def get_variable_counts():
+    """Count the documents per variable inside OpenSearch."""
+    return opensearch_aggregations.variable_counts(get_opensearch_client(), INDEX_ALIAS)
+
 
-    response = client.search(body=query, index=index_name)
+@st.cache_data(show_spinner="Aggregating", ttl=60)
+def get_event_histogram(interval: str = "1h"):
+    """Count the events per time bucket and message_type inside OpenSearch."""
+    return opensearch_aggregations.date_histogram(
+        get_opensearch_client(), INDEX_ALIAS, interval=interval
+    )
 
-    print(len(response.get("hits").get("hits")))
 
-    source_df = pd.DataFrame(
-        [x["_source"] for x in response.get("hits").get("hits")]
-    ).assign(
-        **{
-            "doc_id": [x["_id"] for x in response.get("hits").get("hits")],
-        }
+@st.cache_data(show_spinner="Aggregating", ttl=60)
+def get_top_values(field: str, size: int = 10):
+    """Return the most frequent values of a field per message_type."""
+    return opensearch_aggregations.top_values(
+        get_opensearch_client(), INDEX_ALIAS, field, size=size
     )
 
-    return source_df.melt(id_vars=["doc_id", "timestamp", "message_type"])
+
+@st.cache_resource
+def get_chat_client() -> ChatClient:
+    """Share one pooled, concurrency limited chat client across sessions."""
+    return ChatClient.from_env()
+
+
+@st.cache_resource
+def get_code_runner():
+    """Share the pool of snippet worker processes across sessions."""
+    return get_runner()
 
 
-@st.cache_data(show_spinner="Awaiting response from model", ttl=3600)
-def get_chat_response(data: pd.DataFrame, question_for_agent: str):
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """Share the on-disk chat response cache across reruns and sessions."""
+    return ResponseCache(CHAT_CACHE_DIR)
+
+
+def chat_messages(context: str, question_for_agent: str) -> list:
+    """Return the chat messages asking ``question_for_agent`` about ``context``."""
     chat_prompt = f"""
-    Based on the log data below, {question_for_agent}
-    
-    {data.to_dict()}
+    Based on the summary of the log data below, {question_for_agent}
+
+    {context}
     """
     if "code" in question_for_agent:
-        new_body = {
-            "messages": [
-                {
-                    "role": "user",
-                    "content": "Put yourself in the shoes of a data scientist",
-                },
-                {"role": "user", "content": chat_prompt},
-                {
-                    "role": "user",
-                    "content": "What code would you write to answer this question?",
-                },
-                {"role": "user", "content": "Use plotly express for plots"},
-                {"role": "user", "content": "Please explain your reasoning"},
-            ],
-            "model": "",
-        }
-    else:
-        new_body = {
-            "messages": [
-                {
-                    "role": "user",
-                    "content": "Put yourself in the shoes of a business consultant",
-                },
-                {
-                    "role": "user",
-                    "content": chat_prompt,
-                },
-            ],
-            "model": "",
-        }
-
-    response = requests.post(
-        "http://localhost:1234/v1/chat/completions",
-        json=new_body,
-    )
-    if response.status_code != 200:
-        return response.text
-    return response.json().get("choices")[0].get("message").get("content")
+        return [
+            {
+                "role": "user",
+                "content": "Put yourself in the shoes of a data scientist",
+            },
+            {"role": "user", "content": chat_prompt},
+            {
+                "role": "user",
+                "content": "What code would you write to answer this question? "
+                "The data is in a DataFrame called df with the columns "
+                "doc_id, timestamp, message_type, variable and value",
+            },
+            {"role": "user", "content": "Use plotly express for plots"},
+            {"role": "user", "content": "Please explain your reasoning"},
+        ]
+    return [
+        {
+            "role": "user",
+            "content": "Put yourself in the shoes of a business consultant",
+        },
+        {
+            "role": "user",
+            "content": chat_prompt,
+        },
+    ]
+
+
+def get_chat_response(
+    data: pd.DataFrame, question_for_agent: str, token_budget: int = 3000
+):
+    """Ask the model about the data, sending a summary instead of every row.
+
+    Responses are cached on disk by the summary and question, so asking the
+    same about the same data is instant, from any session and after
+    restarts. Otherwise the answer is streamed, and only cached once it is
+    complete. A question still being answered in this session is cancelled.
+
+    Parameters
+    ----------
+    data : pd.DataFrame
+        The melted frame, see ``get_data``.
+    question_for_agent : str
+        The question.
+    token_budget : int
+        The most tokens the data summary may take, see
+        ``chat_context.build_context``.
+
+    Returns
+    -------
+    str or ChatStream
+        The cached answer, or a stream of the answer as it arrives.
+
+    Raises
+    ------
+    ChatError
+        When the model cannot be asked, see ``ChatClient.stream``.
+    """
+    messages = chat_messages(build_context(data, token_budget), question_for_agent)
+    client = get_chat_client()
+    cache = get_response_cache()
+    key = prompt_key(messages, client.model)
+    content = cache.get(key)
+    if content is not None:
+        return content
+
+    previous = st.session_state.get("chat_stream")
+    if previous is not None:
+        previous.cancel()
+    stream = client.stream(messages, on_complete=lambda text: cache.put(key, text))
+    st.session_state["chat_stream"] = stream
+    return stream
 
 
 # configure the page
@@ -127,14 +237,103 @@ st.set_page_config(
 
 st.title("Dashboard")
 st.write("This is a dashboard for the log data")
-chosen_limit = st.selectbox(
-    "Choose the number of documents to retrieve",
-    [10, 20, 50, 100, 1000, 10000],
-)
+include_body = st.checkbox("Include canvas objects (body field)", False)
+# the local archive is only offered once archive-events.py has written one,
+# events without a valid timestamp cannot be picked by date
+archived = archive_partitions(ARCHIVE_PATH) if pa is not None else {}
+archived.pop("unknown", None)
+data_source = "OpenSearch"
+if archived:
+    data_source = st.radio(
+        "Data source", ["OpenSearch", "Local archive"], horizontal=True
+    )
+
+if data_source == "Local archive":
+    archived_dates = [datetime.date.fromisoformat(date) for date in archived]
+    date_range = st.date_input(
+        "Dates",
+        (min(archived_dates), max(archived_dates)),
+        min_value=min(archived_dates),
+        max_value=max(archived_dates),
+    )
+    chosen_message_types = st.multiselect(
+        "Message types", sorted(set(sum(archived.values(), [])))
+    )
+    df = get_archive_data(
+        date_range[0],
+        date_range[-1],
+        tuple(chosen_message_types),
+        include_body,
+    )
+    # the snippet runner fingerprints the frame itself
+    data_key = None
+    st.write(f"Data read from the local archive row count: {df.shape[0]}")
+else:
+    chosen_limit = st.selectbox(
+        "Choose the number of documents to retrieve",
+        [10, 20, 50, 100, 1000, 10000, 100000, 1000000],
+    )
+    # refreshes only fetch the documents indexed since the previous one
+    AUTO_REFRESH_INTERVALS = {"Off": None, "10s": 10, "30s": 30, "1m": 60}
+    refresh_left, refresh_right = st.columns(2)
+    refresh_now = refresh_left.button("Refresh data")
+    auto_refresh = AUTO_REFRESH_INTERVALS[
+        refresh_right.selectbox("Auto refresh", list(AUTO_REFRESH_INTERVALS))
+    ]
 
-df = get_data(limit=chosen_limit)
-st.write(f"Data retrieved from OpenSearch row count: {df.shape[0]}")
-st.dataframe(df, use_container_width=True, height=200)
+    df = get_data(
+        limit=chosen_limit,
+        include_body=include_body,
+        max_age=0 if refresh_now else auto_refresh,
+    )
+    if auto_refresh is not None:
+
+        @st.fragment(run_every=auto_refresh)
+        def schedule_refresh():
+            if get_incremental_frame(chosen_limit, include_body).age() >= auto_refresh:
+                st.rerun()
+
+        schedule_refresh()
+    # identifies this version of df for the snippet runner's cache
+    data_key = (
+        "opensearch",
+        chosen_limit,
+        include_body,
+        get_incremental_frame(chosen_limit, include_body).version,
+    )
+    st.write(f"Data retrieved from OpenSearch row count: {df.shape[0]}")
+# sending millions of rows to the browser would freeze the page
+st.dataframe(df.head(10000), use_container_width=True, height=200)
+
+# the overview panels are aggregated by OpenSearch over the whole index,
+# so they cost the same whatever the number of documents
+st.subheader("Overview of all logged events")
+variable_counts = get_variable_counts()
+overview_left, overview_right = st.columns(2)
+with overview_left:
+    st.plotly_chart(
+        px.bar(variable_counts, x="variable", y="count"), use_container_width=True
+    )
+with overview_right:
+    chosen_interval = st.selectbox("Histogram interval", ["1m", "1h", "1d"], index=1)
+    st.plotly_chart(
+        px.bar(
+            get_event_histogram(chosen_interval),
+            x="timestamp",
+            y="count",
+            color="message_type",
+        ),
+        use_container_width=True,
+    )
+if len(variable_counts) > 0:
+    chosen_variable = st.selectbox(
+        "Top values of", variable_counts["variable"].tolist()
+    )
+    try:
+        st.dataframe(get_top_values(chosen_variable), use_container_width=True)
+    except Exception as e:
+        # object fields such as body have no values to aggregate
+        st.write(f"Unable to get the top values of {chosen_variable}: {e}")
 st.subheader(
     """Enter python code to execute (for plots begin with "fig = " , else begin with "output = ")"""
 )
@@ -157,32 +356,18 @@ st.code(code_to_execute_explanation)
 code_to_execute = st.text_input("Enter your code", "")
 if st.button("Execute"):
     print(code_to_execute)
-    if "fig" in code_to_execute:
-        exec(code_to_execute)
-        st.plotly_chart(fig)
-    elif "plt." in code_to_execute:
-        exec(code_to_execute)
-        st.pyplot(fig)
+    try:
+        with st.spinner("Running"):
+            result = get_code_runner().run(code_to_execute, df, data_key=data_key)
+    except SnippetError as e:
+        st.error(str(e))
     else:
-        exec(code_to_execute)
-        st.write(output)
-
-    # chosen_plot_type = st.selectbox(
-    #     "Choose a type of plot",
-    #     ["Bar", "Line", "Scatter", "Pie"],
-    # )
-
-    # if chosen_plot_type == "Bar":
-    fig = px.bar(
-        df.dropna()
-        .value_counts(subset=["variable"])
-        .to_frame()
-        .reset_index()
-        .rename(columns={0: "count"}),
-        x="variable",
-        y="count",
-    )
-#     st.plotly_chart(fig)
+        if result["kind"] == "plotly":
+            st.plotly_chart(pio.from_json(result["value"]))
+        elif result["kind"] == "image":
+            st.image(result["value"])
+        else:
+            st.write(result["value"])
 st.subheader(
     "Ask a question based on the data (experimental), an LMM will attempt to answer/ generate code for you"
 )
@@ -190,11 +375,24 @@ question_for_agent = st.text_input(
     "",
     "What are the counts per variable?",
 )
+# the model gets a summary of the data, this caps its size
+context_tokens = st.number_input(
+    "Data summary size (tokens)", min_value=200, max_value=32000, value=3000, step=500
+)
 
 if st.button("Ask"):
     print(question_for_agent)
-    result = get_chat_response(
-        data=df,
-        question_for_agent=question_for_agent,
-    )
-    st.code(result)
+    try:
+        with st.spinner("Awaiting response from model"):
+            result = get_chat_response(
+                data=df,
+                question_for_agent=question_for_agent,
+                token_budget=context_tokens,
+            )
+        if isinstance(result, str):
+            st.markdown(result)
+        else:
+            # tokens are rendered as they arrive, asking again cancels
+            st.write_stream(result)
+    except ChatError as e:
+        st.error(str(e))
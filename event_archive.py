@@ -0,0 +1,277 @@
+"""A columnar on-disk archive of canvas events for offline analytics.
+
+Events are written as Arrow IPC (or Parquet) files, hive partitioned by the
+``date`` of their ``timestamp`` and their ``message_type``::
+
+    archive/date=2024-05-01/message_type=basic-example/part-<...>.arrow
+
+Every export appends new part files, so the archive only grows. Reading
+goes through ``pyarrow.dataset``: partitions outside a filter are never
+opened, only the requested columns are read and uncompressed Arrow files
+are memory-mapped instead of copied.
+"""
+
+import datetime
+import json
+import logging
+import os
+import uuid
+
+import pandas as pd
+
+from opensearch_index import mapping_properties
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+FORMATS = ("arrow", "parquet")
+PARTITION_FIELDS = ("date", "message_type")
+STATE_FILE = "_export_state.json"
+
+
+def _require_pyarrow() -> None:
+    if pa is None:
+        raise ImportError(
+            "pyarrow is required for the event archive, pip install pyarrow"
+        )
+
+
+def _arrow_type(field_mapping: dict):
+    field_type = field_mapping.get("type", "object")
+    if field_type == "date":
+        return pa.timestamp("us")
+    if field_type in ("integer", "long"):
+        return pa.int64()
+    if field_type == "float":
+        return pa.float64()
+    if field_type == "boolean":
+        return pa.bool_()
+    if field_type == "keyword":
+        return pa.string()
+    # objects are kept as JSON text
+    return pa.string()
+
+
+def archive_schema(include_body: bool = False):
+    """Return the Arrow schema of the archive files, built from the index mapping.
+
+    ``message_type`` is a partition field and not stored in the files.
+    """
+    _require_pyarrow()
+    fields = [pa.field("doc_id", pa.string())]
+    for name, field_mapping in mapping_properties().items():
+        if name == "message_type" or (name == "body" and not include_body):
+            continue
+        fields.append(pa.field(name, _arrow_type(field_mapping)))
+    return pa.schema(fields)
+
+
+def documents_to_frame(documents: list, schema) -> pd.DataFrame:
+    """Turn ``(doc_id, document)`` pairs into a frame with the archive's columns."""
+    rows = []
+    for doc_id, document in documents:
+        row = {"doc_id": doc_id, "message_type": document.get("message_type")}
+        for field in list(schema)[1:]:
+            value = document.get(field.name)
+            if isinstance(value, (dict, list)):
+                value = json.dumps(value, default=str)
+            elif value is not None and pa.types.is_string(field.type):
+                value = str(value)
+            row[field.name] = value
+        rows.append(row)
+    frame = pd.DataFrame(rows, columns=["message_type", *schema.names])
+    for field in schema:
+        frame[field.name] = _coerce(frame[field.name], field.type)
+    return frame
+
+
+def _coerce(values: pd.Series, arrow_type) -> pd.Series:
+    """Convert a column to its archive type, values that do not fit become null.
+
+    Documents are not validated on their way into the index, one value of
+    the wrong type must not fail a whole export.
+    """
+    if pa.types.is_timestamp(arrow_type):
+        # naive timestamps are kept, ones with an offset are moved to UTC
+        return pd.to_datetime(
+            values, format="ISO8601", errors="coerce", utc=True
+        ).dt.tz_localize(None)
+    if pa.types.is_boolean(arrow_type):
+        return values.map(lambda value: value if isinstance(value, bool) else None)
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type):
+        numbers = pd.to_numeric(
+            values.map(lambda value: None if isinstance(value, bool) else value),
+            errors="coerce",
+        )
+        if pa.types.is_integer(arrow_type):
+            numbers = numbers.where(numbers == numbers.round()).astype("Int64")
+        return numbers
+    return values
+
+
+def write_documents(
+    path: str, documents: list, file_format: str = "arrow", include_body: bool = False
+) -> int:
+    """Append documents to the archive as new part files, one per partition.
+
+    Parameters
+    ----------
+    path : str
+        The archive directory.
+    documents : list
+        ``(doc_id, document)`` pairs, as the bulk sink buffers them.
+    file_format : str
+        "arrow" for uncompressed, memory-mappable Arrow IPC files or
+        "parquet" for smaller, zstd compressed files.
+    include_body : bool
+        Also store the ``body`` field as JSON text.
+
+    Returns
+    -------
+    int
+        The number of documents written.
+    """
+    _require_pyarrow()
+    if file_format not in FORMATS:
+        raise ValueError(f"file_format must be one of {FORMATS}, got {file_format!r}")
+    if not documents:
+        return 0
+    schema = archive_schema(include_body)
+    frame = documents_to_frame(documents, schema)
+    dates = frame["timestamp"].dt.strftime("%Y-%m-%d").fillna("unknown")
+    part = f"part-{datetime.datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    for (date, message_type), group in frame.groupby(
+        [dates, frame["message_type"].fillna("unknown")]
+    ):
+        directory = os.path.join(path, f"date={date}", f"message_type={message_type}")
+        os.makedirs(directory, exist_ok=True)
+        table = pa.Table.from_pandas(
+            group[schema.names], schema=schema, preserve_index=False
+        )
+        file_path = os.path.join(directory, f"{part}.{file_format}")
+        # written under a temporary name, readers never see half a file
+        if file_format == "arrow":
+            with pa.OSFile(file_path + ".tmp", "wb") as sink:
+                with pa.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(table)
+        else:
+            pq.write_table(table, file_path + ".tmp", compression="zstd")
+        os.replace(file_path + ".tmp", file_path)
+    return len(frame)
+
+
+def load_state(path: str) -> dict:
+    """Return where the previous export stopped, empty before the first one."""
+    try:
+        with open(os.path.join(path, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path: str, state: dict) -> None:
+    os.makedirs(path, exist_ok=True)
+    state_path = os.path.join(path, STATE_FILE)
+    with open(state_path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def open_archive(path: str, file_format: str = "arrow", include_body: bool = False):
+    """Open the archive as a ``pyarrow.dataset.Dataset``.
+
+    The files are read through a memory-mapping filesystem, so uncompressed
+    Arrow files are used in place without being copied into memory.
+    """
+    _require_pyarrow()
+    partitioning = ds.partitioning(
+        pa.schema([("date", pa.string()), ("message_type", pa.string())]),
+        flavor="hive",
+    )
+    schema = archive_schema(include_body)
+    for name in PARTITION_FIELDS:
+        schema = schema.append(pa.field(name, pa.string()))
+    return ds.dataset(
+        path,
+        schema=schema,
+        format="ipc" if file_format == "arrow" else "parquet",
+        partitioning=partitioning,
+        filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True),
+        exclude_invalid_files=False,
+        ignore_prefixes=[".", "_"],
+    )
+
+
+def read_archive(
+    path: str,
+    start: datetime.date = None,
+    end: datetime.date = None,
+    message_types: list = None,
+    columns: list = None,
+    file_format: str = "arrow",
+    include_body: bool = False,
+):
+    """Read a time range of the archive into an Arrow table.
+
+    The date range and message types prune whole partitions, ``columns``
+    limits what is read from the remaining files.
+
+    Parameters
+    ----------
+    path : str
+        The archive directory.
+    start, end : datetime.date
+        The first and last date to read, inclusive.
+    message_types : list
+        Only read these message types.
+    columns : list
+        Only read these columns, defaults to all.
+    file_format : str
+        The format the archive was written in, see ``write_documents``.
+    include_body : bool
+        Read the ``body`` column too.
+
+    Returns
+    -------
+    pyarrow.Table
+        The matching events.
+    """
+    dataset = open_archive(path, file_format, include_body)
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field("date") >= start.isoformat())
+    if end is not None:
+        conditions.append(ds.field("date") <= end.isoformat())
+    if message_types:
+        conditions.append(ds.field("message_type").isin(list(message_types)))
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
+
+
+def archive_partitions(path: str) -> dict:
+    """Return the message types found in the archive per date, without reading files."""
+    partitions = {}
+    if not os.path.isdir(path):
+        return partitions
+    for date_dir in sorted(os.listdir(path)):
+        if not date_dir.startswith("date="):
+            continue
+        partitions[date_dir[len("date=") :]] = sorted(
+            name[len("message_type=") :]
+            for name in os.listdir(os.path.join(path, date_dir))
+            if name.startswith("message_type=")
+        )
+    return partitions
@@ -0,0 +1,134 @@
+import datetime
+import time
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from event_policy import ENVELOPE_FIELDS, get_policy
+from kafka_utilities import kafka_producer
+
+
+def _snapshot_value(value):
+    """Return a value that can be compared across reruns.
+
+    Uploaded files are new objects on every rerun, so they are compared by
+    their file id instead of identity.
+    """
+    return getattr(value, "file_id", value)
+
+
+class RerunEventCollector:
+    """Collect the widget values of one streamlit rerun into a single event.
+
+    Values are added with ``add`` while the page renders and ``flush`` sends
+    one record holding only the fields that changed since the last value
+    sent, the snapshot of the sent values lives in ``st.session_state``.
+    Fields the event policy held back stay out of the snapshot and are sent
+    again on a later rerun, one is scheduled for when they may go out, so
+    the last value of a slider drag or a rate limited change is not lost.
+
+    Parameters
+    ----------
+    message_type : str
+        The message_type of the batched record.
+    state_key : str
+        The session state key the snapshot is kept under, defaults to
+        ``"event_snapshot_<message_type>"``.
+    state : MutableMapping
+        Where the snapshot is kept, defaults to ``st.session_state``.
+    """
+
+    def __init__(self, message_type: str, state_key: str = None, state=None):
+        self.message_type = message_type
+        self.state_key = state_key or f"event_snapshot_{message_type}"
+        self.state = st.session_state if state is None else state
+        self.fields = {}
+
+    def add(self, key: str, value):
+        """Record a value for this rerun and return it unchanged."""
+        self.fields[key] = value
+        return value
+
+    @property
+    def _unsent_key(self) -> str:
+        return f"{self.state_key}_unsent"
+
+    def changed_fields(self) -> dict:
+        """Return the fields that differ from the last values sent.
+
+        Fields held back before are included even when they are back at the
+        sent value, the policy may still hold the value in between.
+        """
+        snapshot = self.state.get(self.state_key, {})
+        unsent = self.state.get(self._unsent_key, {})
+        return {
+            key: value
+            for key, value in self.fields.items()
+            if key in unsent
+            or key not in snapshot
+            or snapshot[key] != _snapshot_value(value)
+        }
+
+    def flush(self, **producer_kwargs) -> dict:
+        """Send the changed fields as one record and update the snapshot.
+
+        Only the fields the event policy let through are recorded as sent.
+        When some were held back, a rerun is scheduled for when they may
+        go out.
+
+        Parameters
+        ----------
+        **producer_kwargs
+            Passed on to ``kafka_producer``.
+
+        Returns
+        -------
+        dict
+            The record that was sent, or None when nothing was.
+        """
+        changed = self.changed_fields()
+        values = {key: _snapshot_value(value) for key, value in changed.items()}
+        self.fields = {}
+        if not changed:
+            return None
+        request_dict, suppressed = get_policy().apply(
+            {
+                "timestamp": datetime.datetime.now().isoformat(),
+                "message_type": self.message_type,
+                **changed,
+            }
+        )
+        sent = set(request_dict or {}) - set(ENVELOPE_FIELDS)
+        now = time.monotonic()
+        unsent = {
+            key: now + delay for key, delay in suppressed.items() if key not in sent
+        }
+        # fields neither sent nor held back were sampled out, retrying cannot
+        # send them, they count as sent
+        snapshot = dict(self.state.get(self.state_key, {}))
+        snapshot.update(
+            {key: value for key, value in values.items() if key not in unsent}
+        )
+        self.state[self.state_key] = snapshot
+        self.state[self._unsent_key] = unsent
+        if unsent:
+            self._schedule_retry(min(unsent.values()) - now)
+        if request_dict is None:
+            return None
+        return kafka_producer(
+            request_dict=request_dict, apply_policy=False, **producer_kwargs
+        )
+
+    def _schedule_retry(self, delay: float) -> None:
+        """Rerun the page once ``delay`` seconds passed."""
+        if get_script_run_ctx(suppress_warning=True) is None:
+            return
+        retry_at = time.monotonic() + delay
+
+        # run_every needs at least a short interval, a few ticks are cheap
+        @st.fragment(run_every=max(delay, 0.1))
+        def retry_held_back_fields():
+            if time.monotonic() >= retry_at:
+                st.rerun()
+
+        retry_held_back_fields()
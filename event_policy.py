@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+POLICY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "configs", "event_policy.json"
+)
+
+# fields every event keeps, whatever the debounce windows say
+ENVELOPE_FIELDS = ("timestamp", "message_type", "sample_rate", "rate_limited")
+
+
+def current_session_id() -> str:
+    """Return the id of the streamlit session running this thread."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx is not None else "default"
+
+
+def sample_fraction(session_id: str, message_type: str) -> float:
+    """Map a session and message type onto a stable number in [0, 1)."""
+    digest = hashlib.blake2b(
+        f"{session_id}/{message_type}".encode("utf-8"), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+class TokenBucket:
+    """Allow ``rate`` events per second on average and bursts of ``burst``."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: float = None) -> bool:
+        """Take a token, False when the bucket is empty."""
+        now = time.monotonic() if now is None else now
+        # ``now`` may be taken just before the bucket was created
+        elapsed = max(now - self.updated, 0)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = max(now, self.updated)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait(self) -> float:
+        """Return the seconds until the next token, as of the last ``take``."""
+        return max(1 - self.tokens, 0) / self.rate
+
+
+class EventPolicy:
+    """Decide which events are sent, in front of ``kafka_producer``.
+
+    Per ``message_type``, a whole session is either sampled in or out, and
+    the sessions that are in share a token bucket rate limit per session.
+    Changes of debounced fields are sent at most once per window, the
+    latest value held back rides along with the next event after it. What
+    is held back is reported to the caller, see ``apply``.
+    Every sent event records its ``sample_rate`` and the number of events
+    ``rate_limited`` before it, a value sent again while it is held back
+    counts once, so counts can be re-weighted downstream by
+    ``(1 + rate_limited) / sample_rate``.
+
+    Parameters
+    ----------
+    rate_limits : dict
+        ``{message_type: {"rate": per_second, "burst": events}}``.
+    sample_rates : dict
+        ``{message_type: fraction_of_sessions}``, missing types are kept.
+    debounce : dict
+        ``{field: seconds}``.
+    max_sessions : int
+        The number of sessions whose state is kept, the least recently
+        active are forgotten.
+    """
+
+    def __init__(
+        self,
+        rate_limits: dict = None,
+        sample_rates: dict = None,
+        debounce: dict = None,
+        max_sessions: int = 1000,
+    ):
+        self.rate_limits = rate_limits or {}
+        self.sample_rates = sample_rates or {}
+        self.debounce = debounce or {}
+        self.max_sessions = max_sessions
+        self.counters = {"sent": 0, "sampled_out": 0, "rate_limited": 0}
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str = POLICY_PATH) -> "EventPolicy":
+        """Load a policy from a JSON file, see ``configs/event_policy.json``."""
+        with open(path, "r") as f:
+            config = json.load(f)
+        return cls(
+            rate_limits=config.get("rate_limits"),
+            sample_rates=config.get("sample_rates"),
+            debounce=config.get("debounce"),
+        )
+
+    def _session(self, session_id: str) -> dict:
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._sessions[session_id] = {
+                "buckets": {},
+                "rate_limited": {},
+                "sent_at": {},
+                "pending": {},
+                "held": {},
+            }
+            if len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        return state
+
+    def apply(self, request_dict: dict, session_id: str = None) -> tuple:
+        """Decide what of an event to send now.
+
+        Fields that are held back are reported with the seconds until they
+        may go out, callers that keep state, like ``RerunEventCollector``,
+        send them again then instead of forgetting them. A debounced value
+        held back also rides along with the next event sent after its window.
+
+        Parameters
+        ----------
+        request_dict : dict
+            The event, it is not modified.
+        session_id : str
+            Defaults to the current streamlit session.
+
+        Returns
+        -------
+        tuple
+            ``(event, suppressed)``, the event to send or None, and
+            ``{field: seconds}`` for the fields of ``request_dict`` that were
+            not sent and when to try again. Sampled out sessions never get a
+            retry, their fields are not reported.
+        """
+        message_type = request_dict.get("message_type")
+        sample_rate = self.sample_rates.get(message_type, 1.0)
+        session_id = session_id or current_session_id()
+        now = time.monotonic()
+        with self._lock:
+            if sample_fraction(session_id, message_type) >= sample_rate:
+                self.counters["sampled_out"] += 1
+                return None, {}
+            state = self._session(session_id)
+            event, suppressed = self._debounce(state, dict(request_dict), now)
+            if not set(event) - set(ENVELOPE_FIELDS):
+                return None, suppressed
+            limit = self.rate_limits.get(message_type)
+            if limit is not None:
+                bucket = state["buckets"].get(message_type)
+                if bucket is None:
+                    bucket = state["buckets"][message_type] = TokenBucket(
+                        limit["rate"], limit["burst"]
+                    )
+                if not bucket.take(now):
+                    # debounced values wait for the next event instead
+                    pending = state["pending"][message_type]
+                    for field in self.debounce:
+                        if field in event:
+                            pending.setdefault(field, event[field])
+                    # callers send held back values again until they go out,
+                    # only a value not held back before is one more event
+                    held = state["held"].setdefault(message_type, {})
+                    changes = {
+                        field: value
+                        for field, value in request_dict.items()
+                        if field not in ENVELOPE_FIELDS
+                    }
+                    if any(
+                        field not in held or held[field] != value
+                        for field, value in changes.items()
+                    ):
+                        state["rate_limited"][message_type] = (
+                            state["rate_limited"].get(message_type, 0) + 1
+                        )
+                        self.counters["rate_limited"] += 1
+                    held.update(changes)
+                    retry = bucket.wait()
+                    for field in request_dict:
+                        if field not in ENVELOPE_FIELDS:
+                            suppressed[field] = max(suppressed.get(field, 0), retry)
+                    return None, suppressed
+            event["sample_rate"] = sample_rate
+            event["rate_limited"] = state["rate_limited"].pop(message_type, 0)
+            held = state["held"].get(message_type, {})
+            for field in request_dict:
+                held.pop(field, None)
+            for field in self.debounce:
+                if field in event:
+                    state["sent_at"][field] = now
+            self.counters["sent"] += 1
+        return event, suppressed
+
+    def _debounce(self, state: dict, event: dict, now: float) -> tuple:
+        message_type = event.get("message_type")
+        pending = state["pending"].setdefault(message_type, {})
+        suppressed = {}
+        for field, window in self.debounce.items():
+            if field in event:
+                pending[field] = event.pop(field)
+                wait = window - (now - state["sent_at"].get(field, -window))
+                if wait > 0:
+                    suppressed[field] = wait
+            if (
+                field in pending
+                and now - state["sent_at"].get(field, -window) >= window
+            ):
+                event[field] = pending.pop(field)
+        return event, suppressed
+
+    def stats(self) -> dict:
+        """Return the counters."""
+        with self._lock:
+            return {**self.counters, "sessions": len(self._sessions)}
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_policy() -> EventPolicy:
+    """Return the shared policy, loaded from ``EVENT_POLICY`` or the default file.
+
+    Set ``EVENT_POLICY=none`` to send every event.
+    """
+    global _policy
+    with _policy_lock:
+        if _policy is None:
+            path = os.getenv("EVENT_POLICY", POLICY_PATH)
+            _policy = EventPolicy() if path == "none" else EventPolicy.from_file(path)
+    return _policy
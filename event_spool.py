@@ -0,0 +1,428 @@
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+# length of the body, crc32 of timestamp and body, append time
+RECORD_HEADER = struct.Struct("<IId")
+SEGMENT_SUFFIX = ".seg"
+CURSOR_FILE = "cursor.json"
+LOCK_FILE = "spool.lock"
+
+
+def encode_record(topic: str, value: bytes, headers: list = None) -> bytes:
+    """Pack a topic, message value and headers into a record body."""
+    topic = topic.encode("utf-8")
+    parts = [
+        struct.pack("<H", len(topic)),
+        topic,
+        struct.pack("<H", len(headers or [])),
+    ]
+    for key, header_value in headers or []:
+        key = key.encode("utf-8")
+        header_value = header_value or b""
+        parts += [struct.pack("<H", len(key)), key]
+        parts += [struct.pack("<I", len(header_value)), header_value]
+    parts.append(value)
+    return b"".join(parts)
+
+
+def decode_record(body: bytes) -> tuple:
+    """Unpack a record body into ``(topic, value, headers)``."""
+    view = memoryview(body)
+    (topic_length,) = struct.unpack_from("<H", view, 0)
+    position = 2 + topic_length
+    topic = bytes(view[2:position]).decode("utf-8")
+    (header_count,) = struct.unpack_from("<H", view, position)
+    position += 2
+    headers = []
+    for _ in range(header_count):
+        (key_length,) = struct.unpack_from("<H", view, position)
+        key = bytes(view[position + 2 : position + 2 + key_length]).decode("utf-8")
+        position += 2 + key_length
+        (value_length,) = struct.unpack_from("<I", view, position)
+        headers.append((key, bytes(view[position + 4 : position + 4 + value_length])))
+        position += 4 + value_length
+    return topic, bytes(view[position:]), headers
+
+
+class Segment:
+    """One preallocated, memory-mapped spool file.
+
+    Records are written back to back, a zero length marks the end of the
+    written part. The name is the sequence number of the first record.
+    """
+
+    def __init__(self, path: str, first_seq: int, size: int):
+        self.path = path
+        self.first_seq = first_seq
+        self.count = 0
+        self.write_position = 0
+        self._file = open(path, "a+b")
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self.size = os.fstat(self._file.fileno()).st_size
+        self.map = mmap.mmap(self._file.fileno(), self.size)
+
+    @classmethod
+    def recover(cls, path: str, first_seq: int, size: int) -> "Segment":
+        """Open an existing segment and find the end of its valid records.
+
+        A torn write at the end, e.g. after a crash, fails the crc check and
+        is overwritten by the next append.
+        """
+        segment = cls(path, first_seq, size)
+        position = 0
+        while position + RECORD_HEADER.size <= segment.size:
+            length, crc, timestamp = RECORD_HEADER.unpack_from(segment.map, position)
+            end = position + RECORD_HEADER.size + length
+            if length == 0 or end > segment.size:
+                break
+            body = segment.map[position + RECORD_HEADER.size : end]
+            if zlib.crc32(struct.pack("<d", timestamp) + body) != crc:
+                logger.warning(f"Discarding torn record at {path}:{position}")
+                break
+            position = end
+            segment.count += 1
+        segment.write_position = position
+        return segment
+
+    def fits(self, length: int) -> bool:
+        return self.write_position + RECORD_HEADER.size + length <= self.size
+
+    def append(self, body: bytes, timestamp: float) -> None:
+        crc = zlib.crc32(struct.pack("<d", timestamp) + body)
+        start = self.write_position + RECORD_HEADER.size
+        # the body goes first, so a crash never leaves a valid looking header
+        self.map[start : start + len(body)] = body
+        RECORD_HEADER.pack_into(
+            self.map, self.write_position, len(body), crc, timestamp
+        )
+        self.write_position = start + len(body)
+        self.count += 1
+
+    def read(self, position: int) -> tuple:
+        """Return ``(body, timestamp, next_position)`` of the record at position."""
+        length, _, timestamp = RECORD_HEADER.unpack_from(self.map, position)
+        start = position + RECORD_HEADER.size
+        return self.map[start : start + length], timestamp, start + length
+
+    def close(self) -> None:
+        self.map.flush()
+        self.map.close()
+        self._file.close()
+
+
+class EventSpool:
+    """An append-only, segment-rotated write-ahead spool of encoded events.
+
+    Appends are memory copies into a memory-mapped segment, so producing an
+    event costs the same whether the broker is up or not. A forwarder reads
+    batches from the cursor and commits it once Kafka acknowledged them;
+    segments behind the cursor are deleted. Only one process can open a
+    spool directory at a time.
+
+    Parameters
+    ----------
+    directory : str
+        Where the segments and the cursor are kept.
+    segment_bytes : int
+        The size of a segment, a larger record gets a segment of its own.
+    sync_interval : float
+        Seconds between flushes of the active segment to disk, the page
+        cache already survives a crash of the process itself.
+    """
+
+    def __init__(
+        self,
+        directory: str = "spool",
+        segment_bytes: int = 16 * 1024 * 1024,
+        sync_interval: float = 1.0,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.sync_interval = sync_interval
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f"Spool {directory} is used by another process")
+        self._lock = threading.Condition()
+        self._last_sync = time.monotonic()
+        self.segments = [
+            Segment.recover(
+                os.path.join(directory, name),
+                int(name[: -len(SEGMENT_SUFFIX)]),
+                segment_bytes,
+            )
+            for name in sorted(os.listdir(directory))
+            if name.endswith(SEGMENT_SUFFIX)
+        ]
+        if not self.segments:
+            self.segments.append(self._new_segment(0))
+        self.cursor = self._load_cursor()
+        self.forwarded = 0
+        logger.info(
+            f"Opened spool {directory} with {self.lag()} events left to forward"
+        )
+
+    def _new_segment(self, first_seq: int, size: int = None) -> Segment:
+        path = os.path.join(self.directory, f"{first_seq:020d}{SEGMENT_SUFFIX}")
+        return Segment(path, first_seq, max(size or 0, self.segment_bytes))
+
+    def _load_cursor(self) -> dict:
+        first = self.segments[0]
+        cursor = {"segment": first.first_seq, "position": 0, "seq": first.first_seq}
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return cursor
+        if any(segment.first_seq == saved["segment"] for segment in self.segments):
+            return saved
+        return cursor
+
+    def _save_cursor(self) -> None:
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.cursor, f)
+        os.replace(path + ".tmp", path)
+
+    @property
+    def next_seq(self) -> int:
+        active = self.segments[-1]
+        return active.first_seq + active.count
+
+    def append(self, topic: str, value: bytes, headers: list = None) -> int:
+        """Write an event to the spool and return its sequence number."""
+        body = encode_record(topic, value, headers)
+        with self._lock:
+            active = self.segments[-1]
+            seq = self.next_seq
+            if not active.fits(len(body)):
+                # a record larger than segment_bytes gets a segment of its own
+                size = RECORD_HEADER.size + len(body)
+                if active.count == 0:
+                    # an empty segment is replaced in place by one large enough
+                    active.close()
+                    os.remove(active.path)
+                    active = self.segments[-1] = self._new_segment(seq, size)
+                else:
+                    active.map.flush()
+                    active = self._new_segment(seq, size)
+                    self.segments.append(active)
+            active.append(body, time.time())
+            if time.monotonic() - self._last_sync > self.sync_interval:
+                active.map.flush()
+                self._last_sync = time.monotonic()
+            self._lock.notify_all()
+        return seq
+
+    def _segment(self, first_seq: int) -> Segment:
+        for segment in self.segments:
+            if segment.first_seq == first_seq:
+                return segment
+        raise KeyError(first_seq)
+
+    def read_batch(self, max_records: int = 500, timeout: float = None) -> tuple:
+        """Return up to ``max_records`` events after the cursor.
+
+        Waits up to ``timeout`` seconds for an event when the spool is empty.
+
+        Returns
+        -------
+        tuple
+            ``(records, cursor)``, the ``(topic, value, headers, appended_at)``
+            records and the cursor to ``commit`` once they are forwarded.
+        """
+        with self._lock:
+            self._lock.wait_for(lambda: self.lag() > 0, timeout=timeout)
+            cursor = dict(self.cursor)
+            records = []
+            segment = self._segment(cursor["segment"])
+            while len(records) < max_records and cursor["seq"] < self.next_seq:
+                if cursor["seq"] == segment.first_seq + segment.count:
+                    segment = self.segments[self.segments.index(segment) + 1]
+                    cursor = {
+                        "segment": segment.first_seq,
+                        "position": 0,
+                        "seq": segment.first_seq,
+                    }
+                body, appended_at, cursor["position"] = segment.read(cursor["position"])
+                cursor["seq"] += 1
+                records.append((*decode_record(body), appended_at))
+        return records, cursor
+
+    def commit(self, cursor: dict) -> None:
+        """Move the cursor and delete the segments that are fully forwarded."""
+        with self._lock:
+            self.forwarded += cursor["seq"] - self.cursor["seq"]
+            self.cursor = dict(cursor)
+            self._save_cursor()
+            while (
+                len(self.segments) > 1
+                and self.segments[0].first_seq != cursor["segment"]
+            ):
+                segment = self.segments.pop(0)
+                segment.close()
+                os.remove(segment.path)
+
+    def lag(self) -> int:
+        """The number of events not forwarded yet."""
+        return self.next_seq - self.cursor["seq"]
+
+    def stats(self) -> dict:
+        """Return the spool size and how far the forwarder is behind."""
+        with self._lock:
+            lag_seconds = 0.0
+            if self.lag():
+                segment = self._segment(self.cursor["segment"])
+                if self.cursor["seq"] == segment.first_seq + segment.count:
+                    segment = self.segments[self.segments.index(segment) + 1]
+                    position = 0
+                else:
+                    position = self.cursor["position"]
+                _, timestamp, _ = segment.read(position)
+                lag_seconds = time.time() - timestamp
+            return {
+                "segments": len(self.segments),
+                "bytes": sum(segment.size for segment in self.segments),
+                "appended": self.next_seq,
+                "forwarded": self.forwarded,
+                "lag": self.lag(),
+                "lag_seconds": lag_seconds,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+
+class SpoolForwarder:
+    """Drain an EventSpool into Kafka from a background thread.
+
+    Each batch is produced and the cursor only moves past the events Kafka
+    acknowledged, failed batches are retried with exponential backoff. The
+    delivery is at least once, events after a failed one may be sent again.
+
+    Parameters
+    ----------
+    spool : EventSpool
+        The spool to drain.
+    producer : Producer
+        The producer, its ``message.timeout.ms`` bounds how long a batch
+        waits on an unreachable broker before it is retried.
+    batch_size : int
+        The maximum number of events per batch.
+    backoff_factor : float
+        Seconds to wait after the first failed batch, doubled per failure.
+    backoff_max : float
+        The longest wait between two attempts.
+    """
+
+    def __init__(
+        self,
+        spool: EventSpool,
+        producer,
+        batch_size: int = 500,
+        backoff_factor: float = 0.5,
+        backoff_max: float = 30.0,
+    ):
+        self.spool = spool
+        self.producer = producer
+        self.batch_size = batch_size
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.failures = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="kafka-spool-forwarder", daemon=True
+        )
+        self._thread.start()
+
+    def _forward(self, records: list) -> int:
+        """Produce a batch and return how many leading events were acknowledged."""
+        results = [None] * len(records)
+
+        def report(index, topic, appended_at):
+            def on_delivery(err, msg):
+                results[index] = err is None
+                if err is not None:
+                    REGISTRY.inc("canvas_events_failed_total", topic=topic)
+                    logger.error(f"Spooled message delivery failed: {err}")
+                    return
+                REGISTRY.inc("canvas_events_delivered_total", topic=topic)
+                REGISTRY.observe(
+                    "canvas_produce_ack_seconds",
+                    time.time() - appended_at,
+                    topic=topic,
+                )
+
+            return on_delivery
+
+        for index, (topic, value, headers, appended_at) in enumerate(records):
+            while True:
+                try:
+                    self.producer.produce(
+                        topic,
+                        value,
+                        headers=headers,
+                        on_delivery=report(index, topic, appended_at),
+                    )
+                    break
+                except BufferError:
+                    self.producer.poll(0.1)
+        while None in results:
+            self.producer.poll(0.1)
+        acknowledged = 0
+        while acknowledged < len(results) and results[acknowledged]:
+            acknowledged += 1
+        return acknowledged
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            records, cursor = self.spool.read_batch(self.batch_size, timeout=0.5)
+            if not records:
+                continue
+            acknowledged = self._forward(records)
+            if acknowledged == len(records):
+                self.spool.commit(cursor)
+                self.failures = 0
+                continue
+            if acknowledged:
+                # commit the acknowledged prefix, the rest is read again
+                _, prefix_cursor = self.spool.read_batch(acknowledged)
+                self.spool.commit(prefix_cursor)
+            self.failures += 1
+            delay = min(
+                self.backoff_factor * 2 ** (self.failures - 1), self.backoff_max
+            )
+            logger.warning(
+                f"Forwarding spooled events failed, {self.spool.lag()} left, "
+                f"retrying in {delay:.1f}s"
+            )
+            self._stopped.wait(delay)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Stop after the current batch."""
+        self._stopped.set()
+        self._thread.join(timeout)
@@ -0,0 +1,105 @@
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+def image_key(source) -> tuple:
+    """Return a key identifying the content of an image source.
+
+    Files on disk are keyed by path, modification time and size, uploaded
+    files by a hash of their bytes, as they are new objects on every rerun.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        stat = os.stat(source)
+        return ("file", os.fspath(source), stat.st_mtime_ns, stat.st_size)
+    data = source.getvalue()
+    return ("upload", hashlib.blake2b(data, digest_size=16).hexdigest())
+
+
+def image_nbytes(image: Image.Image) -> int:
+    """Return the size of the decoded pixels of an image."""
+    return image.width * image.height * len(image.getbands())
+
+
+class ImageCache:
+    """A bounded LRU cache of decoded, canvas sized background images.
+
+    Reruns get the same ``Image`` back and skip the decode and resize.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The decoded pixel bytes kept, the least recently used images are
+        evicted past it.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, source, size: tuple = None) -> Image.Image:
+        """Return the decoded image, resized to ``size`` if given.
+
+        Parameters
+        ----------
+        source : str or UploadedFile
+            A file path or a streamlit uploaded file.
+        size : tuple
+            The ``(width, height)`` of the canvas.
+
+        Returns
+        -------
+        Image.Image
+            The decoded image, shared between reruns so don't modify it.
+        """
+        key = (image_key(source), size)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return self._images[key]
+            self.misses += 1
+        if isinstance(source, (str, os.PathLike)):
+            image = Image.open(source)
+        else:
+            image = Image.open(io.BytesIO(source.getvalue()))
+        if size is not None and image.size != tuple(size):
+            image = image.resize(size, Image.Resampling.BILINEAR)
+        else:
+            image.load()
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = image
+                self.nbytes += image_nbytes(image)
+            while self.nbytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self.nbytes -= image_nbytes(evicted)
+                self.evictions += 1
+        return image
+
+    @property
+    def hit_rate(self) -> float:
+        """The share of lookups served from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """Return the cache counters."""
+        with self._lock:
+            return {
+                "images": len(self._images),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hit_rate,
+            }
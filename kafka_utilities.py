@@ -1,7 +1,17 @@
 from confluent_kafka import Producer
+from collections import deque
+import atexit
 import logging
 import random
 import datetime
+import os
+import threading
+import time
+
+from event_policy import get_policy
+from event_spool import EventSpool, SpoolForwarder
+from metrics import REGISTRY
+from serializers import encode_event, get_serializer
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -9,6 +19,399 @@ handler = logging.StreamHandler()
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
+# For more info on these settings, see:
+# https://kafka.apache.org/documentation/#producerconfigs
+DEFAULT_PRODUCER_CONFIG = {
+    "socket.keepalive.enable": True,
+    # give librdkafka a few ms to batch the messages of a single rerun
+    "linger.ms": 5,
+    # batches are compressed as a whole, consumers decompress transparently
+    "compression.type": "lz4",
+}
+
+# process-wide producers, shared by all streamlit sessions and threads
+_producers = {}
+_producers_lock = threading.Lock()
+
+
+def _registry_key(kafka_brokers: str, producer_config: dict = None):
+    return (kafka_brokers, tuple(sorted((producer_config or {}).items())))
+
+
+def get_producer(
+    kafka_brokers: str = "localhost:29092",
+    producer_config: dict = None,
+) -> Producer:
+    """Return the shared Producer for the given brokers and config.
+
+    The producer is created on first use and reused afterwards, so callers
+    no longer pay a broker handshake per message.
+
+    Parameters
+    ----------
+    kafka_brokers : str
+        A comma seperated str of brokers.
+    producer_config : dict
+        Extra librdkafka settings, merged over ``DEFAULT_PRODUCER_CONFIG``.
+
+    Returns
+    -------
+    Producer
+        The producer registered under ``(kafka_brokers, producer_config)``.
+    """
+    key = _registry_key(kafka_brokers, producer_config)
+    producer = _producers.get(key)
+    if producer is not None:
+        return producer
+    with _producers_lock:
+        producer = _producers.get(key)
+        if producer is None:
+            producer = Producer(
+                {
+                    **DEFAULT_PRODUCER_CONFIG,
+                    **(producer_config or {}),
+                    "bootstrap.servers": kafka_brokers,
+                }
+            )
+            _producers[key] = producer
+            logger.info(f"Created producer for {kafka_brokers}")
+    return producer
+
+
+@atexit.register
+def close_producers(timeout: float = 10.0) -> int:
+    """Flush and drop every registered producer.
+
+    Parameters
+    ----------
+    timeout : float
+        Maximum number of seconds to wait per producer.
+
+    Returns
+    -------
+    int
+        The number of messages still undelivered after flushing.
+    """
+    with _producers_lock:
+        producers = list(_producers.values())
+        _producers.clear()
+    remaining = 0
+    for producer in producers:
+        remaining += producer.flush(timeout)
+    if remaining:
+        logger.error(f"{remaining} messages were not delivered before exit")
+    return remaining
+
+
+BACKPRESSURE_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+
+class EventEmitter:
+    """Fire-and-forget event emission through a background thread.
+
+    Events are put on a bounded in-process queue and handed to librdkafka by
+    a daemon thread, so the streamlit script thread never waits on the
+    network. Delivery reports are counted and passed on to ``on_delivery``.
+
+    Parameters
+    ----------
+    kafka_topic : str
+        The default topic events are sent to.
+    kafka_brokers : str
+        A comma seperated str of brokers.
+    producer_config : dict
+        Extra librdkafka settings, see ``get_producer``.
+    max_queue_size : int
+        The number of events that can wait for the background thread.
+    backpressure : str
+        What ``emit`` does when the queue is full, one of "block" (wait for
+        room), "drop-oldest" (discard the oldest queued event) or
+        "drop-newest" (discard the event being emitted).
+    block_timeout : float
+        Maximum number of seconds "block" waits before dropping the event,
+        ``None`` waits forever.
+    on_delivery : callable
+        Called as ``on_delivery(err, msg)`` for every delivery report.
+    serializer : object
+        Encodes events, see ``serializers.get_serializer``.
+    """
+
+    def __init__(
+        self,
+        kafka_topic: str = "canvas",
+        kafka_brokers: str = "localhost:29092",
+        producer_config: dict = None,
+        max_queue_size: int = 10000,
+        backpressure: str = "drop-oldest",
+        block_timeout: float = None,
+        on_delivery=None,
+        serializer=None,
+    ):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(
+                f"backpressure must be one of {BACKPRESSURE_POLICIES}, got {backpressure!r}"
+            )
+        self.kafka_topic = kafka_topic
+        self.producer = get_producer(kafka_brokers, producer_config)
+        self.max_queue_size = max_queue_size
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self.on_delivery = on_delivery
+        self.serializer = serializer or get_serializer()
+        self.counters = {
+            "emitted": 0,
+            "dropped": 0,
+            "delivered": 0,
+            "failed": 0,
+        }
+        self._queue = deque()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="kafka-event-emitter", daemon=True
+        )
+        self._thread.start()
+        REGISTRY.add_callback(self._export)
+
+    def emit(self, request_dict: dict, kafka_topic: str = None) -> bool:
+        """Queue an event without waiting on the broker.
+
+        Parameters
+        ----------
+        request_dict : dict
+            The event to send.
+        kafka_topic : str
+            Overrides the emitter's default topic.
+
+        Returns
+        -------
+        bool
+            False when the event was dropped by the backpressure policy.
+        """
+        # encode now, the caller may mutate the dict after emitting it
+        value, headers = encode_event(request_dict, self.serializer)
+        item = (kafka_topic or self.kafka_topic, value, headers, time.monotonic())
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Cannot emit on a closed EventEmitter")
+            if len(self._queue) >= self.max_queue_size:
+                if self.backpressure == "drop-newest":
+                    self._count("dropped")
+                    return False
+                if self.backpressure == "drop-oldest":
+                    self._queue.popleft()
+                    self._count("dropped")
+                elif not self._condition.wait_for(
+                    lambda: len(self._queue) < self.max_queue_size,
+                    timeout=self.block_timeout,
+                ):
+                    self._count("dropped")
+                    return False
+            self._queue.append(item)
+            self._count("emitted")
+            self._condition.notify_all()
+        return True
+
+    def _count(self, counter: str) -> None:
+        self.counters[counter] += 1
+        REGISTRY.inc(f"canvas_events_{counter}_total", topic=self.kafka_topic)
+
+    def _export(self, registry) -> None:
+        registry.set(
+            "canvas_emitter_queue_depth", len(self._queue), topic=self.kafka_topic
+        )
+
+    def stats(self) -> dict:
+        """Return the counters plus the current queue depth."""
+        with self._condition:
+            return {
+                **self.counters,
+                "queue_depth": len(self._queue),
+                "in_flight": self._in_flight,
+            }
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Stop accepting events, drain the queue and flush the producer."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        self.producer.flush(timeout)
+
+    def _delivery_report(self, err, msg, emitted_at: float) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._count("failed" if err is not None else "delivered")
+        if err is None:
+            REGISTRY.observe(
+                "canvas_produce_ack_seconds",
+                time.monotonic() - emitted_at,
+                topic=self.kafka_topic,
+            )
+        if err is not None:
+            logger.error(f"Message delivery failed: {err}")
+        if self.on_delivery is not None:
+            try:
+                self.on_delivery(err, msg)
+            except Exception as e:
+                logger.error(f"on_delivery callback raised: {e}")
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._queue or self._closed, timeout=0.1
+                )
+                batch = list(self._queue)
+                self._queue.clear()
+                closed = self._closed
+                self._condition.notify_all()
+            for kafka_topic, value, headers, emitted_at in batch:
+                self._produce(kafka_topic, value, headers, emitted_at)
+            # serve delivery reports
+            self.producer.poll(0)
+            if closed and not batch:
+                return
+
+    def _produce(
+        self, kafka_topic: str, value: bytes, headers: list, emitted_at: float
+    ) -> None:
+        with self._condition:
+            self._in_flight += 1
+        while True:
+            try:
+                self.producer.produce(
+                    kafka_topic,
+                    value,
+                    headers=headers,
+                    on_delivery=lambda err, msg: self._delivery_report(
+                        err, msg, emitted_at
+                    ),
+                )
+                return
+            except BufferError:
+                # librdkafka's own queue is full, wait for deliveries
+                self.producer.poll(0.1)
+
+
+_emitters = {}
+_emitters_lock = threading.Lock()
+
+
+def get_emitter(
+    kafka_topic: str = "canvas",
+    kafka_brokers: str = "localhost:29092",
+    producer_config: dict = None,
+    **emitter_kwargs,
+) -> EventEmitter:
+    """Return the shared EventEmitter for the given topic, brokers and config.
+
+    ``emitter_kwargs`` are only used when the emitter is first created.
+    """
+    key = (kafka_topic, _registry_key(kafka_brokers, producer_config))
+    with _emitters_lock:
+        emitter = _emitters.get(key)
+        if emitter is None:
+            emitter = EventEmitter(
+                kafka_topic=kafka_topic,
+                kafka_brokers=kafka_brokers,
+                producer_config=producer_config,
+                **emitter_kwargs,
+            )
+            _emitters[key] = emitter
+    return emitter
+
+
+# registered after close_producers so it runs first at exit
+@atexit.register
+def close_emitters(timeout: float = 10.0) -> None:
+    """Drain and close every registered emitter."""
+    with _emitters_lock:
+        emitters = list(_emitters.values())
+        _emitters.clear()
+    for emitter in emitters:
+        emitter.close(timeout)
+
+
+# a spooled event gives up on an unreachable broker after this long and is
+# retried by the forwarder, instead of waiting for librdkafka's 5 minutes
+SPOOL_PRODUCER_CONFIG = {"message.timeout.ms": 30000}
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool(
+    spool_dir: str,
+    kafka_brokers: str = "localhost:29092",
+    producer_config: dict = None,
+    **spool_kwargs,
+) -> EventSpool:
+    """Return the shared EventSpool in ``spool_dir`` and start its forwarder.
+
+    ``spool_kwargs`` are only used when the spool is first opened.
+    """
+    with _spools_lock:
+        entry = _spools.get(spool_dir)
+        if entry is None:
+            spool = EventSpool(spool_dir, **spool_kwargs)
+            producer = get_producer(
+                kafka_brokers, {**SPOOL_PRODUCER_CONFIG, **(producer_config or {})}
+            )
+            entry = _spools[spool_dir] = (spool, SpoolForwarder(spool, producer))
+            REGISTRY.add_callback(lambda registry: _export_spool(registry, spool))
+    return entry[0]
+
+
+def _export_spool(registry, spool: EventSpool) -> None:
+    stats = spool.stats()
+    registry.set("canvas_spool_lag_events", stats["lag"], spool=spool.directory)
+    registry.set("canvas_spool_bytes", stats["bytes"], spool=spool.directory)
+
+
+def spool_stats() -> dict:
+    """Return the stats of every open spool, keyed by directory."""
+    with _spools_lock:
+        return {spool_dir: spool.stats() for spool_dir, (spool, _) in _spools.items()}
+
+
+# registered after close_producers so it runs first at exit, what is left in
+# the spool is forwarded on the next start
+@atexit.register
+def close_spools(timeout: float = 10.0) -> None:
+    """Stop every forwarder and close its spool."""
+    with _spools_lock:
+        entries = list(_spools.values())
+        _spools.clear()
+    for spool, forwarder in entries:
+        forwarder.stop(timeout)
+        spool.close()
+
+
+def emit_event(
+    request_dict: dict,
+    kafka_topic: str = "canvas",
+    kafka_brokers: str = "localhost:29092",
+    producer_config: dict = None,
+) -> bool:
+    """Queue an event without waiting on the network.
+
+    With ``EVENT_SPOOL_DIR`` set, the event is written to the durable spool
+    in that directory first, otherwise it goes on the shared emitter's
+    in-memory queue.
+    """
+    spool_dir = os.getenv("EVENT_SPOOL_DIR")
+    if spool_dir:
+        value, headers = encode_event(request_dict, get_serializer())
+        get_spool(spool_dir, kafka_brokers, producer_config).append(
+            kafka_topic, value, headers
+        )
+        REGISTRY.inc("canvas_events_emitted_total", topic=kafka_topic)
+        return True
+    return get_emitter(kafka_topic, kafka_brokers, producer_config).emit(request_dict)
+
+
 def kafka_producer(
     kafka_topic: str = "canvas",
     kafka_brokers: str = "localhost:29092",
@@ -17,19 +420,14 @@ def kafka_producer(
         "message_type": "example",
         "body": "example",
     },
+    producer_config: dict = None,
+    apply_policy: bool = True,
 ):
-    p = Producer(
-        {
-            # For more info on these settings, see:
-            # https://kafka.apache.org/documentation/#producerconfigs
-            # use a comma seperated str to add multiple brokers
-            "bootstrap.servers": kafka_brokers,
-            "socket.keepalive.enable": True,
-        }
-    )
-
-    p.produce(kafka_topic, str(request_dict))
-    p.poll(1)
-    p.flush()
-    logger.info(f"Sent message: {request_dict}")
-    return request_dict
\ No newline at end of file
+    if apply_policy:
+        # sampling, rate limits and debouncing, see configs/event_policy.json
+        request_dict, _ = get_policy().apply(request_dict)
+        if request_dict is None:
+            return None
+    emit_event(request_dict, kafka_topic, kafka_brokers, producer_config)
+    logger.info(f"Queued message: {request_dict}")
+    return request_dict
@@ -0,0 +1,221 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# every metric of the pipeline, name: (type, help)
+METRICS = {
+    "canvas_events_emitted_total": ("counter", "Events queued for Kafka"),
+    "canvas_events_dropped_total": ("counter", "Events dropped by backpressure"),
+    "canvas_events_delivered_total": ("counter", "Events acknowledged by Kafka"),
+    "canvas_events_failed_total": ("counter", "Events Kafka failed to deliver"),
+    "canvas_produce_ack_seconds": (
+        "histogram",
+        "Time from emitting an event to its Kafka acknowledgement",
+    ),
+    "canvas_emitter_queue_depth": ("gauge", "Events waiting for the emitter thread"),
+    "canvas_spool_lag_events": ("gauge", "Spooled events not forwarded yet"),
+    "canvas_spool_bytes": ("gauge", "Size of the spool segments"),
+    "canvas_consumer_lag_messages": (
+        "gauge",
+        "Messages between the consumer position and the partition end",
+    ),
+    "canvas_docs_indexed_total": ("counter", "Documents indexed into OpenSearch"),
+    "canvas_docs_failed_total": ("counter", "Documents that could not be indexed"),
+    "canvas_bulk_errors_total": ("counter", "Failed bulk requests"),
+    "canvas_bulk_seconds": ("histogram", "Duration of bulk requests with retries"),
+    "canvas_docs_per_second": ("gauge", "Documents indexed per second"),
+    "canvas_pipeline_seconds": (
+        "histogram",
+        "Latency per pipeline stage, from the event timestamp to indexing",
+    ),
+}
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms rendered in the Prometheus text format.
+
+    Metrics are identified by a name from ``METRICS`` and keyword labels.
+    Gauges that are cheaper to read on demand are refreshed by callbacks
+    right before every ``render`` or ``snapshot``.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._values = {}
+        self._histograms = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "counts": [0] * (len(self.buckets) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            histogram["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def add_callback(self, callback) -> None:
+        """Call ``callback(registry)`` before every render, to refresh gauges."""
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def _refresh(self) -> None:
+        for callback in list(self._callbacks):
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Metrics callback raised: {e}")
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        self._refresh()
+        lines = []
+        with self._lock:
+            for name, (metric_type, help_text) in METRICS.items():
+                values = [(k, v) for k, v in self._values.items() if k[0] == name]
+                histograms = [
+                    (k, h) for k, h in self._histograms.items() if k[0] == name
+                ]
+                if not values and not histograms:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for (_, labels), value in values:
+                    lines.append(f"{name}{_label_text(labels)} {value}")
+                for (_, labels), histogram in histograms:
+                    cumulative = 0
+                    bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram["counts"]):
+                        cumulative += count
+                        bucket_labels = _label_text(labels + (("le", bound),))
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{_label_text(labels)} {histogram['sum']}")
+                    lines.append(
+                        f"{name}_count{_label_text(labels)} {histogram['count']}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Return every metric as a JSON serializable dict."""
+        self._refresh()
+        with self._lock:
+            snapshot = {"time": time.time(), "values": [], "histograms": []}
+            for (name, labels), value in self._values.items():
+                snapshot["values"].append(
+                    {"name": name, "labels": dict(labels), "value": value}
+                )
+            for (name, labels), histogram in self._histograms.items():
+                snapshot["histograms"].append(
+                    {
+                        "name": name,
+                        "labels": dict(labels),
+                        "buckets": list(self.buckets),
+                        **histogram,
+                    }
+                )
+        return snapshot
+
+
+REGISTRY = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve ``/metrics`` for Prometheus from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics-http", daemon=True
+    ).start()
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def start_stats_file(path: str, interval: float = 10.0) -> threading.Thread:
+    """Rewrite ``path`` with a JSON snapshot of the metrics every ``interval``."""
+
+    def write():
+        while True:
+            time.sleep(interval)
+            try:
+                with open(path + ".tmp", "w") as f:
+                    json.dump(REGISTRY.snapshot(), f)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                logger.error(f"Unable to write metrics to {path}: {e}")
+
+    thread = threading.Thread(target=write, name="metrics-file", daemon=True)
+    thread.start()
+    return thread
+
+
+_exporting = set()
+_exporting_lock = threading.Lock()
+
+
+def export_from_env(offset: int = 0) -> None:
+    """Start the exporters configured in the environment, once per process.
+
+    ``METRICS_PORT`` serves ``/metrics`` on that port plus ``offset`` and
+    ``METRICS_FILE`` names a stats file, suffixed with ``offset`` when it is
+    not 0, so worker processes don't collide.
+    """
+    with _exporting_lock:
+        if os.getpid() in _exporting:
+            return
+        _exporting.add(os.getpid())
+    port = os.getenv("METRICS_PORT")
+    if port:
+        start_http_server(int(port) + offset)
+    path = os.getenv("METRICS_FILE")
+    if path:
+        start_stats_file(f"{path}.{offset}" if offset else path)
@@ -1,47 +1,158 @@
-import os
-from opensearchpy import OpenSearch
+import argparse
+import time
 
+from opensearch_client import get_client
+from opensearch_index import INDEX_ALIAS, ensure_index
 
-def main() -> None:
+
+def build_query(
+    since: str = None, until: str = None, message_types: list = None
+) -> dict:
+    """Return the query matching the documents to purge.
+
+    ``since`` and ``until`` are dates or date math, e.g. ``2024-10-13`` or
+    ``now-7d``.
     """
-    an example showing how to create an synchronous connection to
-    OpenSearch, create an index, index a document and search to
-    return the document
+    filters = []
+    if since or until:
+        timestamp_range = {}
+        if since:
+            timestamp_range["gte"] = since
+        if until:
+            timestamp_range["lt"] = until
+        filters.append({"range": {"timestamp": timestamp_range}})
+    if message_types:
+        filters.append({"terms": {"message_type": message_types}})
+    if not filters:
+        return {"match_all": {}}
+    return {"bool": {"filter": filters}}
+
+
+def backing_indices(client) -> dict:
+    """Return ``{index: is_write_index}`` for the indices behind the alias.
+
+    A concrete index from before rollover was introduced is returned as a
+    write index.
     """
-    host = "localhost"
-    port = 9200
-    auth = (
-        "admin",
-        os.getenv("OPENSEARCH_PASSWORD", "admin"),
-    )  # For testing only. Don't store credentials in code.
-
-    client = OpenSearch(
-        hosts=[{"host": host, "port": port}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_show_warn=False,
+    if not client.indices.exists_alias(name=INDEX_ALIAS):
+        if client.indices.exists(index=INDEX_ALIAS):
+            return {INDEX_ALIAS: True}
+        return {}
+    return {
+        index: bool(aliases["aliases"][INDEX_ALIAS].get("is_write_index"))
+        for index, aliases in client.indices.get_alias(name=INDEX_ALIAS).items()
+    }
+
+
+def droppable_indices(client, until: str) -> list:
+    """Return the read-only backing indices whose newest document is before ``until``."""
+    indices = [
+        index for index, is_write in backing_indices(client).items() if not is_write
+    ]
+    if not indices:
+        return []
+    response = client.search(
+        index=",".join(indices),
+        body={
+            "size": 0,
+            "query": {"range": {"timestamp": {"gte": until}}},
+            "aggs": {"indices": {"terms": {"field": "_index", "size": len(indices)}}},
+        },
     )
+    still_needed = {
+        bucket["key"] for bucket in response["aggregations"]["indices"]["buckets"]
+    }
+    return [index for index in indices if index not in still_needed]
 
-    info = client.info()
-    print(f"Welcome to {info['version']['distribution']} {info['version']['number']}!")
 
-    # create an index
+def wait_for_task(client, task_id: str, poll_interval: float = 1.0) -> dict:
+    """Print the progress of a ``_delete_by_query`` task until it completes."""
+    while True:
+        response = client.tasks.get(task_id=task_id)
+        status = response["task"]["status"]
+        print(
+            f"deleted {status['deleted']:,} of {status['total']:,} "
+            f"({status.get('version_conflicts', 0):,} conflicts)"
+        )
+        if response.get("completed"):
+            return response.get("response", status)
+        time.sleep(poll_interval)
 
-    index_name = "canvas-index"
 
-    # delete the document
-    for i in range(1, 10000):
-        doc_id = str(i)
-        response = client.delete(index=index_name, id=doc_id)
-        print(response)
+def main() -> None:
+    """
+    purge canvas-index documents, either by dropping whole indices or with
+    a sliced _delete_by_query running inside the cluster
+    """
+    parser = argparse.ArgumentParser(description="Purge logged canvas events")
+    parser.add_argument("--since", help="only documents at or after this date")
+    parser.add_argument("--until", help="only documents before this date")
+    parser.add_argument(
+        "--message-type",
+        action="append",
+        dest="message_types",
+        help="only documents of this message_type, can be repeated",
+    )
+    parser.add_argument(
+        "--drop-indices",
+        action="store_true",
+        help="drop whole backing indices instead of deleting their documents "
+        "where possible, without filters every index is dropped",
+    )
+    parser.add_argument(
+        "--slices", default="auto", help="parallel slices for _delete_by_query"
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        default=-1,
+        help="throttle _delete_by_query, -1 for no throttling",
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count what would be deleted"
+    )
+    args = parser.parse_args()
+
+    client = get_client()
 
-    # delete the index
+    query = build_query(args.since, args.until, args.message_types)
+    to_drop = []
+    if args.drop_indices and not args.message_types:
+        if args.since is None and args.until is None:
+            to_drop = list(backing_indices(client))
+        elif args.since is None:
+            to_drop = droppable_indices(client, args.until)
 
-    # response = client.indices.delete(index=index_name)
+    count = client.count(index=INDEX_ALIAS, body={"query": query})["count"]
+    print(f"{count:,} documents match")
+    if to_drop:
+        print(f"indices to drop: {', '.join(to_drop)}")
+    if args.dry_run:
+        return
 
-    # print(response)
+    # drop the indices
+    for index in to_drop:
+        response = client.indices.delete(index=index)
+        print(f"dropped {index}: {response}")
+    if to_drop and not client.indices.exists_alias(name=INDEX_ALIAS):
+        # every index was dropped, recreate the write alias
+        ensure_index(client)
+        return
+
+    # delete the remaining documents
+    response = client.delete_by_query(
+        index=INDEX_ALIAS,
+        body={"query": query},
+        params={
+            "slices": args.slices,
+            "conflicts": "proceed",
+            "requests_per_second": args.requests_per_second,
+            "wait_for_completion": "false",
+        },
+    )
+    result = wait_for_task(client, response["task"])
+    print(f"deleted {result.get('deleted', 0):,} documents")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
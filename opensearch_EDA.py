@@ -10,9 +10,7 @@
 # GitHub history for details.
 
 
-import os
-
-from opensearchpy import OpenSearch
+from opensearch_client import get_client
 
 # connect to OpenSearch
 
@@ -23,23 +21,7 @@ def main() -> None:
     OpenSearch, create an index, index a document and search to
     return the document
     """
-    host = "localhost"
-    port = 9200
-    auth = (
-        "admin",
-        os.getenv("OPENSEARCH_PASSWORD", "admin"),
-    )  # For testing only. Don't store credentials in code.
-
-    client = OpenSearch(
-        hosts=[{"host": host, "port": port}],
-        http_auth=auth,
-        use_ssl=True,
-        verify_certs=False,
-        ssl_show_warn=False,
-    )
-
-    info = client.info()
-    print(f"Welcome to {info['version']['distribution']} {info['version']['number']}!")
+    client = get_client(check_connection=True)
 
     # create an index
 
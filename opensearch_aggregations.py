@@ -0,0 +1,176 @@
+import pandas as pd
+
+# fields every event has, they are not "variables" of the melted frame
+ID_FIELDS = ("timestamp", "message_type")
+
+
+def field_mapping(client, index_name: str) -> dict:
+    """Return the top level field mappings of an index (or alias)."""
+    properties = {}
+    for mapping in client.indices.get_mapping(index=index_name).values():
+        properties.update(mapping["mappings"].get("properties", {}))
+    return properties
+
+
+def aggregatable_field(mapping: dict, field: str) -> str:
+    """Return the name to aggregate ``field`` on, its keyword sub-field for text."""
+    properties = mapping.get(field, {})
+    if properties.get("type") == "text":
+        for name, sub_field in properties.get("fields", {}).items():
+            if sub_field.get("type") == "keyword":
+                return f"{field}.{name}"
+    return field
+
+
+def _search_aggs(client, index_name: str, aggs: dict, query: dict = None) -> dict:
+    body = {"size": 0, "aggs": aggs}
+    if query is not None:
+        body["query"] = query
+    return client.search(body=body, index=index_name)["aggregations"]
+
+
+def variable_counts(client, index_name: str, query: dict = None) -> pd.DataFrame:
+    """Count the documents holding each field, the server-side ``value_counts``.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns ``variable`` and ``count``, most frequent first.
+    """
+    fields = [f for f in field_mapping(client, index_name) if f not in ID_FIELDS]
+    if not fields:
+        return pd.DataFrame({"variable": [], "count": []})
+    aggs = {
+        "variables": {
+            "filters": {
+                "filters": {field: {"exists": {"field": field}} for field in fields}
+            }
+        }
+    }
+    buckets = _search_aggs(client, index_name, aggs, query)["variables"]["buckets"]
+    return (
+        pd.DataFrame(
+            {
+                "variable": list(buckets),
+                "count": [bucket["doc_count"] for bucket in buckets.values()],
+            }
+        )
+        .query("count > 0")
+        .sort_values("count", ascending=False, ignore_index=True)
+    )
+
+
+def message_type_counts(client, index_name: str, query: dict = None) -> pd.DataFrame:
+    """Count the documents per ``message_type``.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns ``message_type`` and ``count``.
+    """
+    aggs = {"message_types": {"terms": {"field": "message_type", "size": 100}}}
+    buckets = _search_aggs(client, index_name, aggs, query)["message_types"]["buckets"]
+    return pd.DataFrame(
+        {
+            "message_type": [bucket["key"] for bucket in buckets],
+            "count": [bucket["doc_count"] for bucket in buckets],
+        }
+    )
+
+
+def date_histogram(
+    client,
+    index_name: str,
+    interval: str = "1h",
+    split_by: str = "message_type",
+    query: dict = None,
+) -> pd.DataFrame:
+    """Count the documents per time bucket and ``split_by`` value.
+
+    Parameters
+    ----------
+    interval : str
+        A fixed interval such as "1m", "1h" or "1d".
+    split_by : str
+        A keyword field to split each bucket by, None for one series.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns ``timestamp``, ``split_by`` (when given) and ``count``.
+    """
+    histogram = {
+        "date_histogram": {"field": "timestamp", "fixed_interval": interval},
+    }
+    if split_by:
+        mapping = field_mapping(client, index_name)
+        histogram["aggs"] = {
+            "split": {
+                "terms": {"field": aggregatable_field(mapping, split_by), "size": 20}
+            }
+        }
+    buckets = _search_aggs(client, index_name, {"histogram": histogram}, query)[
+        "histogram"
+    ]["buckets"]
+    columns = {"timestamp": [], "count": []}
+    if split_by:
+        columns[split_by] = []
+    for bucket in buckets:
+        if not split_by:
+            columns["timestamp"].append(bucket["key"])
+            columns["count"].append(bucket["doc_count"])
+            continue
+        for split in bucket["split"]["buckets"]:
+            columns["timestamp"].append(bucket["key"])
+            columns[split_by].append(split["key"])
+            columns["count"].append(split["doc_count"])
+    frame = pd.DataFrame(columns)
+    frame["timestamp"] = pd.to_datetime(frame["timestamp"], unit="ms")
+    return frame
+
+
+def top_values(
+    client,
+    index_name: str,
+    field: str,
+    size: int = 10,
+    by_message_type: bool = True,
+    query: dict = None,
+) -> pd.DataFrame:
+    """Return the most frequent values of ``field``, per ``message_type``.
+
+    Returns
+    -------
+    pd.DataFrame
+        Columns ``message_type`` (when ``by_message_type``), ``value`` and
+        ``count``.
+    """
+    terms = {
+        "terms": {
+            "field": aggregatable_field(field_mapping(client, index_name), field),
+            "size": size,
+        }
+    }
+    if by_message_type:
+        aggs = {
+            "message_types": {
+                "terms": {"field": "message_type", "size": 100},
+                "aggs": {"values": terms},
+            }
+        }
+    else:
+        aggs = {"values": terms}
+    result = _search_aggs(client, index_name, aggs, query)
+    columns = {"value": [], "count": []}
+    if by_message_type:
+        columns["message_type"] = []
+        for message_type in result["message_types"]["buckets"]:
+            for bucket in message_type["values"]["buckets"]:
+                columns["message_type"].append(message_type["key"])
+                columns["value"].append(bucket.get("key_as_string", bucket["key"]))
+                columns["count"].append(bucket["doc_count"])
+    else:
+        for bucket in result["values"]["buckets"]:
+            columns["value"].append(bucket.get("key_as_string", bucket["key"]))
+            columns["count"].append(bucket["doc_count"])
+    return pd.DataFrame(columns)
@@ -0,0 +1,127 @@
+import logging
+import os
+import threading
+import time
+
+from opensearchpy import OpenSearch, Transport
+from opensearchpy.exceptions import ConnectionError, ConnectionTimeout, TransportError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+
+class BackoffTransport(Transport):
+    """A Transport that waits with exponential backoff between retries.
+
+    The stock Transport retries straight away on the next connection, which
+    only hammers a cluster that is already struggling.
+
+    Parameters
+    ----------
+    backoff_factor : float
+        Seconds to wait before the first retry, doubled on every retry.
+    backoff_max : float
+        The longest wait between two retries.
+    """
+
+    def __init__(
+        self, *args, backoff_factor: float = 0.5, backoff_max: float = 10.0, **kwargs
+    ):
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.backoff_retries = kwargs.pop("max_retries", 3)
+        super().__init__(*args, max_retries=0, **kwargs)
+
+    def _should_retry(self, error: TransportError) -> bool:
+        if isinstance(error, ConnectionTimeout):
+            return self.retry_on_timeout
+        if isinstance(error, ConnectionError):
+            return True
+        return error.status_code in self.retry_on_status
+
+    def perform_request(self, *args, **kwargs):
+        for attempt in range(self.backoff_retries + 1):
+            try:
+                return super().perform_request(*args, **kwargs)
+            except TransportError as e:
+                if attempt == self.backoff_retries or not self._should_retry(e):
+                    raise
+                delay = min(self.backoff_factor * 2**attempt, self.backoff_max)
+                logger.warning(
+                    f"OpenSearch request failed ({e}), retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+
+def client_config_from_env() -> dict:
+    """Read the OpenSearch connection settings from the environment.
+
+    ``OPENSEARCH_HOSTS`` is a comma seperated list of ``host:port``, e.g.
+    ``opensearch-node1:9200,opensearch-node2:9200`` inside the docker network.
+    """
+    hosts = []
+    for host in os.getenv("OPENSEARCH_HOSTS", "localhost:9200").split(","):
+        name, _, port = host.strip().partition(":")
+        hosts.append({"host": name, "port": int(port or 9200)})
+    sniff = os.getenv("OPENSEARCH_SNIFF", "false").lower() in ("1", "true", "yes")
+    return {
+        "hosts": hosts,
+        "http_auth": (
+            os.getenv("OPENSEARCH_USER", "admin"),
+            os.getenv("OPENSEARCH_PASSWORD", "admin"),
+        ),  # For testing only. Don't store credentials in code.
+        "use_ssl": True,
+        "verify_certs": False,
+        "ssl_show_warn": False,
+        "pool_maxsize": int(os.getenv("OPENSEARCH_POOL_SIZE", "10")),
+        "timeout": float(os.getenv("OPENSEARCH_TIMEOUT", "30")),
+        "max_retries": int(os.getenv("OPENSEARCH_MAX_RETRIES", "3")),
+        "retry_on_timeout": True,
+        "retry_on_status": (429, 502, 503, 504),
+        "backoff_factor": float(os.getenv("OPENSEARCH_BACKOFF", "0.5")),
+        # sniffing discovers the other cluster nodes, only useful where their
+        # publish addresses are reachable, e.g. inside the docker network
+        "sniff_on_start": sniff,
+        "sniff_on_connection_fail": sniff,
+        "sniffer_timeout": 60 if sniff else None,
+    }
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(check_connection: bool = False, **overrides) -> OpenSearch:
+    """Return a cached, connection-pooled OpenSearch client.
+
+    Clients are cached per process and configuration, so forked worker
+    processes never share sockets with their parent.
+
+    Parameters
+    ----------
+    check_connection : bool
+        Call ``info()`` and log the cluster version, costs a round trip.
+    **overrides
+        Settings that replace the ones from ``client_config_from_env``.
+
+    Returns
+    -------
+    OpenSearch
+        The shared client.
+    """
+    config = {**client_config_from_env(), **overrides}
+    key = (os.getpid(), repr(sorted(config.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = OpenSearch(transport_class=BackoffTransport, **config)
+            _clients[key] = client
+    if check_connection:
+        info = client.info()
+        logger.info(
+            f"Welcome to {info['version']['distribution']} {info['version']['number']}!"
+        )
+    return client
@@ -0,0 +1,74 @@
+import json
+import logging
+import os
+
+from opensearchpy.exceptions import NotFoundError
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs")
+
+# events are written to and read from this alias, the backing indices are
+# canvas-index-000001, canvas-index-000002, ... rolled over by ISM
+INDEX_ALIAS = "canvas-index"
+INDEX_PATTERN = f"{INDEX_ALIAS}-*"
+FIRST_INDEX = f"{INDEX_ALIAS}-000001"
+TEMPLATE_NAME = "canvas-template"
+POLICY_NAME = "canvas-rollover"
+
+
+def _load_config(file_name: str) -> dict:
+    with open(os.path.join(CONFIG_DIR, file_name), "r") as f:
+        return json.load(f)
+
+
+def mapping_properties() -> dict:
+    """Return the field mapping of the canvas index template."""
+    return _load_config("canvas-index-template.json")["template"]["mappings"][
+        "properties"
+    ]
+
+
+def ensure_index(client) -> None:
+    """Install the canvas index template and ISM policy and bootstrap the alias.
+
+    Safe to call on every startup, existing policies and indices are kept.
+    The template mapping lives in ``configs/canvas-index-template.json`` and
+    the rollover and retention policy in ``configs/canvas-ism-policy.json``.
+    """
+    template = _load_config("canvas-index-template.json")
+    client.indices.put_index_template(name=TEMPLATE_NAME, body=template)
+    try:
+        client.plugins.index_management.get_policy(policy=POLICY_NAME)
+        logger.info(f"ISM policy {POLICY_NAME} already exists")
+    except NotFoundError:
+        client.plugins.index_management.put_policy(
+            policy=POLICY_NAME, body=_load_config("canvas-ism-policy.json")
+        )
+        logger.info(f"Created ISM policy {POLICY_NAME}")
+
+    if client.indices.exists_alias(name=INDEX_ALIAS):
+        # fields added to the template since are added to the existing
+        # indices too, the template itself only applies to new ones
+        client.indices.put_mapping(
+            index=INDEX_ALIAS,
+            body={"properties": template["template"]["mappings"]["properties"]},
+        )
+        return
+    if client.indices.exists(index=INDEX_ALIAS):
+        # a concrete index from before rollover was introduced, it keeps
+        # receiving writes until it is dropped with opensearch-clear.py
+        logger.warning(
+            f"{INDEX_ALIAS} is a concrete index, not an alias, "
+            "drop it to switch to rollover indices"
+        )
+        return
+    client.indices.create(
+        index=FIRST_INDEX,
+        body={"aliases": {INDEX_ALIAS: {"is_write_index": True}}},
+    )
+    logger.info(f"Created {FIRST_INDEX} behind the {INDEX_ALIAS} alias")
@@ -0,0 +1,254 @@
+import datetime
+import logging
+import threading
+import time
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+
+def iter_hit_pages(
+    client,
+    index_name: str,
+    limit: int,
+    query: dict = None,
+    sort: list = None,
+    source_includes: list = None,
+    source_excludes: list = None,
+    page_size: int = 5000,
+    keep_alive: str = "2m",
+    search_after: list = None,
+):
+    """Yield pages of hits from a point-in-time, paged with ``search_after``.
+
+    The point in time keeps the pages consistent while documents are being
+    indexed and avoids the index's max result window, so ``limit`` can go
+    into the millions.
+
+    Parameters
+    ----------
+    client : OpenSearch
+        The OpenSearch client.
+    index_name : str
+        The index or alias to read.
+    limit : int
+        The maximum number of hits to yield in total.
+    query : dict
+        The query, defaults to ``match_all``.
+    sort : list
+        The sort, defaults to newest ``timestamp`` first. ``_id`` is appended
+        as a tiebreaker.
+    source_includes, source_excludes : list
+        ``_source`` filtering, only the needed fields are transferred.
+    page_size : int
+        The number of hits per request.
+    keep_alive : str
+        How long the point in time lives between two requests.
+    search_after : list
+        Resume after the hit with these ``sort`` values.
+
+    Yields
+    ------
+    tuple
+        ``(hits, total)``, the hits of a page and the number of hits that
+        will be yielded in total.
+    """
+    pit_id = client.create_pit(index=index_name, params={"keep_alive": keep_alive})[
+        "pit_id"
+    ]
+    sort = list(sort or [{"timestamp": {"order": "desc"}}]) + [
+        {"_id": {"order": "asc"}}
+    ]
+    source = {}
+    if source_includes:
+        source["includes"] = source_includes
+    if source_excludes:
+        source["excludes"] = source_excludes
+    fetched = 0
+    total = None
+    try:
+        while fetched < limit:
+            body = {
+                "size": min(page_size, limit - fetched),
+                "query": query or {"match_all": {}},
+                "sort": sort,
+                "pit": {"id": pit_id, "keep_alive": keep_alive},
+                "track_total_hits": total is None,
+            }
+            if source:
+                body["_source"] = source
+            if search_after is not None:
+                body["search_after"] = search_after
+            response = client.search(body=body)
+            hits = response["hits"]["hits"]
+            if total is None:
+                total = min(response["hits"]["total"]["value"], limit)
+            if not hits:
+                break
+            pit_id = response.get("pit_id", pit_id)
+            search_after = hits[-1]["sort"]
+            fetched += len(hits)
+            yield hits, total
+    finally:
+        try:
+            client.delete_pit(body={"pit_id": [pit_id]})
+        except Exception as e:
+            logger.error(f"Unable to delete point in time due to error: {e}")
+
+
+def load_frame(client, index_name: str, limit: int, progress=None, **page_kwargs):
+    """Load up to ``limit`` documents into a DataFrame, one page at a time.
+
+    Each page is turned into column lists straight away, so the full list of
+    hits is never held in memory.
+
+    Parameters
+    ----------
+    client : OpenSearch
+        The OpenSearch client.
+    index_name : str
+        The index or alias to read.
+    limit : int
+        The maximum number of documents.
+    progress : callable
+        Called as ``progress(loaded, total)`` after every page.
+    **page_kwargs
+        Passed on to ``iter_hit_pages``.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per document, with the ``_source`` fields and ``doc_id``.
+    """
+    columns = {"doc_id": []}
+    loaded = 0
+    for hits, total in iter_hit_pages(client, index_name, limit, **page_kwargs):
+        columns["doc_id"].extend(hit["_id"] for hit in hits)
+        for hit in hits:
+            for field in hit["_source"]:
+                if field not in columns:
+                    # fields first seen on this page are missing before it
+                    columns[field] = [None] * loaded
+        for field, values in columns.items():
+            if field != "doc_id":
+                values.extend(hit["_source"].get(field) for hit in hits)
+        loaded += len(hits)
+        if progress is not None:
+            progress(loaded, total)
+    return pd.DataFrame(columns)
+
+
+class IncrementalFrame:
+    """The newest documents of an index, refreshed by fetching only new ones.
+
+    The first ``refresh`` loads up to ``max_rows`` documents. Later ones
+    only fetch documents whose ``watermark_field`` is past the newest value
+    seen, minus ``overlap`` seconds for documents that became searchable
+    late, and put them in front of the frame. Duplicates are dropped by
+    ``doc_id`` and the oldest rows are evicted past ``max_rows``.
+
+    The watermark defaults to ``indexed_at``, which the sink sets, so events
+    that reach the index late are still picked up; ``timestamp`` is when the
+    event happened in the app.
+
+    Parameters
+    ----------
+    client : OpenSearch
+        The OpenSearch client.
+    index_name : str
+        The index or alias to read.
+    max_rows : int
+        The number of documents kept.
+    watermark_field : str
+        The date field new documents are found by.
+    overlap : float
+        Seconds the watermark is moved back on every refresh.
+    **page_kwargs
+        Passed on to ``iter_hit_pages``, e.g. ``source_excludes``.
+    """
+
+    def __init__(
+        self,
+        client,
+        index_name: str,
+        max_rows: int,
+        watermark_field: str = "indexed_at",
+        overlap: float = 5.0,
+        **page_kwargs,
+    ):
+        self.client = client
+        self.index_name = index_name
+        self.max_rows = max_rows
+        self.watermark_field = watermark_field
+        self.overlap = overlap
+        self.page_kwargs = page_kwargs
+        self.frame = None
+        self.watermark = None
+        self.refreshed_at = None
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def refresh(self, progress=None) -> pd.DataFrame:
+        """Fetch the documents indexed since the last refresh and return the frame.
+
+        Falls back to a full load the first time, and while no document has
+        the watermark field yet.
+        """
+        with self._lock:
+            if self.frame is None or self.watermark is None:
+                frame = load_frame(
+                    self.client,
+                    self.index_name,
+                    self.max_rows,
+                    progress=progress,
+                    **self.page_kwargs,
+                )
+                fetched = len(frame)
+            else:
+                since = datetime.datetime.fromisoformat(
+                    self.watermark
+                ) - datetime.timedelta(seconds=self.overlap)
+                new = load_frame(
+                    self.client,
+                    self.index_name,
+                    self.max_rows,
+                    progress=progress,
+                    query={"range": {self.watermark_field: {"gte": since.isoformat()}}},
+                    **self.page_kwargs,
+                )
+                fetched = len(new)
+                frame = pd.concat([new, self.frame], ignore_index=True)
+                frame = frame.drop_duplicates("doc_id", keep="first")
+                if (
+                    "timestamp" in frame
+                    and not frame["timestamp"].is_monotonic_decreasing
+                ):
+                    frame = frame.sort_values(
+                        "timestamp", ascending=False, kind="stable"
+                    )
+                # evict the oldest rows
+                frame = frame.head(self.max_rows).reset_index(drop=True)
+            if (
+                self.watermark_field in frame
+                and frame[self.watermark_field].notna().any()
+            ):
+                self.watermark = frame[self.watermark_field].dropna().max()
+            self.frame = frame
+            self.refreshed_at = time.monotonic()
+            self.version += 1
+            logger.info(
+                f"Fetched {fetched} documents, keeping {len(frame)} "
+                f"up to {self.watermark_field} {self.watermark}"
+            )
+            return frame
+
+    def age(self) -> float:
+        """Seconds since the last refresh, infinite before the first one."""
+        if self.refreshed_at is None:
+            return float("inf")
+        return time.monotonic() - self.refreshed_at
@@ -0,0 +1,418 @@
+from confluent_kafka import TIMESTAMP_NOT_AVAILABLE, KafkaException, TopicPartition
+import bisect
+import datetime
+import hashlib
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+from metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+handler = logging.StreamHandler()
+handler.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+
+# upper bounds of the batch size histogram buckets
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 5000)
+
+# bulk item statuses worth retrying, anything else is a bad document
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+
+def kafka_doc_id(message, document: dict = None) -> str:
+    """Return a document id built from the message's topic, partition and offset.
+
+    The id is unique per message and stable on replay, so re-consuming a
+    partition overwrites the same documents instead of duplicating them.
+    """
+    return f"{message.topic()}-{message.partition()}-{message.offset()}"
+
+
+def content_doc_id(message, document: dict = None) -> str:
+    """Return a document id built from a hash of the message value.
+
+    Identical events map onto a single document, wherever they were produced.
+    """
+    return hashlib.blake2b(message.value(), digest_size=16).hexdigest()
+
+
+def _isoformat(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+
+def stamp_consumed(message, document) -> None:
+    """Add the ``produced_at`` and ``consumed_at`` timestamps to a document.
+
+    ``produced_at`` is the Kafka message timestamp, set when the event was
+    handed to the producer. The sink adds ``indexed_at`` before the bulk
+    request, so every stage of the pipeline can be told apart.
+    """
+    if not isinstance(document, dict):
+        return
+    timestamp_type, timestamp = message.timestamp()
+    if timestamp_type != TIMESTAMP_NOT_AVAILABLE:
+        document["produced_at"] = _isoformat(timestamp / 1000)
+    document["consumed_at"] = _isoformat(time.time())
+
+
+def observe_stages(documents: list) -> None:
+    """Record the latency of each pipeline stage of indexed documents."""
+    stages = (
+        ("emit", "timestamp", "produced_at"),
+        ("kafka", "produced_at", "consumed_at"),
+        ("sink", "consumed_at", "indexed_at"),
+        ("end_to_end", "timestamp", "indexed_at"),
+    )
+    for _, document in documents:
+        if not isinstance(document, dict):
+            continue
+        for stage, start, end in stages:
+            try:
+                latency = (
+                    datetime.datetime.fromisoformat(document[end])
+                    - datetime.datetime.fromisoformat(document[start])
+                ).total_seconds()
+            except (KeyError, TypeError, ValueError):
+                continue
+            REGISTRY.observe("canvas_pipeline_seconds", max(latency, 0.0), stage=stage)
+
+
+class SinkMetrics:
+    """Throughput counters for the bulk sink.
+
+    Parameters
+    ----------
+    window : int
+        The number of recent bulk latencies kept for the percentiles.
+    """
+
+    def __init__(self, window: int = 1000):
+        self.started = time.monotonic()
+        self.docs_indexed = 0
+        self.docs_failed = 0
+        self.bulk_requests = 0
+        self.bulk_errors = 0
+        self.bulk_latencies = deque(maxlen=window)
+        self.batch_size_counts = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+        # (topic, partition): messages behind, updated on every report
+        self.partition_lag = {}
+        REGISTRY.add_callback(self._export)
+
+    def record_bulk(self, batch_size: int, latency: float, failed: int) -> None:
+        self.bulk_requests += 1
+        self.docs_indexed += batch_size - failed
+        self.docs_failed += failed
+        self.bulk_latencies.append(latency)
+        self.batch_size_counts[bisect.bisect_left(BATCH_SIZE_BUCKETS, batch_size)] += 1
+        REGISTRY.inc("canvas_docs_indexed_total", batch_size - failed)
+        REGISTRY.inc("canvas_docs_failed_total", failed)
+        REGISTRY.observe("canvas_bulk_seconds", latency)
+
+    def record_failed(self, count: int = 1) -> None:
+        self.docs_failed += count
+        REGISTRY.inc("canvas_docs_failed_total", count)
+
+    def record_bulk_error(self) -> None:
+        self.bulk_errors += 1
+        REGISTRY.inc("canvas_bulk_errors_total")
+
+    def _export(self, registry) -> None:
+        elapsed = time.monotonic() - self.started
+        registry.set(
+            "canvas_docs_per_second", self.docs_indexed / elapsed if elapsed else 0.0
+        )
+        for (topic, partition), lag in self.partition_lag.items():
+            registry.set(
+                "canvas_consumer_lag_messages", lag, topic=topic, partition=partition
+            )
+
+    def summary(self) -> dict:
+        """Return docs/sec, bulk latency percentiles and the batch histogram."""
+        elapsed = time.monotonic() - self.started
+        latencies_ms = np.array(self.bulk_latencies) * 1000
+        labels = [f"<={bound}" for bound in BATCH_SIZE_BUCKETS] + [
+            f">{BATCH_SIZE_BUCKETS[-1]}"
+        ]
+        return {
+            "docs_indexed": self.docs_indexed,
+            "docs_failed": self.docs_failed,
+            "docs_per_sec": self.docs_indexed / elapsed if elapsed else 0.0,
+            "bulk_requests": self.bulk_requests,
+            "bulk_errors": self.bulk_errors,
+            "bulk_latency_p50_ms": (
+                float(np.percentile(latencies_ms, 50)) if len(latencies_ms) else None
+            ),
+            "bulk_latency_p99_ms": (
+                float(np.percentile(latencies_ms, 99)) if len(latencies_ms) else None
+            ),
+            "batch_size_histogram": dict(zip(labels, self.batch_size_counts)),
+            "consumer_lag": {
+                f"{topic}-{partition}": lag
+                for (topic, partition), lag in self.partition_lag.items()
+            },
+        }
+
+
+class BulkIndexError(Exception):
+    """Documents kept failing with retryable statuses, their batch is not committed."""
+
+
+class BulkSink:
+    """Move messages from a Kafka consumer into OpenSearch with ``_bulk``.
+
+    Messages are fetched with ``consume`` and buffered until the buffer holds
+    ``max_batch_docs`` documents, ``max_batch_bytes`` bytes or is older than
+    ``flush_interval`` seconds. Offsets are committed only once the bulk
+    request holding them succeeded, so the consumer needs
+    ``"enable.auto.commit": False``. Documents OpenSearch rejects for good,
+    like mapping errors, are logged and skipped, while documents that still
+    fail with a retryable status after ``max_retries`` make ``flush`` raise
+    ``BulkIndexError`` without committing, the batch is consumed again.
+
+    Parameters
+    ----------
+    client : OpenSearch
+        The OpenSearch client.
+    consumer : Consumer
+        A subscribed Kafka consumer.
+    index_name : str
+        The index documents are written to.
+    decode : callable
+        Turns a Kafka message into a document dict, see
+        ``serializers.decode_message``.
+    doc_id : callable
+        Called as ``doc_id(message, document)``, returns the document id,
+        see ``kafka_doc_id`` and ``content_doc_id``.
+    max_batch_docs : int
+        Flush once this many documents are buffered.
+    max_batch_bytes : int
+        Flush once the buffered message values reach this size.
+    flush_interval : float
+        Flush buffered documents at least this often, in seconds.
+    consume_timeout : float
+        How long a single ``consume`` call waits for messages.
+    max_retries : int
+        How often a failing bulk request or document is retried before
+        giving up.
+    report_interval : float
+        How often the metrics are logged, in seconds.
+    """
+
+    def __init__(
+        self,
+        client,
+        consumer,
+        index_name: str,
+        decode,
+        doc_id=kafka_doc_id,
+        max_batch_docs: int = 500,
+        max_batch_bytes: int = 5 * 1024 * 1024,
+        flush_interval: float = 1.0,
+        consume_timeout: float = 0.5,
+        max_retries: int = 5,
+        report_interval: float = 30.0,
+    ):
+        self.client = client
+        self.consumer = consumer
+        self.index_name = index_name
+        self.decode = decode
+        self.doc_id = doc_id
+        self.max_batch_docs = max_batch_docs
+        self.max_batch_bytes = max_batch_bytes
+        self.flush_interval = flush_interval
+        self.consume_timeout = consume_timeout
+        self.max_retries = max_retries
+        self.report_interval = report_interval
+        self.metrics = SinkMetrics()
+        self._documents = []
+        self._offsets = {}
+        self._batch_bytes = 0
+        self._batch_started = None
+        self._last_report = time.monotonic()
+        self._running = False
+        self._failed = False
+
+    def add(self, message) -> None:
+        """Buffer a single Kafka message."""
+        if message.error():
+            logger.error(f"Consumer error: {message.error()}")
+            return
+        try:
+            document = self.decode(message)
+        except Exception as e:
+            logger.error(f"Unable to decode message due to error: {e}")
+            self.metrics.record_failed()
+        else:
+            stamp_consumed(message, document)
+            self._documents.append((self.doc_id(message, document), document))
+            self._batch_bytes += len(message.value())
+        if self._batch_started is None:
+            self._batch_started = time.monotonic()
+        # undecodable messages are skipped, their offsets are still committed
+        self._offsets[(message.topic(), message.partition())] = message.offset() + 1
+
+    def should_flush(self) -> bool:
+        if not self._offsets:
+            return False
+        return (
+            len(self._documents) >= self.max_batch_docs
+            or self._batch_bytes >= self.max_batch_bytes
+            or time.monotonic() - self._batch_started >= self.flush_interval
+        )
+
+    def flush(self) -> None:
+        """Index the buffered documents and commit their offsets.
+
+        Raises
+        ------
+        BulkIndexError
+            When documents kept failing with retryable statuses, nothing is
+            committed and the buffer is kept.
+        """
+        if not self._offsets:
+            return
+        if self._documents:
+            try:
+                self._index(self._documents)
+            except Exception:
+                # the batch stays uncommitted, flushing it again on the way
+                # out would only repeat every retry
+                self._failed = True
+                raise
+            self._failed = False
+        try:
+            self.consumer.commit(
+                offsets=[
+                    TopicPartition(topic, partition, offset)
+                    for (topic, partition), offset in self._offsets.items()
+                ],
+                asynchronous=False,
+            )
+        except KafkaException as e:
+            # the documents are indexed under deterministic ids, so messages
+            # replayed after a failed commit only overwrite them
+            logger.error(f"Unable to commit offsets due to error: {e}")
+        self._documents = []
+        self._offsets = {}
+        self._batch_bytes = 0
+        self._batch_started = None
+
+    def _index(self, documents: list) -> None:
+        pending = list(documents)
+        failed = 0
+        started = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            indexed_at = time.time()
+            body = []
+            for doc_id, document in pending:
+                document["indexed_at"] = _isoformat(indexed_at)
+                body.append({"index": {"_index": self.index_name, "_id": doc_id}})
+                body.append(document)
+            try:
+                response = self.client.bulk(body=body)
+            except Exception as e:
+                self.metrics.record_bulk_error()
+                if attempt == self.max_retries:
+                    raise
+                logger.error(f"Bulk request failed due to error: {e}, retrying")
+                time.sleep(min(2**attempt * 0.1, 5.0))
+                continue
+            if not response.get("errors"):
+                pending = []
+                break
+            retry = []
+            for (doc_id, document), item in zip(pending, response["items"]):
+                result = item["index"]
+                if result.get("status", 200) < 300:
+                    continue
+                if result["status"] in RETRYABLE_STATUSES:
+                    retry.append((doc_id, document))
+                else:
+                    failed += 1
+                    logger.error(
+                        f"Unable to index document {doc_id}: {result.get('error')}"
+                    )
+            pending = retry
+            if not pending:
+                break
+            time.sleep(min(2**attempt * 0.1, 5.0))
+        self.metrics.record_bulk(
+            len(documents), time.monotonic() - started, failed + len(pending)
+        )
+        if pending:
+            # OpenSearch is overloaded or unavailable, not the documents at
+            # fault, raising keeps their offsets uncommitted so they are
+            # consumed again
+            raise BulkIndexError(
+                f"{len(pending)} documents still failed with retryable "
+                f"statuses after {self.max_retries} retries"
+            )
+        observe_stages(documents)
+
+    def update_lag(self) -> None:
+        """Measure how far each assigned partition's position is behind its end."""
+        try:
+            positions = self.consumer.position(self.consumer.assignment())
+        except KafkaException as e:
+            logger.error(f"Unable to get consumer positions due to error: {e}")
+            return
+        lag = {}
+        for tp in positions:
+            try:
+                _, high = self.consumer.get_watermark_offsets(tp, timeout=1.0)
+            except KafkaException as e:
+                logger.error(f"Unable to get watermarks due to error: {e}")
+                continue
+            # before the first fetch the position is unknown (negative)
+            lag[(tp.topic, tp.partition)] = high - tp.offset if tp.offset >= 0 else high
+        self.metrics.partition_lag = lag
+
+    def report(self) -> None:
+        self.update_lag()
+        logger.info(f"Sink metrics: {self.metrics.summary()}")
+        self._last_report = time.monotonic()
+
+    def on_assign(self, consumer, partitions) -> None:
+        """Rebalance callback, pass to ``Consumer.subscribe``."""
+        logger.info(f"Assigned partitions: {[p.partition for p in partitions]}")
+
+    def on_revoke(self, consumer, partitions) -> None:
+        """Rebalance callback, flushes before the partitions move elsewhere."""
+        logger.info(f"Revoked partitions: {[p.partition for p in partitions]}")
+        if not self._failed:
+            self.flush()
+
+    def stop(self) -> None:
+        """Make ``run`` return after the current batch, safe from signal handlers."""
+        self._running = False
+
+    def run(self) -> None:
+        """Consume, index and commit until ``stop`` is called or interrupted.
+
+        A batch that cannot be indexed ends the loop with its error, it is
+        not flushed again on the way out and its offsets stay uncommitted.
+        """
+        self._running = True
+        try:
+            while self._running:
+                messages = self.consumer.consume(
+                    num_messages=self.max_batch_docs, timeout=self.consume_timeout
+                )
+                for message in messages:
+                    self.add(message)
+                    if self.should_flush():
+                        self.flush()
+                if self.should_flush():
+                    self.flush()
+                if time.monotonic() - self._last_report >= self.report_interval:
+                    self.report()
+        finally:
+            try:
+                if not self._failed:
+                    self.flush()
+            finally:
+                self.report()
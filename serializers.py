@@ -0,0 +1,210 @@
+"""Event serialization shared by the producer and the consumer.
+
+Events are encoded once by the producer and tagged with a ``content-type``
+Kafka header, the consumer picks the matching serializer from that header.
+Messages without the header are pre-serializer ``str(dict)`` events and are
+decoded with ``ast.literal_eval``.
+"""
+
+import ast
+import datetime
+import json
+import os
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SCHEMA_REGISTRY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "configs", "event_schemas.json"
+)
+CONTENT_TYPE_HEADER = "content-type"
+
+
+def to_serializable(value):
+    """Turn values JSON can't encode into plain data.
+
+    Handles the objects the canvas pages put into events: streamlit's
+    ``UploadedFile``, svgpathtools ``Path``, numpy values and datetimes.
+    """
+    if isinstance(value, (np.generic,)):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    if hasattr(value, "file_id") and hasattr(value, "size"):
+        # streamlit UploadedFile, the content itself is not logged
+        return {
+            "name": getattr(value, "name", None),
+            "type": getattr(value, "type", None),
+            "size": value.size,
+            "file_id": value.file_id,
+        }
+    if hasattr(value, "d") and callable(value.d):
+        # svgpathtools Path, kept as its svg path string
+        return value.d()
+    return str(value)
+
+
+class JsonSerializer:
+    """JSON events, encoded with orjson when it is installed."""
+
+    content_type = "application/json"
+
+    def dumps(self, event: dict) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(
+                event,
+                default=to_serializable,
+                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+            )
+        return json.dumps(event, default=to_serializable).encode("utf-8")
+
+    def loads(self, value: bytes) -> dict:
+        if orjson is not None:
+            return orjson.loads(value)
+        return json.loads(value)
+
+
+class SchemaMsgpackSerializer:
+    """Compact msgpack events driven by a local schema registry file.
+
+    The registry lists the known fields of each message_type. Known fields
+    are written positionally behind a presence bitmask, so field names are
+    not repeated in every message. Fields missing from the schema, and events
+    of unknown message types, are kept in a trailing map.
+
+    Parameters
+    ----------
+    schema_path : str
+        The schema registry file, see ``configs/event_schemas.json``. Schemas
+        are only ever appended to it, since the schema id is its position.
+    """
+
+    content_type = "application/x-msgpack-schema"
+
+    def __init__(self, schema_path: str = SCHEMA_REGISTRY_PATH):
+        if msgpack is None:
+            raise ImportError(
+                "msgpack is required for the msgpack serializer, pip install msgpack"
+            )
+        with open(schema_path, "r") as f:
+            registry = json.load(f)
+        self.version = registry["version"]
+        self.schemas = [
+            (schema["message_type"], schema["fields"]) for schema in registry["schemas"]
+        ]
+        self.schema_ids = {
+            message_type: schema_id
+            for schema_id, (message_type, _) in enumerate(self.schemas)
+        }
+
+    def dumps(self, event: dict) -> bytes:
+        schema_id = self.schema_ids.get(event.get("message_type"), -1)
+        extras = dict(event)
+        mask = 0
+        values = []
+        if schema_id >= 0:
+            extras.pop("message_type")
+            for position, field in enumerate(self.schemas[schema_id][1]):
+                if field in extras:
+                    mask |= 1 << position
+                    values.append(extras.pop(field))
+        return msgpack.packb(
+            [self.version, schema_id, mask, values, extras],
+            default=to_serializable,
+            use_bin_type=True,
+        )
+
+    def loads(self, value: bytes) -> dict:
+        version, schema_id, mask, values, extras = msgpack.unpackb(value, raw=False)
+        if version != self.version:
+            raise ValueError(
+                f"Event was encoded with schema registry version {version}, "
+                f"this consumer has version {self.version}"
+            )
+        if schema_id < 0:
+            return extras
+        message_type, fields = self.schemas[schema_id]
+        event = {"message_type": message_type}
+        values = iter(values)
+        for position, field in enumerate(fields):
+            if mask & (1 << position):
+                event[field] = next(values)
+        event.update(extras)
+        return event
+
+
+class LegacySerializer:
+    """The original ``str(dict)`` format, decoded without ``eval``."""
+
+    content_type = "text/x-python-repr"
+
+    def dumps(self, event: dict) -> bytes:
+        return str(event).encode("utf-8")
+
+    def loads(self, value: bytes) -> dict:
+        return ast.literal_eval(value.decode("utf-8"))
+
+
+SERIALIZERS = {
+    "json": JsonSerializer,
+    "msgpack": SchemaMsgpackSerializer,
+    "legacy": LegacySerializer,
+}
+_instances = {}
+
+
+def get_serializer(name: str = None):
+    """Return a shared serializer by name.
+
+    Parameters
+    ----------
+    name : str
+        One of ``SERIALIZERS``, defaults to the ``EVENT_SERIALIZER``
+        environment variable or "json".
+    """
+    name = name or os.getenv("EVENT_SERIALIZER", "json")
+    if name not in SERIALIZERS:
+        raise ValueError(
+            f"serializer must be one of {tuple(SERIALIZERS)}, got {name!r}"
+        )
+    if name not in _instances:
+        _instances[name] = SERIALIZERS[name]()
+    return _instances[name]
+
+
+def _serializer_for_content_type(content_type: str):
+    for name, serializer_class in SERIALIZERS.items():
+        if serializer_class.content_type == content_type:
+            return get_serializer(name)
+    raise ValueError(f"Unknown content-type {content_type!r}")
+
+
+def encode_event(event: dict, serializer=None):
+    """Encode an event and return ``(value, headers)`` for ``produce``."""
+    serializer = serializer or get_serializer()
+    return serializer.dumps(event), [
+        (CONTENT_TYPE_HEADER, serializer.content_type.encode("utf-8"))
+    ]
+
+
+def decode_message(message) -> dict:
+    """Decode a Kafka message, picking the serializer from its headers."""
+    for key, value in message.headers() or []:
+        if key == CONTENT_TYPE_HEADER:
+            return _serializer_for_content_type(value.decode("utf-8")).loads(
+                message.value()
+            )
+    return get_serializer("legacy").loads(message.value())
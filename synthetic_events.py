@@ -0,0 +1,232 @@
+import datetime
+import math
+import random
+
+from arc_length import estimate_length
+from canvas_diff import CanvasDiffer
+
+
+def fabric_path(points: int = 50, rng: random.Random = random) -> list:
+    """Return a Fabric.js freedraw path over a smooth random stroke.
+
+    Like Fabric.js, each sampled point becomes the control point of a
+    quadratic curve ending half way to the next point.
+    """
+    x, y = rng.uniform(0, 512), rng.uniform(0, 320)
+    heading = rng.uniform(0, 2 * math.pi)
+    samples = []
+    for _ in range(points + 1):
+        samples.append((x, y))
+        heading += rng.gauss(0, 0.3)
+        step = rng.uniform(1, 4)
+        x, y = x + step * math.cos(heading), y + step * math.sin(heading)
+    path = [["M", *samples[0]]]
+    for (cx, cy), (nx, ny) in zip(samples, samples[1:]):
+        path.append(["Q", cx, cy, (cx + nx) / 2, (cy + ny) / 2])
+    path.append(["L", *samples[-1]])
+    return path
+
+
+def fabric_object(kind: str = "rect", rng: random.Random = random) -> dict:
+    """Return a Fabric.js object as streamlit-drawable-canvas reports it."""
+    obj = {
+        "type": kind,
+        "version": "4.4.0",
+        "originX": "left",
+        "originY": "center" if kind == "circle" else "top",
+        "left": rng.uniform(0, 500),
+        "top": rng.uniform(0, 300),
+        "width": rng.uniform(5, 120),
+        "height": rng.uniform(5, 120),
+        "fill": "rgba(255, 165, 0, 0.3)",
+        "stroke": "#000000",
+        "strokeWidth": 3,
+        "strokeDashArray": None,
+        "strokeLineCap": "round",
+        "strokeDashOffset": 0,
+        "strokeLineJoin": "round",
+        "strokeUniform": False,
+        "strokeMiterLimit": 4,
+        "scaleX": 1,
+        "scaleY": 1,
+        "angle": rng.uniform(0, 360) if kind == "circle" else 0,
+        "flipX": False,
+        "flipY": False,
+        "opacity": 1,
+        "shadow": None,
+        "visible": True,
+        "backgroundColor": "",
+        "fillRule": "nonzero",
+        "paintFirst": "fill",
+        "globalCompositeOperation": "source-over",
+        "skewX": 0,
+        "skewY": 0,
+    }
+    if kind == "circle":
+        obj["radius"] = obj["width"] / 2
+        obj["startAngle"] = 0
+        obj["endAngle"] = 360
+    elif kind == "path":
+        obj["fill"] = None
+        obj["path"] = fabric_path(rng=rng)
+    else:
+        obj["rx"] = 0
+        obj["ry"] = 0
+    return obj
+
+
+def _timestamp() -> str:
+    return datetime.datetime.now().isoformat()
+
+
+def _event(message_type: str, **fields) -> dict:
+    return {"timestamp": _timestamp(), "message_type": message_type, **fields}
+
+
+# the canvas objects each app draws
+CANVAS_KINDS = {
+    "basic-example": "path",
+    "center-circle": "circle",
+    "color-annotation": "rect",
+    "compute-arc-length": "path",
+}
+
+MESSAGE_TYPES = tuple(CANVAS_KINDS)
+
+
+def edit_canvas(objects: list, kind: str, rng: random.Random = random) -> list:
+    """Return the canvas after one user action, drawing, moving or deleting."""
+    objects = list(objects)
+    action = rng.random()
+    if not objects or action < 0.5:
+        objects.append(fabric_object(kind, rng))
+    elif action < 0.9:
+        index = rng.randrange(len(objects))
+        moved = dict(objects[index])
+        moved["left"] += rng.uniform(-20, 20)
+        moved["top"] += rng.uniform(-20, 20)
+        objects[index] = moved
+    else:
+        objects.pop(rng.randrange(len(objects)))
+    return objects
+
+
+class SyntheticSession:
+    """One user's reruns of the demo apps, producing the events app.py sends.
+
+    Canvases are edited an action at a time and sent as ``CanvasDiffer``
+    deltas, the full_app sidebar as ``RerunEventCollector`` records holding
+    only the fields that changed, alongside the derived events each app sends
+    when its canvas changed.
+
+    Parameters
+    ----------
+    rng : random.Random
+        The source of randomness, seed it for repeatable sessions.
+    """
+
+    def __init__(self, rng: random.Random = random):
+        self.rng = rng
+        self.state = {}
+        self.canvases = {message_type: [] for message_type in MESSAGE_TYPES}
+        self.widgets = {
+            "drawing_mode": "freedraw",
+            "stroke_width": 3,
+            "stroke_color": "#000000",
+            "bg_color": "#eee",
+            "bg_image": None,
+            "realtime_update": True,
+        }
+        self.sent = {}
+
+    def rerun(self, message_type: str) -> list:
+        """Return the events of one rerun of the app sending ``message_type``."""
+        rng = self.rng
+        if message_type == "basic-example" and rng.random() < 0.5:
+            # a sidebar change, the canvas stays as it is
+            return self._basic_example(canvas_changed=False)
+        objects = edit_canvas(
+            self.canvases[message_type], CANVAS_KINDS[message_type], rng
+        )
+        self.canvases[message_type] = objects
+        delta = CanvasDiffer(message_type, state=self.state).diff(objects)
+        if message_type == "basic-example":
+            return self._basic_example(canvas_changed=delta is not None)
+        if message_type == "color-annotation":
+            # the sidebar values are sent on every rerun
+            events = [
+                _event("color-annotation-settings", body=body)
+                for body in ("#EA101077", "Default", rng.choice(("rect", "transform")))
+            ]
+        else:
+            events = []
+        if delta is None:
+            return events
+        events.append(_event(message_type, body=delta))
+        if message_type == "center-circle":
+            events.append(_event("center-circle-centers", body=circle_centers(objects)))
+        elif message_type == "compute-arc-length":
+            # the lengths of the changed paths only, keyed by their object id
+            body = []
+            for change in delta["added"] + delta["modified"]:
+                length = estimate_length(change["object"]["path"])
+                body.append({"id": change["id"], "length": f"{length:.3f} pixels"})
+            if body:
+                events.append(_event("compute-arc-length-lengths", body=body))
+        return events
+
+    def _basic_example(self, canvas_changed: bool) -> list:
+        rng = self.rng
+        widget = rng.choice(tuple(self.widgets))
+        if widget == "drawing_mode":
+            value = rng.choice(("freedraw", "line", "rect", "circle", "transform"))
+        elif widget == "stroke_width":
+            value = rng.randint(1, 25)
+        elif widget in ("stroke_color", "bg_color"):
+            value = f"#{rng.randrange(16**6):06x}"
+        elif widget == "realtime_update":
+            value = not self.widgets[widget]
+        else:
+            value = self.widgets[widget]
+        self.widgets[widget] = value
+        fields = dict(self.widgets)
+        objects = self.canvases["basic-example"]
+        if canvas_changed and objects:
+            # full_app adds the fields of the first object
+            fields.update(
+                {
+                    key: "new path drawn" if key == "path" else value
+                    for key, value in objects[0].items()
+                }
+            )
+        changed = {
+            key: value
+            for key, value in fields.items()
+            if key not in self.sent or self.sent[key] != value
+        }
+        self.sent.update(changed)
+        return [_event("basic-example", **changed)] if changed else []
+
+
+def circle_centers(objects: list) -> list:
+    """The center-circle-centers body, the records of ``app.circle_centers``."""
+    centers = []
+    for obj in objects:
+        theta = math.radians(obj["angle"])
+        centers.append(
+            {
+                "center_x": obj["left"] + obj["radius"] * math.cos(theta),
+                "center_y": obj["top"] + obj["radius"] * math.sin(theta),
+                "radius": obj["radius"],
+            }
+        )
+    return centers
+
+
+def session_events(message_type: str, events: int, rng: random.Random = random) -> list:
+    """Return ``events`` events of reruns of one session of one app."""
+    session = SyntheticSession(rng)
+    result = []
+    while len(result) < events:
+        result.extend(session.rerun(message_type))
+    return result[:events]